@@ -0,0 +1,344 @@
+"""
+PymageJ Copyright (C) 2015 Jochem Smit
+
+This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public License
+ as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+ of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program; if not, write to the
+Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import numpy as np
+from collections import OrderedDict
+import json
+import mmap
+import struct
+
+from pymagej.roi import ROIFileObject, ROIPolygon, ROIRect, ROIOval, ROILine, ROIFreeLine, ROIPolyline, ROIFreehand, \
+    ROITraced, ROIComposite
+from pymagej.geometry import areas, perimeters, centroids, simplify_mask, segment_sums
+
+
+roi_classes = {cls.type: cls for cls in [ROIPolygon, ROIRect, ROIOval, ROILine, ROIFreeLine, ROIPolyline, ROIFreehand,
+                                         ROITraced, ROIComposite]}
+
+# Type codes of ROIs with vertices, closed shapes and lines. Composite ROIs store their rings as a single vertex stream
+# (see ROIComposite), which is filled, measured and tested for containment like a polygon.
+TYPES_CLOSED = np.array([ROIFileObject.roi_types_rev[t] for t in ['polygon', 'freehand', 'traced', 'composite']])
+TYPES_OPEN = np.array([ROIFileObject.roi_types_rev[t] for t in ['line', 'freeline', 'polyline']])
+
+
+def _object_array(values):
+    """1D object array of values, also if the values are arrays of equal length"""
+    if isinstance(values, np.ndarray) and values.dtype == object and values.ndim == 1:
+        return values
+    values = list(values)
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+class ROICollection(object):
+    """
+    Columnar storage of many ROIs.
+
+    Vertices of all ROIs are stored in the flat float32 arrays x and y (absolute image coordinates), the vertices of
+    ROI i are x[offsets[i]:offsets[i + 1]]. Line ROIs store their two endpoints as vertices. All other properties are
+    stored as parallel arrays with one entry per ROI (see columns). ROI objects are only created when indexing or
+    iterating.
+    """
+
+    # Per ROI columns and their dtypes, names is an object array
+    columns = OrderedDict([
+        ('types', np.uint8), ('top', np.int32), ('left', np.int32), ('bottom', np.int32), ('right', np.int32),
+        ('names', object), ('arc', np.int16), ('subpixel', bool), ('position', np.int32), ('c_position', np.int32),
+        ('z_position', np.int32), ('t_position', np.int32), ('stroke_width', np.int16), ('stroke_color', np.int32),
+        ('fill_color', np.int32), ('ring_offsets', object)
+    ])
+
+    # Default values of the object columns, ring_offsets are the offsets of the rings of composite ROIs
+    object_defaults = {'names': '', 'ring_offsets': None}
+
+    # Columns which are stored in the ROI's header
+    header_columns = ['position', 'c_position', 'z_position', 't_position', 'stroke_width', 'stroke_color',
+                      'fill_color']
+
+    def __init__(self, types, top, left, bottom, right, x, y, offsets, **columns):
+        n = len(types)
+        columns.update(types=types, top=top, left=left, bottom=bottom, right=right)
+        for attr, dtype in self.columns.items():
+            value = columns.pop(attr, None)
+            if value is None:
+                value = [self.object_defaults[attr]] * n if dtype is object else np.zeros(n, dtype=dtype)
+            if dtype is not object:
+                value = np.asarray(value, dtype=dtype)
+            else:
+                value = np.array(value, dtype=object) if attr == 'names' else _object_array(value)
+            setattr(self, attr, value)
+        if columns:
+            raise TypeError('Unknown columns: %s' % ', '.join(sorted(columns)))
+
+        self.x = np.asarray(x, dtype=np.float32)
+        self.y = np.asarray(y, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        assert len(self.offsets) == n + 1, 'Offsets should have one entry more than the number of ROIs'
+        assert len(self.x) == len(self.y) == self.offsets[-1], 'Unequal length of x and y coords'
+
+    @classmethod
+    def from_rois(cls, rois):
+        if isinstance(rois, ROICollection):
+            return rois
+
+        columns = {k: [] for k in cls.columns}
+        xs, ys = [], []
+        lengths = [0]
+
+        for roi_obj in rois:
+            if roi_obj.type == 'line':
+                x = np.array([roi_obj.x1, roi_obj.x2], dtype=np.float32)
+                y = np.array([roi_obj.y1, roi_obj.y2], dtype=np.float32)
+                bounds = [np.floor(y.min()), np.floor(x.min()), np.ceil(y.max()), np.ceil(x.max())]
+            else:
+                bounds = [roi_obj.top, roi_obj.left, roi_obj.bottom, roi_obj.right]
+                if hasattr(roi_obj, 'x_coords'):
+                    x = roi_obj.left + np.asarray(roi_obj.x_coords, dtype=np.float32)
+                    y = roi_obj.top + np.asarray(roi_obj.y_coords, dtype=np.float32)
+                else:
+                    x = y = np.empty(0, dtype=np.float32)
+
+            header = getattr(roi_obj, 'header', None) or {}
+            for k, v in zip(['top', 'left', 'bottom', 'right'], bounds):
+                columns[k].append(v)
+            columns['types'].append(ROIFileObject.roi_types_rev[roi_obj.type])
+            columns['names'].append(roi_obj.name or '')
+            columns['arc'].append(getattr(roi_obj, 'arc', 0))
+            columns['ring_offsets'].append(getattr(roi_obj, 'ring_offsets', None))
+            columns['subpixel'].append(hasattr(roi_obj, 'x_coords') and np.asarray(roi_obj.x_coords).dtype.kind == 'f')
+            for k in cls.header_columns:
+                columns[k].append(header.get(k.upper(), 0))
+
+            xs.append(x)
+            ys.append(y)
+            lengths.append(len(x))
+
+        x = np.concatenate(xs) if xs else np.empty(0, dtype=np.float32)
+        y = np.concatenate(ys) if ys else np.empty(0, dtype=np.float32)
+
+        return cls(x=x, y=y, offsets=np.cumsum(lengths), **columns)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        """Materialize ROI i as an ROIObject"""
+        if i < 0:
+            i += len(self)
+        roi_type = ROIFileObject.roi_types[self.types[i]]
+        cls = roi_classes[roi_type]
+        name = self.names[i]
+        x = self.x[self.offsets[i]:self.offsets[i + 1]]
+        y = self.y[self.offsets[i]:self.offsets[i + 1]]
+        top, left, bottom, right = [int(c[i]) for c in [self.top, self.left, self.bottom, self.right]]
+
+        if roi_type == 'line':
+            roi_obj = ROILine(float(x[0]), float(y[0]), float(x[1]), float(y[1]), name=name)
+        elif roi_type == 'rect':
+            roi_obj = ROIRect(top, left, bottom, right, arc=int(self.arc[i]), name=name)
+        elif roi_type == 'oval':
+            roi_obj = ROIOval(top, left, bottom, right, name=name)
+        else:
+            x_coords, y_coords = x - left, y - top
+            if not self.subpixel[i]:
+                x_coords, y_coords = np.round(x_coords).astype(np.int32), np.round(y_coords).astype(np.int32)
+            if roi_type == 'composite':
+                roi_obj = cls(top, left, bottom, right, x_coords, y_coords, self.ring_offsets[i], name=name)
+            else:
+                roi_obj = cls(top, left, bottom, right, x_coords, y_coords, name=name)
+
+        roi_obj.header = {k.upper(): getattr(self, k)[i].item() for k in self.header_columns}
+        return roi_obj
+
+    def take(self, indices):
+        """New ROICollection with the ROIs at indices (integer or boolean array)"""
+        indices = np.arange(len(self))[indices]
+        lengths = self.lengths[indices]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        vertex_idx = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+        columns = {k: getattr(self, k)[indices] for k in self.columns}
+        return ROICollection(x=self.x[vertex_idx], y=self.y[vertex_idx], offsets=offsets, **columns)
+
+    def simplify(self, tolerance=0.5):
+        """
+        New ROICollection with the vertices of all ROIs simplified (see geometry.simplify), bounding boxes are kept.
+        Composite ROIs are not simplified.
+        """
+        keep = simplify_mask(self.x, self.y, self.offsets, tolerance, closed=np.isin(self.types, TYPES_CLOSED))
+        # The rings of composite ROIs are joined by repeated vertices, these are not simplified
+        keep[np.repeat(self.types == ROIFileObject.roi_types_rev['composite'], self.lengths)] = True
+        offsets = np.concatenate([[0], np.cumsum(segment_sums(keep, self.offsets).astype(np.int64))])
+        columns = {k: getattr(self, k) for k in self.columns}
+        return ROICollection(x=self.x[keep], y=self.y[keep], offsets=offsets, **columns)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def width(self):
+        return self.right - self.left
+
+    @property
+    def height(self):
+        return self.bottom - self.top
+
+    @property
+    def bboxes(self):
+        """Array of (top, left, bottom, right) per ROI"""
+        return np.stack([self.top, self.left, self.bottom, self.right], axis=1)
+
+    @property
+    def area(self):
+        width, height = self.width.astype(np.float64), self.height.astype(np.float64)
+        area = np.zeros(len(self))
+
+        is_rect = self.types == ROIFileObject.roi_types_rev['rect']
+        area[is_rect] = width[is_rect] * height[is_rect] - (4 - np.pi) * (self.arc[is_rect] / 2.) ** 2
+
+        is_oval = self.types == ROIFileObject.roi_types_rev['oval']
+        area[is_oval] = width[is_oval] * height[is_oval] * np.pi / 4
+
+        is_closed = np.isin(self.types, TYPES_CLOSED)
+        area[is_closed] = areas(self.x, self.y, self.offsets)[is_closed]
+
+        return area
+
+    @property
+    def perimeter(self):
+        width, height = self.width.astype(np.float64), self.height.astype(np.float64)
+        perimeter = perimeters(self.x, self.y, self.offsets, closed=np.isin(self.types, TYPES_CLOSED))
+
+        is_rect = self.types == ROIFileObject.roi_types_rev['rect']
+        perimeter[is_rect] = 2 * (width[is_rect] + height[is_rect]) - (4 - np.pi) * self.arc[is_rect]
+
+        is_oval = self.types == ROIFileObject.roi_types_rev['oval']
+        a, b = width[is_oval] / 2., height[is_oval] / 2.
+        perimeter[is_oval] = np.pi * (3 * (a + b) - np.sqrt((3 * a + b) * (a + 3 * b)))  # Ramanujan's approximation
+
+        # The edges joining the rings of composite ROIs are not part of their perimeter
+        for i in np.flatnonzero(self.types == ROIFileObject.roi_types_rev['composite']):
+            perimeter[i] = self[i].perimeter
+
+        return perimeter
+
+    @property
+    def centroid(self):
+        """Centroids as an (n, 2) array of x, y"""
+        centroid = centroids(self.x, self.y, self.offsets, closed=np.isin(self.types, TYPES_CLOSED))
+
+        is_box = np.isin(self.types, [ROIFileObject.roi_types_rev['rect'], ROIFileObject.roi_types_rev['oval']])
+        centroid[is_box, 0] = self.left[is_box] + self.width[is_box] / 2.
+        centroid[is_box, 1] = self.top[is_box] + self.height[is_box] / 2.
+
+        return centroid
+
+    def in_bbox(self, top, left, bottom, right):
+        """Indices of ROIs whose bounding box overlaps with the given box"""
+        overlaps = (self.top < bottom) & (self.bottom > top) & (self.left < right) & (self.right > left)
+        return np.nonzero(overlaps)[0]
+
+
+CACHE_MAGIC = b'PYMAGEJC'
+CACHE_VERSION = 1
+_CACHE_ALIGN = 64  # Arrays in the cache file start at multiples of 64 bytes
+
+
+def _aligned(offset):
+    return -(-offset // _CACHE_ALIGN) * _CACHE_ALIGN
+
+
+def save_cache(rois, path):
+    """
+    Save ROIs (an ROICollection or iterable of ROI objects) to a single binary cache file, which load_cache reads
+    back without decoding any ROI. The file is a small JSON header describing the arrays of the ROICollection,
+    followed by the raw arrays.
+    """
+    collection = ROICollection.from_rois(rois)
+    names = [name.encode('utf-8') for name in collection.names]
+
+    arrays = OrderedDict((k, getattr(collection, k)) for k in ROICollection.columns
+                         if ROICollection.columns[k] is not object)
+    arrays['x'], arrays['y'], arrays['offsets'] = collection.x, collection.y, collection.offsets
+    arrays['names_data'] = np.frombuffer(b''.join(names), dtype=np.uint8)
+    arrays['names_offsets'] = np.cumsum([0] + [len(name) for name in names], dtype=np.int64)
+    # Ring offsets of composite ROIs, the count is -1 for ROIs without ring offsets
+    ring_offsets = [np.asarray(r if r is not None else [], dtype=np.int64) for r in collection.ring_offsets]
+    arrays['ring_offsets_data'] = np.concatenate(ring_offsets) if ring_offsets else np.empty(0, dtype=np.int64)
+    arrays['ring_offsets_counts'] = np.array([len(r) if o is not None else -1 for r, o in
+                                              zip(ring_offsets, collection.ring_offsets)], dtype=np.int64)
+
+    header = {'version': CACHE_VERSION, 'n_rois': len(collection), 'arrays': OrderedDict()}
+    offset = 0
+    for k, array in arrays.items():
+        arrays[k] = array = np.ascontiguousarray(array)
+        header['arrays'][k] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _aligned(len(CACHE_MAGIC) + 8 + len(header_bytes))
+
+    with open(path, 'wb') as f_obj:
+        f_obj.write(CACHE_MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for k, array in arrays.items():
+            f_obj.seek(data_start + header['arrays'][k]['offset'])
+            f_obj.write(array.tobytes())
+        f_obj.truncate(data_start + offset)
+
+
+def load_cache(path, use_mmap=True):
+    """
+    Load an ROICollection saved with save_cache. With use_mmap the file is memory-mapped and the coordinate and column
+    arrays are read-only views on the mapping.
+    """
+    with open(path, 'rb') as f_obj:
+        if use_mmap:
+            buffer = mmap.mmap(f_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buffer = f_obj.read()
+
+    if buffer[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+        raise IOError('Invalid ROI cache file, magic number mismatch')
+    header_length = struct.unpack_from('<Q', buffer, len(CACHE_MAGIC))[0]
+    header_start = len(CACHE_MAGIC) + 8
+    header = json.loads(bytes(buffer[header_start:header_start + header_length]).decode('utf-8'))
+    if header['version'] != CACHE_VERSION:
+        raise IOError('Unsupported ROI cache version %s' % header['version'])
+    data_start = _aligned(header_start + header_length)
+
+    arrays = {}
+    for k, spec in header['arrays'].items():
+        count = int(np.prod(spec['shape']))
+        if count:
+            array = np.frombuffer(buffer, dtype=spec['dtype'], count=count, offset=data_start + spec['offset'])
+        else:
+            array = np.empty(0, dtype=spec['dtype'])
+        arrays[k] = array.reshape(spec['shape'])
+
+    names_data = arrays.pop('names_data').tobytes()
+    names_offsets = arrays.pop('names_offsets')
+    arrays['names'] = [names_data[a:b].decode('utf-8') for a, b in zip(names_offsets[:-1], names_offsets[1:])]
+
+    if 'ring_offsets_data' in arrays:
+        ring_data, counts = arrays.pop('ring_offsets_data'), arrays.pop('ring_offsets_counts')
+        starts = np.concatenate([[0], np.cumsum(np.maximum(counts, 0))])
+        arrays['ring_offsets'] = [ring_data[a:a + c] if c >= 0 else None for a, c in zip(starts, counts)]
+
+    return ROICollection(**arrays)
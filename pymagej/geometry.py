@@ -0,0 +1,361 @@
+"""
+PymageJ Copyright (C) 2015 Jochem Smit
+
+This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public License
+ as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+ of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program; if not, write to the
+Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import numpy as np
+
+
+# Batched geometry over many polygons stored as concatenated vertex arrays x, y, where polygon i has vertices
+# x[offsets[i]:offsets[i + 1]].
+
+
+def segment_sums(values, offsets):
+    """Sum of values per segment given by offsets, empty segments sum to zero"""
+    offsets = np.asarray(offsets)
+    sums = np.zeros(len(offsets) - 1)
+    non_empty = offsets[1:] > offsets[:-1]
+    if non_empty.any():
+        sums[non_empty] = np.add.reduceat(values, offsets[:-1][non_empty])
+    return sums
+
+
+def next_indices(offsets):
+    """Index of the next vertex for every vertex, wrapping around within each segment"""
+    offsets = np.asarray(offsets)
+    nxt = np.arange(1, offsets[-1] + 1)
+    starts, ends = offsets[:-1], offsets[1:]
+    non_empty = ends > starts
+    nxt[ends[non_empty] - 1] = starts[non_empty]
+    return nxt
+
+
+def segment_indices(starts, counts):
+    """Concatenated aranges starts[i] .. starts[i] + counts[i] and the index i of every element"""
+    segment = np.repeat(np.arange(len(starts)), counts)
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum()), segment
+
+
+def _edges(x, y, offsets):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    nxt = next_indices(offsets)
+    return x, y, x[nxt], y[nxt]
+
+
+def _signed_areas(x, y, offsets):
+    x1, y1, x2, y2 = _edges(x, y, offsets)
+    cross = x1 * y2 - x2 * y1
+    return segment_sums(cross, offsets) / 2, cross
+
+
+def signed_areas(x, y, offsets):
+    """Shoelace area of each polygon, positive for polygons which are clockwise in image coordinates (y down)"""
+    return _signed_areas(x, y, offsets)[0]
+
+
+def areas(x, y, offsets):
+    """Shoelace area of each polygon"""
+    return np.abs(signed_areas(x, y, offsets))
+
+
+def perimeters(x, y, offsets, closed=True):
+    """
+    Length of the outline of each polygon. closed (bool or array of bools per polygon) sets whether the segment from
+    the last vertex back to the first is included, which it is not for lines.
+    """
+    x1, y1, x2, y2 = _edges(x, y, offsets)
+    lengths = np.hypot(x2 - x1, y2 - y1)
+    lengths[_wrap_edges(offsets, closed)] = 0
+    return segment_sums(lengths, offsets)
+
+
+def centroids(x, y, offsets, closed=True):
+    """
+    Centroid (x, y) of each polygon as an (n, 2) array. For closed polygons this is the centroid of the enclosed area,
+    for open ones (lines) the centroid of the line segments. Degenerate polygons fall back to the mean of the vertices.
+    """
+    offsets = np.asarray(offsets)
+    x1, y1, x2, y2 = _edges(x, y, offsets)
+    closed = np.broadcast_to(closed, (len(offsets) - 1,))
+    counts = np.diff(offsets)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.stack([segment_sums(x1, offsets), segment_sums(y1, offsets)], axis=1) / counts[:, np.newaxis]
+
+        signed_area, cross = _signed_areas(x, y, offsets)
+        area_centroid = np.stack([segment_sums((x1 + x2) * cross, offsets),
+                                  segment_sums((y1 + y2) * cross, offsets)], axis=1) / (6 * signed_area[:, np.newaxis])
+
+        lengths = np.hypot(x2 - x1, y2 - y1)
+        lengths[_wrap_edges(offsets, False)] = 0
+        total = segment_sums(lengths, offsets)
+        line_centroid = np.stack([segment_sums((x1 + x2) / 2 * lengths, offsets),
+                                  segment_sums((y1 + y2) / 2 * lengths, offsets)], axis=1) / total[:, np.newaxis]
+
+    result = np.where(closed[:, np.newaxis], area_centroid, line_centroid)
+    degenerate = np.where(closed, signed_area == 0, total == 0)
+    result[degenerate] = mean[degenerate]
+    return result
+
+
+def _wrap_edges(offsets, closed):
+    """Boolean mask of the edges from the last back to the first vertex of the polygons which are not closed"""
+    offsets = np.asarray(offsets)
+    wrap = np.zeros(offsets[-1], dtype=bool)
+    open_ = ~np.broadcast_to(closed, (len(offsets) - 1,)) & (offsets[1:] > offsets[:-1])
+    wrap[offsets[1:][open_] - 1] = True
+    return wrap
+
+
+def simplify_mask(x, y, offsets, tolerance=0.5, closed=True):
+    """
+    Boolean mask of the vertices kept by Douglas-Peucker simplification of each polygon, with the tolerance in pixels.
+    Collinear and duplicate vertices are always removed, closed polygons which would be left with fewer than three
+    vertices are kept unchanged. The recursion is run breadth first on all polygons at once, each iteration splits
+    every remaining interval at its vertex furthest from the interval's chord.
+    """
+    offsets = np.asarray(offsets)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    counts = np.diff(offsets)
+    closed = np.broadcast_to(closed, counts.shape) & (counts > 0)
+
+    # Closed polygons get their first vertex appended, so they are simplified as a line starting and ending there
+    ext_counts = counts + closed
+    ext_idx, segment = segment_indices(offsets[:-1], ext_counts)
+    ext_offsets = np.concatenate([[0], np.cumsum(ext_counts)])
+    appended = ext_offsets[1:][closed] - 1
+    ext_idx[appended] = offsets[:-1][closed]
+    ex, ey = x[ext_idx], y[ext_idx]
+
+    keep = np.zeros(len(ext_idx), dtype=bool)
+    keep[ext_offsets[:-1][ext_counts > 0]] = True
+    keep[ext_offsets[1:][ext_counts > 0] - 1] = True
+    small = counts < 3
+    keep[np.isin(segment, np.flatnonzero(small))] = True
+
+    a, b = ext_offsets[:-1][~small], ext_offsets[1:][~small] - 1
+    while len(a):
+        interior = b - a - 1
+        a, b, interior = a[interior > 0], b[interior > 0], interior[interior > 0]
+        if not len(a):
+            break
+        idx, interval = segment_indices(a + 1, interior)
+
+        # Distance to the chord, or to its start if the chord has zero length (closed polygons)
+        dx, dy = ex[b] - ex[a], ey[b] - ey[a]
+        chord = np.hypot(dx, dy)
+        px, py = ex[idx] - ex[a][interval], ey[idx] - ey[a][interval]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance = np.abs(dx[interval] * py - dy[interval] * px) / chord[interval]
+        distance = np.where(chord[interval] > 0, distance, np.hypot(px, py))
+
+        starts = np.concatenate([[0], np.cumsum(interior)[:-1]])
+        maximum = np.maximum.reduceat(distance, starts)
+        candidates = np.flatnonzero(distance == maximum[interval])
+        furthest = idx[candidates[np.unique(interval[candidates], return_index=True)[1]]]
+
+        split = maximum > tolerance
+        keep[furthest[split]] = True
+        a, b = np.concatenate([a[split], furthest[split]]), np.concatenate([furthest[split], b[split]])
+
+    keep[appended] = False
+    result = np.zeros(len(x), dtype=bool)
+    result[ext_idx[keep]] = True
+
+    # Closed polygons smaller than the tolerance would collapse into a line, these are not simplified
+    collapsed = closed & (segment_sums(result, offsets) < 3)
+    result[np.isin(np.repeat(np.arange(len(counts)), counts), np.flatnonzero(collapsed))] = True
+    return result
+
+
+def simplify(x, y, offsets, tolerance=0.5, closed=True):
+    """Simplified polygons (see simplify_mask), returns the new x, y and offsets"""
+    keep = simplify_mask(x, y, offsets, tolerance=tolerance, closed=closed)
+    offsets = np.asarray(offsets)
+    new_offsets = np.concatenate([[0], np.cumsum(segment_sums(keep, offsets).astype(np.int64))])
+    return np.asarray(x)[keep], np.asarray(y)[keep], new_offsets
+
+
+# Segment types of the paths of shape (composite) ROIs as in java.awt.geom.PathIterator, and their number of coordinates
+SEG_MOVETO, SEG_LINETO, SEG_QUADTO, SEG_CUBICTO, SEG_CLOSE = range(5)
+_SEG_N_COORDS = np.array([2, 2, 4, 6, 0])
+
+
+def decode_path(segments, curve_steps=8):
+    """
+    Rings of the path in the float segment array of a shape ROI: every segment is its type followed by its
+    coordinates. Subpaths start at moveTo, quadratic and cubic curves are flattened into curve_steps line segments.
+    Returns x, y and offsets of the rings, which are not explicitly closed.
+
+    The segments are parsed without a loop: every value is treated as a possible segment start pointing to the next
+    segment start, the actual segment starts are those reachable from the first value, found by pointer jumping.
+    """
+    values = np.asarray(segments, dtype=np.float64)
+    n = len(values)
+    if n == 0:
+        return np.empty(0), np.empty(0), np.zeros(1, dtype=np.int64)
+
+    is_code = (values == np.round(values)) & (values >= SEG_MOVETO) & (values <= SEG_CLOSE)
+    codes = np.where(is_code, values, SEG_CLOSE).astype(np.int64)
+    nxt = np.append(np.minimum(np.arange(n) + 1 + _SEG_N_COORDS[codes], n), n)
+    reached = np.zeros(n + 1, dtype=bool)
+    reached[0] = True
+    for i in range(int(np.ceil(np.log2(n + 1))) + 1):
+        reached[nxt[reached]] = True
+        nxt = nxt[nxt]
+    starts = np.flatnonzero(reached[:n])
+    if not is_code[starts].all() or starts[-1] + 1 + _SEG_N_COORDS[codes[starts[-1]]] != n:
+        raise ValueError('Invalid shape ROI path')
+    codes = codes[starts]
+    if codes[0] != SEG_MOVETO:
+        raise ValueError('Shape ROI path should start with moveTo')
+
+    # Control points of every segment as a cubic curve from the end point of the previous segment, moveTo and
+    # lineTo are a single point at t = 1, close segments have no points
+    n_coords = _SEG_N_COORDS[codes]
+    end_x = values[np.minimum(starts + n_coords - 1, n - 1)]
+    end_y = values[np.minimum(starts + n_coords, n - 1)]
+    subpath = np.cumsum(codes == SEG_MOVETO) - 1
+    is_close = codes == SEG_CLOSE
+    end_x[is_close], end_y[is_close] = end_x[codes == SEG_MOVETO][subpath[is_close]], \
+        end_y[codes == SEG_MOVETO][subpath[is_close]]
+    x0, y0 = np.roll(end_x, 1), np.roll(end_y, 1)
+
+    c1x, c1y = values[np.minimum(starts + 1, n - 1)], values[np.minimum(starts + 2, n - 1)]
+    c2x, c2y = values[np.minimum(starts + 3, n - 1)], values[np.minimum(starts + 4, n - 1)]
+    is_quad, is_cubic = codes == SEG_QUADTO, codes == SEG_CUBICTO
+    # Quadratic curves as cubic with control points 2/3 of the way to the quadratic control point
+    q1x, q1y = x0 + 2 / 3. * (c1x - x0), y0 + 2 / 3. * (c1y - y0)
+    q2x, q2y = end_x + 2 / 3. * (c1x - end_x), end_y + 2 / 3. * (c1y - end_y)
+    p1x = np.where(is_cubic, c1x, np.where(is_quad, q1x, end_x))
+    p1y = np.where(is_cubic, c1y, np.where(is_quad, q1y, end_y))
+    p2x = np.where(is_cubic, c2x, np.where(is_quad, q2x, end_x))
+    p2y = np.where(is_cubic, c2y, np.where(is_quad, q2y, end_y))
+
+    # Rings start at moveTo, or at a segment following a close without moveTo, which starts at the point the previous
+    # ring was closed at (its start) and also gets a vertex at t = 0
+    implicit = ~is_close & (codes != SEG_MOVETO) & np.r_[False, is_close[:-1]]
+    ring_id = np.cumsum((codes == SEG_MOVETO) | implicit) - 1
+    p0x, p0y = np.where(is_quad | is_cubic | implicit, x0, end_x), np.where(is_quad | is_cubic | implicit, y0, end_y)
+
+    counts = np.where(is_quad | is_cubic, curve_steps, np.where(is_close, 0, 1)) + implicit
+    step, segment = segment_indices((~implicit).astype(np.int64), counts)
+    t = step / np.where(is_quad | is_cubic, curve_steps, 1)[segment]
+    u = 1 - t
+    b0, b1, b2, b3 = u**3, 3 * u**2 * t, 3 * u * t**2, t**3
+    x = b0 * p0x[segment] + b1 * p1x[segment] + b2 * p2x[segment] + b3 * end_x[segment]
+    y = b0 * p0y[segment] + b1 * p1y[segment] + b2 * p2y[segment] + b3 * end_y[segment]
+    ring = ring_id[segment]
+
+    # Drop explicit closing vertices equal to the first vertex of their ring
+    first = np.r_[True, ring[1:] != ring[:-1]]
+    last = np.r_[ring[1:] != ring[:-1], True]
+    ring_start = np.flatnonzero(first)[np.cumsum(first) - 1]
+    keep = ~(last & ~first & (x == x[ring_start]) & (y == y[ring_start]))
+    x, y, ring = x[keep], y[keep], ring[keep]
+
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(ring, minlength=ring_id[-1] + 1))])
+    non_empty = np.flatnonzero(np.diff(offsets) > 0)
+    return x, y, np.concatenate([[0], offsets[1:][non_empty]])
+
+
+def encode_path(x, y, offsets):
+    """Float segment array of a shape ROI path of the rings x, y, offsets, each ring as moveTo, lineTo's and close"""
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    ring = np.repeat(np.arange(len(counts)), counts)
+    segments = np.zeros(3 * len(x) + len(counts), dtype=np.float32)
+
+    position = 3 * np.arange(len(x)) + ring
+    segments[position] = np.where(np.arange(len(x)) == offsets[:-1][ring], SEG_MOVETO, SEG_LINETO)
+    segments[position + 1] = x
+    segments[position + 2] = y
+    segments[3 * offsets[1:] + np.arange(len(counts))] = SEG_CLOSE
+    return segments
+
+
+def ring_depths(x, y, offsets):
+    """Number of other rings containing the first vertex of every ring (even-odd rule), holes have an odd depth"""
+    offsets = np.asarray(offsets)
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    x1, y1, x2, y2 = _edges(x, y, offsets)
+    starts, counts = offsets[:-1], np.diff(offsets)
+    px, py = x[starts], y[starts]
+
+    # Pairs of the first vertex of a ring and another ring whose bounding box contains it
+    x_min, x_max = np.minimum.reduceat(x, starts), np.maximum.reduceat(x, starts)
+    y_min, y_max = np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts)
+    candidate = (px[:, np.newaxis] >= x_min) & (px[:, np.newaxis] <= x_max) & \
+        (py[:, np.newaxis] >= y_min) & (py[:, np.newaxis] <= y_max)
+    np.fill_diagonal(candidate, False)
+    point, ring = np.nonzero(candidate)
+
+    # Crossings of a ray from the vertex in the +x direction with the edges of the other ring. Pairs are sorted by ring
+    # and the rank of the vertex' y, so the pairs an edge crosses (y in [min(y1, y2), max(y1, y2))) are a range.
+    edge_ring = np.repeat(np.arange(len(starts)), counts)
+    levels, rank = np.unique(np.concatenate([py[point], np.minimum(y1, y2), np.maximum(y1, y2)]), return_inverse=True)
+    pair_rank, low, high = np.split(rank, [len(point), len(point) + len(x)])
+    pair_keys = ring * len(levels) + pair_rank
+    order = np.argsort(pair_keys, kind='stable')
+    lo = np.searchsorted(pair_keys[order], edge_ring * len(levels) + low, 'left')
+    hi = np.searchsorted(pair_keys[order], edge_ring * len(levels) + high, 'left')
+    pair, edge = segment_indices(lo, hi - lo)
+    pair = order[pair]
+
+    ex, ey = px[point][pair], py[point][pair]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cross_x = x1[edge] + (ey - y1[edge]) * (x2[edge] - x1[edge]) / (y2[edge] - y1[edge])
+    inside = np.bincount(pair, weights=cross_x > ex, minlength=len(point)) % 2
+    return np.bincount(point, weights=inside, minlength=len(starts)).astype(np.int64)
+
+
+def join_rings(x, y, offsets):
+    """
+    Single vertex stream of multiple rings, oriented clockwise (in image coordinates) for outer boundaries and
+    anticlockwise for holes. Every ring is closed by repeating its first vertex and the stream ends with the first
+    vertices of the rings in reverse order (except the first and last ring), so the edges joining the rings are
+    traversed once in both directions. Even-odd filling, the shoelace area and the centroid of the stream are then
+    those of the rings with holes.
+
+    Returns x, y and the offsets of the rings in the stream, ring i (including its repeated first vertex) is
+    x[offsets[i]:offsets[i + 1]], the joining vertices follow the last ring.
+    """
+    offsets = np.asarray(offsets)
+    x, y = np.asarray(x), np.asarray(y)
+    counts = np.diff(offsets)
+    ring = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(len(x)) - offsets[:-1][ring]
+
+    # Reverse the rings with the wrong orientation for their depth
+    clockwise = signed_areas(x, y, offsets) >= 0
+    reverse = clockwise != (ring_depths(x, y, offsets) % 2 == 0)
+    position = np.where(reverse[ring], (counts[ring] - position) % counts[ring], position)
+
+    ext_offsets = offsets + np.arange(len(offsets))
+    idx = np.empty(len(x) + len(counts), dtype=np.int64)
+    idx[ext_offsets[:-1][ring] + position] = np.arange(len(x))
+    idx[ext_offsets[1:] - 1] = offsets[:-1]
+    idx = np.concatenate([idx, offsets[1:-2][::-1]])
+    return x[idx], y[idx], ext_offsets
+
+
+def polygon_area(x, y):
+    return areas(x, y, [0, len(x)])[0]
+
+
+def polygon_perimeter(x, y, closed=True):
+    return perimeters(x, y, [0, len(x)], closed=closed)[0]
+
+
+def polygon_centroid(x, y, closed=True):
+    return tuple(centroids(x, y, [0, len(x)], closed=closed)[0])
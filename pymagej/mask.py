@@ -0,0 +1,301 @@
+"""
+PymageJ Copyright (C) 2015 Jochem Smit
+
+This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public License
+ as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+ of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program; if not, write to the
+Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import numpy as np
+import os
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Like ImageJ, a pixel is inside a ROI if its center is inside the shape. Vertices are at pixel corners, so the center
+# of pixel (row, col) is at (row + 0.5, col + 0.5).
+
+
+def fill_polygon(x, y, shape):
+    """
+    Boolean mask of the polygon with vertices x, y (even-odd rule) in an array of given shape. Uses a vectorized
+    scanline fill: the crossings of all edges with all pixel center rows are computed at once, sorted per row and
+    filled pairwise.
+    """
+    height, width = shape
+    x1, y1 = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+
+    # Edge crosses row if the row's pixel centers lie in [min(y1, y2), max(y1, y2))
+    row_start = np.clip(np.ceil(np.minimum(y1, y2) - 0.5), 0, height).astype(np.int64)
+    row_end = np.clip(np.ceil(np.maximum(y1, y2) - 0.5), 0, height).astype(np.int64)
+    counts = np.maximum(row_end - row_start, 0)
+
+    edges = np.repeat(np.arange(len(x1)), counts)
+    rows = row_start[edges] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (x2 - x1) / (y2 - y1)
+    crossings = x1[edges] + (rows + 0.5 - y1[edges]) * slope[edges]
+
+    order = np.lexsort((crossings, rows))
+    rows, crossings = rows[order], crossings[order]
+    # Pixel centers in [start crossing, end crossing) are inside
+    starts = np.clip(np.ceil(crossings[0::2] - 0.5), 0, width).astype(np.int64)
+    ends = np.clip(np.ceil(crossings[1::2] - 0.5), 0, width).astype(np.int64)
+
+    return _fill_spans(rows[0::2], starts, ends, shape)
+
+
+def _window_centers(shape, window):
+    """Pixel center coordinates (y, x) of the window (top, left, height, width) of an array of given shape"""
+    top, left, height, width = window if window is not None else (0, 0) + tuple(shape)
+    return np.arange(top, top + height) + 0.5, np.arange(left, left + width) + 0.5
+
+
+def fill_oval(shape, window=None):
+    """
+    Boolean mask of the ellipse inscribed in an array of given shape. With window (top, left, height, width) only that
+    part of the array is returned, the window may extend outside the array.
+    """
+    height, width = shape
+    y, x = _window_centers(shape, window)
+    y = (y - height / 2.) / (height / 2.)
+    x = (x - width / 2.) / (width / 2.)
+    return y[:, np.newaxis]**2 + x[np.newaxis, :]**2 < 1
+
+
+def fill_rect(shape, arc=0, window=None):
+    """
+    Boolean mask of a rectangle filling an array of given shape, with corners rounded with diameter arc. With window
+    (top, left, height, width) only that part of the array is returned, the window may extend outside the array.
+    """
+    height, width = shape
+    y, x = _window_centers(shape, window)
+    inside = ((y > 0) & (y < height))[:, np.newaxis] & ((x > 0) & (x < width))[np.newaxis, :]
+    if arc <= 0:
+        return inside
+
+    rx, ry = min(arc, width) / 2., min(arc, height) / 2.
+    dx = np.maximum(np.maximum(rx - x, x - (width - rx)), 0) / rx  # Distance into the corner regions
+    dy = np.maximum(np.maximum(ry - y, y - (height - ry)), 0) / ry
+    return inside & (dy[:, np.newaxis]**2 + dx[np.newaxis, :]**2 <= 1)
+
+
+def _fill_spans(rows, starts, ends, shape):
+    """Mask with pixels [starts, ends) set in each of rows, spans in one row should not overlap"""
+    height, width = shape
+    size = height * (width + 1)
+    diff = np.bincount(rows * (width + 1) + starts, minlength=size) - \
+        np.bincount(rows * (width + 1) + ends, minlength=size)
+    return np.cumsum(diff.reshape(height, width + 1), axis=1)[:, :width] > 0
+
+
+def clip_bbox(shape, top, left, mask):
+    """Slices of the image of given shape and of the mask where the mask at top, left overlaps the image"""
+    height, width = mask.shape
+    y0, x0 = max(top, 0), max(left, 0)
+    y1, x1 = min(top + height, shape[0]), min(left + width, shape[1])
+    if y1 <= y0 or x1 <= x0:
+        return None, None
+
+    image_slice = (slice(y0, y1), slice(x0, x1))
+    mask_slice = (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left))
+    return image_slice, mask_slice
+
+
+def bbox_to_mask(shape, top, left, mask):
+    """Place a bbox cropped mask into a full mask of given shape"""
+    out = np.zeros(shape, dtype=bool)
+    image_slice, mask_slice = clip_bbox(shape, top, left, mask)
+    if image_slice is not None:
+        out[image_slice] = mask[mask_slice]
+    return out
+
+
+def rasterize(rois, shape, dtype=np.int32):
+    """
+    Label image of given shape, pixels inside the i'th ROI in rois are labelled i + 1. Where ROIs overlap, later ROIs
+    overwrite earlier ones. Only the bounding box of each ROI is touched.
+    """
+    labels = np.zeros(shape, dtype=dtype)
+    for i, roi_obj in enumerate(rois):
+        top, left, mask = roi_obj.bbox_mask()
+        image_slice, mask_slice = clip_bbox(shape, top, left, mask)
+        if image_slice is not None:
+            labels[image_slice][mask[mask_slice]] = i + 1
+
+    return labels
+
+
+def _render_tile(roi_objs, labels, origin, shape, dtype):
+    """Label tile of given shape at origin (top, left), pixels inside roi_objs[j] are labelled labels[j]"""
+    tile = np.zeros(shape, dtype=dtype)
+    for label, roi_obj in zip(labels, roi_objs):
+        # Only the part of the tile within the ROI's bounding box is rendered
+        y0, x0 = max(roi_obj.top, origin[0]), max(roi_obj.left, origin[1])
+        y1, x1 = min(roi_obj.bottom, origin[0] + shape[0]), min(roi_obj.right, origin[1] + shape[1])
+        if y1 > y0 and x1 > x0:
+            window = tile[y0 - origin[0]:y1 - origin[0], x0 - origin[1]:x1 - origin[1]]
+            window[roi_obj.window_mask(y0, x0, (y1 - y0, x1 - x0))] = label
+    return origin, tile
+
+
+def rasterize_tiles(rois, shape, tile_size=1024, dtype=np.int32, out=None, workers=1, skip_empty=True):
+    """
+    Rasterize ROIs onto an image of given shape tile by tile, yielding (tile_origin, label_tile) with tile_origin the
+    (top, left) of the tile in the image. Labels are as in rasterize: pixels inside the i'th ROI are labelled i + 1 and
+    later ROIs overwrite earlier ones, so the tiles put together equal rasterize(rois, shape).
+
+    Tiles are tile_size (an int or (height, width)) pixels, smaller at the bottom and right edges of the image, and are
+    yielded in row-major order. Each ROI is only drawn on the tiles its bounding box intersects and only within the
+    tile, so memory use depends on the tile size and not on the image size. With skip_empty tiles without ROIs are
+    skipped.
+
+    If out is given (e.g. an np.memmap or any array supporting slice assignment) each tile is also written into it,
+    with skip_empty out should be zero initialized. With workers > 1 (None for the number of CPUs) tiles are rendered
+    in a process pool, with at most twice as many tiles in flight as there are workers.
+    """
+    rois = list(rois)
+    height, width = shape
+    tile_height, tile_width = (tile_size, tile_size) if np.isscalar(tile_size) else tile_size
+    n_rows, n_cols = -(-height // tile_height), -(-width // tile_width)
+
+    bboxes = []
+    for roi_obj in rois:
+        try:
+            bboxes.append((roi_obj.top, roi_obj.left, roi_obj.bottom, roi_obj.right))
+        except AttributeError:
+            raise NotImplementedError('Mask not implemented for %s ROIs' % roi_obj.type)
+    top, left, bottom, right = np.array(bboxes, dtype=np.int64).reshape(-1, 4).T
+
+    # All (ROI, tile) pairs of tiles intersecting the bounding boxes, sorted by tile and then ROI
+    row0, row1 = np.clip(top // tile_height, 0, n_rows), np.clip(-(-bottom // tile_height), 0, n_rows)
+    col0, col1 = np.clip(left // tile_width, 0, n_cols), np.clip(-(-right // tile_width), 0, n_cols)
+    tile_rows, tile_cols = np.maximum(row1 - row0, 0), np.maximum(col1 - col0, 0)
+    counts = tile_rows * tile_cols
+    roi_idx = np.repeat(np.arange(len(rois)), counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = row0[roi_idx] + within // np.maximum(tile_cols[roi_idx], 1)
+    cols = col0[roi_idx] + within % np.maximum(tile_cols[roi_idx], 1)
+    keys = rows * n_cols + cols
+    order = np.argsort(keys, kind='stable')
+    keys, roi_idx = keys[order], roi_idx[order]
+
+    if skip_empty:
+        tiles, starts = np.unique(keys, return_index=True)
+    else:
+        tiles = np.arange(n_rows * n_cols)
+        starts = np.searchsorted(keys, tiles, 'left')
+    ends = np.searchsorted(keys, tiles, 'right')
+
+    def tasks():
+        for key, start, end in zip(tiles, starts, ends):
+            r, c = divmod(int(key), n_cols)
+            origin = (r * tile_height, c * tile_width)
+            tile_shape = (min(tile_height, height - origin[0]), min(tile_width, width - origin[1]))
+            idx = roi_idx[start:end]
+            yield [rois[i] for i in idx], idx + 1, origin, tile_shape, dtype
+
+    def write(result):
+        origin, tile = result
+        if out is not None:
+            out[origin[0]:origin[0] + tile.shape[0], origin[1]:origin[1] + tile.shape[1]] = tile
+        return result
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for task in tasks():
+            yield write(_render_tile(*task))
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for task in tasks():
+            pending.append(executor.submit(_render_tile, *task))
+            if len(pending) >= 2 * workers:
+                yield write(pending.popleft().result())
+        while pending:
+            yield write(pending.popleft().result())
+
+
+def geometry_key(roi_obj):
+    """Hashable key identifying the geometry of an ROI: type, bounding box, arc and a digest of the coordinates"""
+    digest = hashlib.blake2b(digest_size=16)
+    for attr in ['x_coords', 'y_coords']:
+        if hasattr(roi_obj, attr):
+            digest.update(np.asarray(getattr(roi_obj, attr), dtype=np.float64).tobytes())
+
+    bbox = tuple(int(getattr(roi_obj, attr, 0)) for attr in ['top', 'left', 'bottom', 'right'])
+    return (roi_obj.type,) + bbox + (getattr(roi_obj, 'arc', 0), digest.hexdigest())
+
+
+class MaskCache(object):
+    """
+    Least recently used cache of ROI masks, keyed by the ROI geometry (see geometry_key) and the image shape.
+
+    Masks are stored cropped to the part of the ROI's bounding box inside the image, the cache evicts the least
+    recently used masks when their total size exceeds max_bytes. ROIs outside the image are not cached.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+
+    def __len__(self):
+        return len(self._masks)
+
+    def get(self, roi_obj, shape):
+        """
+        Image slices and (read-only) mask of roi_obj clipped to an image of given shape, or None, None if the ROI is
+        outside the image
+        """
+        key = geometry_key(roi_obj) + tuple(shape)
+        try:
+            item = self._masks[key]
+            self._masks.move_to_end(key)
+            self.hits += 1
+            return item
+        except KeyError:
+            self.misses += 1
+
+        top, left, mask = roi_obj.bbox_mask()
+        image_slice, mask_slice = clip_bbox(shape, top, left, mask)
+        if image_slice is None:
+            return None, None
+
+        mask = np.ascontiguousarray(mask[mask_slice])
+        mask.flags.writeable = False
+        self.nbytes += mask.nbytes
+        self._masks[key] = image_slice, mask
+        self._evict()
+        return image_slice, mask
+
+    def to_mask(self, roi_obj, shape):
+        """Boolean mask of roi_obj in an image of given shape"""
+        out = np.zeros(shape, dtype=bool)
+        image_slice, mask = self.get(roi_obj, shape)
+        if image_slice is not None:
+            out[image_slice] = mask
+        return out
+
+    def clear(self):
+        self._masks.clear()
+        self.nbytes = 0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self), 'nbytes': self.nbytes}
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._masks:
+            image_slice, mask = self._masks.popitem(last=False)[1]
+            self.nbytes -= mask.nbytes
@@ -0,0 +1,194 @@
+"""
+PymageJ Copyright (C) 2015 Jochem Smit
+
+This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public License
+ as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+ of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program; if not, write to the
+Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import numpy as np
+
+from pymagej.mask import clip_bbox
+
+
+def _std(values):
+    """Sample standard deviation per frame like ImageJ, which reports 0 for a single pixel"""
+    if values.shape[1] < 2:
+        return np.zeros(values.shape[0])
+    return values.std(axis=1, ddof=1)
+
+
+# Functions calculating a statistic per frame from an (n_frames, n_pixels) array of pixel values
+STATS = {
+    'area': lambda values: np.full(values.shape[0], values.shape[1]),
+    'mean': lambda values: values.mean(axis=1),
+    'sum': lambda values: values.sum(axis=1, dtype=np.float64),
+    'min': lambda values: values.min(axis=1),
+    'max': lambda values: values.max(axis=1),
+    'std': _std,
+    'median': lambda values: np.median(values, axis=1),
+}
+
+
+def roi_position(roi_obj, dim='t'):
+    """
+    1-based stack position of the ROI along dim ('c', 'z' or 't'), falling back to the stack POSITION if it has no
+    hyperstack position. Returns 0 if the ROI is not associated with a position.
+    """
+    header = getattr(roi_obj, 'header', None) or {}
+    return header.get(dim.upper() + '_POSITION', 0) or header.get('POSITION', 0)
+
+
+def measure(rois, image_or_stack, stats=('mean', 'sum', 'min', 'max', 'std'), dim='t', use_positions=True,
+            cache=None):
+    """
+    Measure pixel statistics of ROIs in an image (y, x) or stack (frames, y, x), like ImageJ's Measure.
+
+    Each ROI's mask is computed once on its bounding box and used for all frames of the stack. If use_positions is
+    True, ROIs which have a position along dim (see roi_position) are only measured in that frame of the stack. Pass a
+    MaskCache as cache to reuse masks between calls on images of the same shape.
+
+    Returns a dict with per stat an array of shape (n_rois,) for images or (n_rois, n_frames) for stacks. ROIs outside
+    the image or frames which are not measured are NaN.
+    """
+    stack = np.asarray(image_or_stack)
+    is_image = stack.ndim == 2
+    if is_image:
+        stack = stack[np.newaxis, ...]
+    if stack.ndim != 3:
+        raise ValueError('Expected an image (y, x) or a stack (frames, y, x), got %i dimensions' % stack.ndim)
+
+    unknown = set(stats) - set(STATS)
+    if unknown:
+        raise ValueError('Unknown statistics: %s' % ', '.join(sorted(unknown)))
+
+    rois = list(rois)
+    n_frames = stack.shape[0]
+    results = {stat: np.full((len(rois), n_frames), np.nan) for stat in stats}
+
+    for i, roi_obj in enumerate(rois):
+        if cache is not None:
+            image_slice, mask = cache.get(roi_obj, stack.shape[1:])
+        else:
+            top, left, mask = roi_obj.bbox_mask()
+            image_slice, mask_slice = clip_bbox(stack.shape[1:], top, left, mask)
+            mask = mask[mask_slice] if image_slice is not None else None
+        if image_slice is None or not mask.any():
+            continue
+
+        frames = slice(None)
+        position = roi_position(roi_obj, dim) if use_positions and not is_image else 0
+        if 0 < position <= n_frames:
+            frames = slice(position - 1, position)
+        elif position > n_frames:
+            continue
+
+        values = stack[(frames,) + image_slice][:, mask]
+        for stat in stats:
+            results[stat][i, frames] = STATS[stat](values)
+
+    if is_image:
+        results = {stat: values[:, 0] for stat, values in results.items()}
+
+    return results
+
+
+def _line_vertices(roi_obj):
+    """Absolute coordinates of the vertices of a line ROI"""
+    if roi_obj.type == 'line':
+        return np.array([roi_obj.x1, roi_obj.x2], dtype=np.float64), \
+            np.array([roi_obj.y1, roi_obj.y2], dtype=np.float64)
+    elif roi_obj.type in ['polyline', 'freeline']:
+        return roi_obj.left + np.asarray(roi_obj.x_coords, dtype=np.float64), \
+            roi_obj.top + np.asarray(roi_obj.y_coords, dtype=np.float64)
+    raise NotImplementedError('Profile not implemented for roi type %s' % roi_obj.type)
+
+
+def _line_samples(x, y, width):
+    """
+    Sample points (n, width) spaced one pixel apart along the line through vertices x, y, with width points spaced one
+    pixel apart perpendicular to the line at each position along it
+    """
+    dx, dy = np.diff(x), np.diff(y)
+    lengths = np.hypot(dx, dy)
+    cumulative = np.concatenate([[0], np.cumsum(lengths)])
+    n = int(round(cumulative[-1]))
+    distance = np.linspace(0, cumulative[-1], n + 1)
+
+    segment = np.clip(np.searchsorted(cumulative, distance, 'right') - 1, 0, len(lengths) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(lengths[segment] > 0, (distance - cumulative[segment]) / lengths[segment], 0)
+        normal_x = np.where(lengths > 0, -dy / lengths, 0)[segment]
+        normal_y = np.where(lengths > 0, dx / lengths, 0)[segment]
+
+    offsets = np.arange(width) - (width - 1) / 2.
+    sample_x = x[segment] + t * dx[segment]
+    sample_y = y[segment] + t * dy[segment]
+    return sample_x[:, np.newaxis] + offsets * normal_x[:, np.newaxis], \
+        sample_y[:, np.newaxis] + offsets * normal_y[:, np.newaxis]
+
+
+def _interpolate(stack, x, y, order):
+    """Values (frames, n) of the stack at the points x, y, NaN outside of the image"""
+    height, width = stack.shape[1:]
+    flat = stack.reshape(len(stack), -1)
+
+    def pixels(row, col):  # Taking from the flattened frames is much faster than indexing rows and columns
+        return np.take(flat, np.clip(row, 0, height - 1) * width + np.clip(col, 0, width - 1), axis=1)
+
+    if order == 0:
+        values = pixels(np.floor(y).astype(np.int64), np.floor(x).astype(np.int64)).astype(np.float64)
+    elif order == 1:
+        # Pixel centers are at +0.5, outside the outer pixel centers the edge values are extended
+        fx, fy = x - 0.5, y - 0.5
+        x0, y0 = np.floor(fx), np.floor(fy)
+        wx, wy = fx - x0, fy - y0
+        x0, y0 = x0.astype(np.int64), y0.astype(np.int64)
+        values = (pixels(y0, x0) * (1 - wx) + pixels(y0, x0 + 1) * wx) * (1 - wy) + \
+            (pixels(y0 + 1, x0) * (1 - wx) + pixels(y0 + 1, x0 + 1) * wx) * wy
+    else:
+        raise ValueError('Interpolation order should be 0 (nearest) or 1 (bilinear), got %s' % order)
+
+    outside = (x < 0) | (x > width) | (y < 0) | (y > height)
+    values[:, outside] = np.nan
+    return values
+
+
+def profile(rois, image_or_stack, width=1, order=1):
+    """
+    Intensity profile along line, polyline or freeline ROIs, like ImageJ's Plot Profile.
+
+    The image (y, x) or stack (frames, y, x) is sampled at equally spaced points one pixel apart along the line,
+    including both ends, with bilinear (order=1) or nearest neighbour (order=0) interpolation. For width > 1, width
+    points spaced one pixel apart perpendicular to the line are averaged at each position. Samples outside the image
+    are NaN.
+
+    rois is a single ROI or a list of ROIs, all samples of all ROIs and frames are interpolated at once. Returns an
+    array of shape (n_samples,) for images or (n_frames, n_samples) for stacks, or a list of these for a list of ROIs.
+    """
+    stack = np.asarray(image_or_stack)
+    is_image = stack.ndim == 2
+    if is_image:
+        stack = stack[np.newaxis, ...]
+    if stack.ndim != 3:
+        raise ValueError('Expected an image (y, x) or a stack (frames, y, x), got %i dimensions' % stack.ndim)
+
+    single = hasattr(rois, 'type')
+    rois = [rois] if single else list(rois)
+    samples = [_line_samples(*(_line_vertices(roi_obj) + (width,))) for roi_obj in rois]
+    if not samples:
+        return []
+    x = np.concatenate([sample_x.ravel() for sample_x, sample_y in samples])
+    y = np.concatenate([sample_y.ravel() for sample_x, sample_y in samples])
+
+    values = _interpolate(stack, x, y, order).reshape(len(stack), -1, width).mean(axis=2)
+    profiles = np.split(values, np.cumsum([len(sample_x) for sample_x, sample_y in samples])[:-1], axis=1)
+    if is_image:
+        profiles = [p[0] for p in profiles]
+
+    return profiles[0] if single else profiles
@@ -0,0 +1,128 @@
+"""
+PymageJ Copyright (C) 2015 Jochem Smit
+
+This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public License
+ as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+ of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program; if not, write to the
+Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import numpy as np
+
+from pymagej.collection import ROICollection
+from pymagej.spatial import ROIIndex
+
+
+def _bbox_masks(roi_objs):
+    """Top, left and bbox cropped mask of each ROI, None for ROIs without a mask (lines)"""
+    masks = []
+    for roi_obj in roi_objs:
+        try:
+            masks.append(roi_obj.bbox_mask())
+        except NotImplementedError:
+            masks.append(None)
+    return masks
+
+
+def iou_pairs(rois_a, rois_b):
+    """
+    Pixel-wise intersection over union of all pairs of ROIs in rois_a and rois_b which overlap, computed on the masks
+    cropped to the bounding boxes. Only pairs with overlapping bounding boxes (found with an ROIIndex) are compared.
+
+    Returns arrays of the indices in rois_a and rois_b, the intersection (in pixels) and the IoU of the overlapping
+    pairs.
+    """
+    rois_a, rois_b = list(rois_a), list(rois_b)
+    collection_a = ROICollection.from_rois(rois_a)
+    idx_a, idx_b = ROIIndex(rois_b).query_bboxes(collection_a.top, collection_a.left, collection_a.bottom,
+                                                 collection_a.right)
+
+    masks_a, masks_b = _bbox_masks(rois_a), _bbox_masks(rois_b)
+    intersection = np.zeros(len(idx_a), dtype=np.int64)
+    for i, (a, b) in enumerate(zip(idx_a, idx_b)):
+        if masks_a[a] is None or masks_b[b] is None:
+            continue
+        (top_a, left_a, mask_a), (top_b, left_b, mask_b) = masks_a[a], masks_b[b]
+        top, left = max(top_a, top_b), max(left_a, left_b)
+        bottom = min(top_a + mask_a.shape[0], top_b + mask_b.shape[0])
+        right = min(left_a + mask_a.shape[1], left_b + mask_b.shape[1])
+        if bottom > top and right > left:
+            intersection[i] = np.count_nonzero(mask_a[top - top_a:bottom - top_a, left - left_a:right - left_a] &
+                                               mask_b[top - top_b:bottom - top_b, left - left_b:right - left_b])
+
+    area_a = np.array([m[2].sum() if m is not None else 0 for m in masks_a], dtype=np.int64)
+    area_b = np.array([m[2].sum() if m is not None else 0 for m in masks_b], dtype=np.int64)
+    overlapping = intersection > 0
+    idx_a, idx_b, intersection = idx_a[overlapping], idx_b[overlapping], intersection[overlapping]
+    iou = intersection / (area_a[idx_a] + area_b[idx_b] - intersection).astype(np.float64)
+
+    return idx_a, idx_b, intersection, iou
+
+
+def iou_matrix(rois_a, rois_b):
+    """
+    Sparse (scipy.sparse.csr_matrix) matrix of the IoU of all pairs of ROIs in rois_a and rois_b, see iou_pairs.
+    Requires scipy (pip install pymagej[scipy]), use iou_pairs otherwise.
+    """
+    from scipy.sparse import csr_matrix
+
+    rois_a, rois_b = list(rois_a), list(rois_b)
+    idx_a, idx_b, intersection, iou = iou_pairs(rois_a, rois_b)
+    return csr_matrix((iou, (idx_a, idx_b)), shape=(len(rois_a), len(rois_b)))
+
+
+def match_rois(rois_a, rois_b, threshold=0.5, method='greedy'):
+    """
+    One-to-one matching of ROIs in rois_a to ROIs in rois_b with an IoU of at least threshold.
+
+    With method 'greedy' the pairs are matched in order of decreasing IoU, 'hungarian' maximizes the total IoU of the
+    matches and requires scipy (pip install pymagej[scipy]). Returns arrays of the indices in rois_a and rois_b and the
+    IoU of the matched pairs.
+    """
+    idx_a, idx_b, intersection, iou = iou_pairs(rois_a, rois_b)
+    above = iou >= threshold
+    idx_a, idx_b, iou = idx_a[above], idx_b[above], iou[above]
+
+    if method == 'greedy':
+        matched = np.zeros(len(iou), dtype=bool)
+        used_a, used_b = set(), set()
+        for i in np.argsort(-iou, kind='stable'):
+            if idx_a[i] not in used_a and idx_b[i] not in used_b:
+                used_a.add(idx_a[i])
+                used_b.add(idx_b[i])
+                matched[i] = True
+    elif method == 'hungarian':
+        from scipy.optimize import linear_sum_assignment
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        # The assignment is solved separately for every connected group of overlapping ROIs, which are small
+        rows, row_idx = np.unique(idx_a, return_inverse=True)
+        cols, col_idx = np.unique(idx_b, return_inverse=True)
+        n = len(rows) + len(cols)
+        graph = coo_matrix((np.ones(len(iou)), (row_idx, len(rows) + col_idx)), shape=(n, n))
+        labels = connected_components(graph, directed=False)[1]
+
+        matched = np.zeros(len(iou), dtype=bool)
+        pair_group = labels[row_idx]
+        order = np.argsort(pair_group, kind='stable')
+        bounds = np.flatnonzero(np.diff(np.r_[-1, pair_group[order], -2]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            pairs = order[start:end]
+            group_rows, r = np.unique(row_idx[pairs], return_inverse=True)
+            group_cols, c = np.unique(col_idx[pairs], return_inverse=True)
+            cost = np.zeros((len(group_rows), len(group_cols)))
+            cost[r, c] = iou[pairs]
+            row_match, col_match = linear_sum_assignment(cost, maximize=True)
+            selected = np.zeros(cost.shape, dtype=bool)
+            selected[row_match, col_match] = True
+            matched[pairs] = selected[r, c]
+    else:
+        raise ValueError("Unknown matching method %s, should be 'greedy' or 'hungarian'" % method)
+
+    order = np.argsort(idx_a[matched], kind='stable')
+    return idx_a[matched][order], idx_b[matched][order], iou[matched][order]
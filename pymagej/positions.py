@@ -0,0 +1,107 @@
+"""
+PymageJ Copyright (C) 2015 Jochem Smit
+
+This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public License
+ as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+ of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program; if not, write to the
+Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import numpy as np
+
+from pymagej.roi import scan_headers
+from pymagej.collection import ROICollection
+
+
+class PositionIndex(object):
+    """
+    Index of the stack positions of many ROIs, for fast lookup of the ROIs in a frame or range of frames.
+
+    Positions are 1-based, per dimension ('c', 'z' or 't') an ROI's position is its hyperstack position, falling back
+    to its stack POSITION (as in measure.roi_position). Position 0 means the ROI is not associated with a position, in
+    ImageJ it is shown on all frames. ROIs are sorted by position per dimension, so queries take O(log n) plus the
+    number of ROIs returned. All queries return sorted ROI indices.
+    """
+
+    dims = ('c', 'z', 't')
+
+    def __init__(self, c_position, z_position, t_position, position=None):
+        position = np.zeros(len(c_position), dtype=np.int64) if position is None else \
+            np.asarray(position, dtype=np.int64)
+        self.positions = {}
+        self._order = {}
+        self._sorted = {}
+        for dim, values in zip(self.dims, [c_position, z_position, t_position]):
+            values = np.asarray(values, dtype=np.int64)
+            self.positions[dim] = np.where(values > 0, values, position)
+            self._order[dim] = np.argsort(self.positions[dim], kind='stable')
+            self._sorted[dim] = self.positions[dim][self._order[dim]]
+
+        # Combined (c, z, t) key for lookups of a single hyperstack position
+        self._shape = tuple(int(self.positions[dim].max(initial=0)) + 1 for dim in self.dims)
+        keys = np.ravel_multi_index([self.positions[dim] for dim in self.dims], self._shape)
+        self._key_order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[self._key_order]
+
+    @classmethod
+    def from_rois(cls, rois):
+        """Index of a list of ROI objects or an ROICollection"""
+        rois = ROICollection.from_rois(rois)
+        return cls(rois.c_position, rois.z_position, rois.t_position, rois.position)
+
+    @classmethod
+    def from_headers(cls, headers):
+        """Index of the header array returned by scan_headers"""
+        fields = ['C_POSITION', 'Z_POSITION', 'T_POSITION', 'POSITION']
+        return cls(*[headers[field].astype(np.int64) for field in fields])
+
+    def __len__(self):
+        return len(self.positions['t'])
+
+    def frames(self, start, stop, dim='t', include_all=False):
+        """
+        Indices of the ROIs with a position start <= position < stop along dim. With include_all, ROIs without a
+        position are included.
+        """
+        values, order = self._sorted[dim], self._order[dim]
+        indices = order[np.searchsorted(values, start, 'left'):np.searchsorted(values, stop, 'left')]
+        if include_all and start > 0:
+            indices = np.concatenate([indices, order[:np.searchsorted(values, 1, 'left')]])
+        return np.sort(indices)
+
+    def frame(self, position, dim='t', include_all=False):
+        """Indices of the ROIs at position along dim"""
+        return self.frames(position, position + 1, dim=dim, include_all=include_all)
+
+    def __getitem__(self, key):
+        """Indices of the ROIs at the position (c, z, t), 0 matches any position along that dimension"""
+        key = tuple(int(k) for k in key)
+        if all(k > 0 for k in key):
+            if any(k >= size for k, size in zip(key, self._shape)):
+                return np.empty(0, dtype=np.int64)
+            flat = np.ravel_multi_index(key, self._shape)
+            lo, hi = np.searchsorted(self._sorted_keys, [flat, flat + 1], 'left')
+            return np.sort(self._key_order[lo:hi])
+
+        indices = np.arange(len(self))
+        for dim, k in zip(self.dims, key):
+            if k > 0:
+                indices = np.intersect1d(indices, self.frame(k, dim=dim), assume_unique=True)
+        return indices
+
+    def unique(self, dim='t'):
+        """Sorted positions along dim which have ROIs, ROIs without a position are not included"""
+        values = np.unique(self._sorted[dim])
+        return values[values > 0]
+
+
+def position_index(paths_or_zip):
+    """
+    PositionIndex of a RoiSet .zip archive, a directory of .roi files or an iterable of .roi file paths, built from the
+    headers only (see scan_headers). ROI indices follow the order of scan_headers and decode_many.
+    """
+    return PositionIndex.from_headers(scan_headers(paths_or_zip))
@@ -13,17 +13,26 @@ Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 0211
 
 import numpy as np
 import struct
-import re
-from collections import namedtuple
 import os
+import zipfile
+import tempfile
+from collections.abc import Mapping
+import mmap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from pymagej.mask import fill_polygon, fill_oval, fill_rect, bbox_to_mask
+from pymagej.geometry import polygon_area, polygon_perimeter, polygon_centroid, simplify_mask, segment_indices, \
+    decode_path, encode_path, join_rings
 
 
 # http://rsb.info.nih.gov/ij/developer/source/ij/io/RoiDecoder.java.html
 # http://rsb.info.nih.gov/ij/developer/source/ij/io/RoiEncoder.java.html
 
 
-#  Base class for all ROI classes
+#  Base class for all ROI classes. ROI classes use __slots__ to keep millions of ROIs in memory compact.
 class ROIObject(object):
+    __slots__ = ('name', 'header')
 
     def __init__(self, name=None):
         self.name = name
@@ -31,9 +40,24 @@ class ROIObject(object):
     def area(self):
         raise NotImplementedError('Area not implemented')
 
+    def bbox_mask(self):
+        """Boolean mask of the ROI cropped to its bounding box, returns top, left and the mask"""
+        raise NotImplementedError('Mask not implemented')
+
+    def to_mask(self, shape):
+        """Boolean mask of the ROI in an image of given shape"""
+        top, left, mask = self.bbox_mask()
+        return bbox_to_mask(shape, top, left, mask)
+
+    def window_mask(self, top, left, shape):
+        """Boolean mask of the ROI in the window of given shape at top, left of the image"""
+        roi_top, roi_left, mask = self.bbox_mask()
+        return bbox_to_mask(shape, roi_top - top, roi_left - left, mask)
+
 
 class ROIPolygon(ROIObject):
     type = 'polygon'
+    __slots__ = ('top', 'left', 'bottom', 'right', 'x_coords', 'y_coords')
 
     def __init__(self, top, left, bottom, right, x_coords, y_coords, *args, **kwargs):
         super(ROIPolygon, self).__init__(*args, **kwargs)
@@ -52,12 +76,33 @@ class ROIPolygon(ROIObject):
     def height(self):
         return self.y_coords.max() - self.y_coords.min() + 1
 
+    @property
+    def area(self):
+        return polygon_area(self.x_coords, self.y_coords)
+
+    @property
+    def perimeter(self):
+        return polygon_perimeter(self.x_coords, self.y_coords)
+
+    @property
+    def centroid(self):
+        x, y = polygon_centroid(self.x_coords, self.y_coords)
+        return self.left + x, self.top + y
+
     def __len__(self):
         return len(self.x_coords)
 
+    def bbox_mask(self):
+        shape = (self.bottom - self.top, self.right - self.left)
+        return self.top, self.left, fill_polygon(self.x_coords, self.y_coords, shape)
+
+    def window_mask(self, top, left, shape):
+        return fill_polygon(self.x_coords + (self.left - left), self.y_coords + (self.top - top), shape)
+
 
 class ROIRect(ROIObject):
     type = 'rect'
+    __slots__ = ('top', 'left', 'bottom', 'right', 'arc')
 
     def __init__(self, top, left, bottom, right, arc=0, *args, **kwargs):
         super(ROIRect, self).__init__(*args, **kwargs)
@@ -82,9 +127,25 @@ class ROIRect(ROIObject):
         else:
             return self.width * self.height - ((4 - np.pi)*(self.arc/2.)**2)
 
+    @property
+    def perimeter(self):
+        return 2 * (self.width + self.height) - (4 - np.pi) * self.arc
+
+    @property
+    def centroid(self):
+        return self.left + self.width / 2., self.top + self.height / 2.
+
+    def bbox_mask(self):
+        return self.top, self.left, fill_rect((self.height, self.width), self.arc)
+
+    def window_mask(self, top, left, shape):
+        window = (top - self.top, left - self.left) + tuple(shape)
+        return fill_rect((self.height, self.width), self.arc, window=window)
+
 
 class ROIOval(ROIObject):
     type = 'oval'
+    __slots__ = ('top', 'left', 'bottom', 'right')
 
     def __init__(self, top, left, bottom, right, *args, **kwargs):
         super(ROIOval, self).__init__(*args, **kwargs)
@@ -105,9 +166,25 @@ class ROIOval(ROIObject):
     def area(self):
         return self.width * self.height * np.pi / 4
 
+    @property
+    def perimeter(self):
+        a, b = self.width / 2., self.height / 2.
+        return np.pi * (3 * (a + b) - np.sqrt((3 * a + b) * (a + 3 * b)))  # Ramanujan's approximation
+
+    @property
+    def centroid(self):
+        return self.left + self.width / 2., self.top + self.height / 2.
+
+    def bbox_mask(self):
+        return self.top, self.left, fill_oval((self.height, self.width))
+
+    def window_mask(self, top, left, shape):
+        return fill_oval((self.height, self.width), window=(top - self.top, left - self.left) + tuple(shape))
+
 
 class ROILine(ROIObject):
     type = 'line'
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
 
     def __init__(self, x1, y1, x2, y2, *args, **kwargs):
         super(ROILine, self).__init__(*args, **kwargs)
@@ -120,9 +197,18 @@ class ROILine(ROIObject):
     def area(self):
         return 0
 
+    @property
+    def perimeter(self):
+        return np.hypot(self.x2 - self.x1, self.y2 - self.y1)
+
+    @property
+    def centroid(self):
+        return (self.x1 + self.x2) / 2., (self.y1 + self.y2) / 2.
+
 
 class ROIFreeLine(ROIObject):
     type = 'freeline'
+    __slots__ = ('top', 'left', 'bottom', 'right', 'x_coords', 'y_coords')
 
     def __init__(self, top, left, bottom, right, x_coords, y_coords, *args, **kwargs):
         super(ROIFreeLine, self).__init__(*args, **kwargs)
@@ -131,8 +217,8 @@ class ROIFreeLine(ROIObject):
         self.left = left
         self.bottom = bottom
         self.right = right
-        self.x_coords = np.array(x_coords)
-        self.y_coords = np.array(y_coords)
+        self.x_coords = np.asarray(x_coords)
+        self.y_coords = np.asarray(y_coords)
 
     @property
     def width(self):
@@ -144,7 +230,16 @@ class ROIFreeLine(ROIObject):
 
     @property
     def area(self):
-        raise NotImplementedError("Freeline area not implemented")
+        return 0
+
+    @property
+    def perimeter(self):
+        return polygon_perimeter(self.x_coords, self.y_coords, closed=False)
+
+    @property
+    def centroid(self):
+        x, y = polygon_centroid(self.x_coords, self.y_coords, closed=False)
+        return self.left + x, self.top + y
 
     def __len__(self):
         return len(self.x_coords)
@@ -152,6 +247,7 @@ class ROIFreeLine(ROIObject):
 
 class ROIPolyline(ROIObject):
     type = 'polyline'
+    __slots__ = ('top', 'left', 'bottom', 'right', 'x_coords', 'y_coords')
 
     def __init__(self, top, left, bottom, right, x_coords, y_coords, *args, **kwargs):
         super(ROIPolyline, self).__init__(*args, **kwargs)
@@ -160,8 +256,8 @@ class ROIPolyline(ROIObject):
         self.left = left
         self.bottom = bottom
         self.right = right
-        self.x_coords = np.array(x_coords)
-        self.y_coords = np.array(y_coords)
+        self.x_coords = np.asarray(x_coords)
+        self.y_coords = np.asarray(y_coords)
 
     @property
     def width(self):
@@ -173,7 +269,16 @@ class ROIPolyline(ROIObject):
 
     @property
     def area(self):
-        raise NotImplementedError("Freeline area not implemented")
+        return 0
+
+    @property
+    def perimeter(self):
+        return polygon_perimeter(self.x_coords, self.y_coords, closed=False)
+
+    @property
+    def centroid(self):
+        x, y = polygon_centroid(self.x_coords, self.y_coords, closed=False)
+        return self.left + x, self.top + y
 
     def __len__(self):
         return len(self.x_coords)
@@ -181,6 +286,7 @@ class ROIPolyline(ROIObject):
 
 class ROINoRoi(ROIObject):
     type = 'no_roi'
+    __slots__ = ()
 
     @property
     def area(self):
@@ -189,6 +295,7 @@ class ROINoRoi(ROIObject):
 
 class ROIFreehand(ROIObject):
     type = 'freehand'
+    __slots__ = ('top', 'left', 'bottom', 'right', 'x_coords', 'y_coords')
 
     def __init__(self, top, left, bottom, right, x_coords, y_coords, *args, **kwargs):
         super(ROIFreehand, self).__init__(*args, **kwargs)
@@ -212,11 +319,28 @@ class ROIFreehand(ROIObject):
 
     @property
     def area(self):
-        raise NotImplementedError('Area of freehand ROI is not implemented')
+        return polygon_area(self.x_coords, self.y_coords)
+
+    @property
+    def perimeter(self):
+        return polygon_perimeter(self.x_coords, self.y_coords)
+
+    @property
+    def centroid(self):
+        x, y = polygon_centroid(self.x_coords, self.y_coords)
+        return self.left + x, self.top + y
+
+    def bbox_mask(self):
+        shape = (self.bottom - self.top, self.right - self.left)
+        return self.top, self.left, fill_polygon(self.x_coords, self.y_coords, shape)
+
+    def window_mask(self, top, left, shape):
+        return fill_polygon(self.x_coords + (self.left - left), self.y_coords + (self.top - top), shape)
 
 
 class ROITraced(ROIObject):
     type = 'traced'
+    __slots__ = ('top', 'left', 'bottom', 'right', 'x_coords', 'y_coords')
 
     def __init__(self, top, left, bottom, right, x_coords, y_coords, *args, **kwargs):
         super(ROITraced, self).__init__(*args, **kwargs)
@@ -227,6 +351,9 @@ class ROITraced(ROIObject):
         self.x_coords = x_coords
         self.y_coords = y_coords
 
+    def __len__(self):
+        return len(self.x_coords)
+
     @property
     def width(self):
         return self.x_coords.max() - self.x_coords.min() + 1
@@ -237,24 +364,117 @@ class ROITraced(ROIObject):
 
     @property
     def area(self):
-        raise NotImplementedError('Area of traced ROI is not implemented')
+        return polygon_area(self.x_coords, self.y_coords)
+
+    @property
+    def perimeter(self):
+        return polygon_perimeter(self.x_coords, self.y_coords)
+
+    @property
+    def centroid(self):
+        x, y = polygon_centroid(self.x_coords, self.y_coords)
+        return self.left + x, self.top + y
+
+    def bbox_mask(self):
+        shape = (self.bottom - self.top, self.right - self.left)
+        return self.top, self.left, fill_polygon(self.x_coords, self.y_coords, shape)
+
+    def window_mask(self, top, left, shape):
+        return fill_polygon(self.x_coords + (self.left - left), self.y_coords + (self.top - top), shape)
+
+
+class ROIComposite(ROIObject):
+    """
+    Composite (shape) ROI of one or more rings, eg a region with holes or a union of regions. Pixels are inside by the
+    even-odd rule, so pixels inside a ring within another ring are outside.
+
+    The rings are stored as a single vertex stream in x_coords, y_coords (see geometry.join_rings): every ring is closed
+    by repeating its first vertex and holes run in the opposite direction, so masks, area, centroid and containment
+    are computed by the same code as for polygons. ring_offsets are the offsets of the rings in the stream, ring i is
+    x_coords[ring_offsets[i]:ring_offsets[i + 1]]. Use from_rings to create one and rings to get the separate rings.
+    """
+    type = 'composite'
+    __slots__ = ('top', 'left', 'bottom', 'right', 'x_coords', 'y_coords', 'ring_offsets')
+
+    def __init__(self, top, left, bottom, right, x_coords, y_coords, ring_offsets, *args, **kwargs):
+        super(ROIComposite, self).__init__(*args, **kwargs)
+        self.top = top
+        self.left = left
+        self.bottom = bottom
+        self.right = right
+        self.x_coords = x_coords
+        self.y_coords = y_coords
+        self.ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+
+    @classmethod
+    def from_rings(cls, x, y, offsets, top=None, left=None, bottom=None, right=None, **kwargs):
+        """
+        Composite ROI of the rings with absolute coordinates x, y, ring i has vertices x[offsets[i]:offsets[i + 1]].
+        The bounding box defaults to the bounding box of the vertices.
+        """
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        top = int(np.floor(y.min())) if top is None else top
+        left = int(np.floor(x.min())) if left is None else left
+        bottom = int(np.ceil(y.max())) if bottom is None else bottom
+        right = int(np.ceil(x.max())) if right is None else right
+        x_coords, y_coords, ring_offsets = join_rings(x - left, y - top, offsets)
+        return cls(top, left, bottom, right, x_coords.astype(np.float32), y_coords.astype(np.float32), ring_offsets,
+                   **kwargs)
+
+    def __len__(self):
+        return len(self.x_coords)
+
+    @property
+    def rings(self):
+        """List of x, y coordinates (relative to left, top) of every ring, without the repeated first vertex"""
+        return [(self.x_coords[start:end - 1], self.y_coords[start:end - 1])
+                for start, end in zip(self.ring_offsets[:-1], self.ring_offsets[1:])]
+
+    @property
+    def width(self):
+        return self.right - self.left
+
+    @property
+    def height(self):
+        return self.bottom - self.top
+
+    @property
+    def area(self):
+        return polygon_area(self.x_coords, self.y_coords)
+
+    @property
+    def perimeter(self):
+        return sum(polygon_perimeter(x, y) for x, y in self.rings)
+
+    @property
+    def centroid(self):
+        x, y = polygon_centroid(self.x_coords, self.y_coords)
+        return self.left + x, self.top + y
+
+    def bbox_mask(self):
+        shape = (self.bottom - self.top, self.right - self.left)
+        return self.top, self.left, fill_polygon(self.x_coords, self.y_coords, shape)
+
+    def window_mask(self, top, left, shape):
+        return fill_polygon(self.x_coords + (self.left - left), self.y_coords + (self.top - top), shape)
 
 
 class ROIAngle(ROIObject):
+    __slots__ = ()
+
     @property
     def area(self):
         return 0
 
 
 class ROIPoint(ROIObject):
+    __slots__ = ()
+
     @property
     def area(self):
         return 0
 
 
-HeaderTuple = namedtuple('Header_variables', 'type size offset')
-
-
 class ROIFileObject(object):
     header1_fields = [
         # 'VAR_NAME', 'type', offset'
@@ -306,45 +526,160 @@ class ROIFileObject(object):
         ['ROI_PROPS_LENGTH', 'i', 44]
     ]
 
+    # Composite ROIs are stored as type rect with SHAPE_ROI_SIZE > 0, their type code is only used by ROICollection
     roi_types_rev = {'polygon': 0, 'rect': 1, 'oval': 2, 'line': 3, 'freeline': 4, 'polyline': 5, 'no_roi': 6,
-                     'freehand': 7, 'traced': 8, 'angle': 9, 'point': 10}
+                     'freehand': 7, 'traced': 8, 'angle': 9, 'point': 10, 'composite': 11}
 
     roi_types = {0: 'polygon', 1: 'rect', 2: 'oval', 3: 'line', 4: 'freeline', 5: 'polyline', 6: 'no_roi',
-                 7: 'freehand', 8: 'traces', 9: 'angle', 10: 'point'}
+                 7: 'freehand', 8: 'traced', 9: 'angle', 10: 'point', 11: 'composite'}
+
+    SUB_PIXEL_RESOLUTION = 128  # Bit in OPTIONS
+
+
+def _build_layout(fields):
+    """
+    Build a single big-endian struct.Struct covering all header fields. Fields sharing an offset (eg X1 and XD) are
+    aliases and share the same slot in the unpacked tuple. Returns the Struct and a dict mapping names to slots.
+    """
+    fmt = '>'
+    position = 0
+    slots = {}
+    offset_slots = {}
+    for name, _type, offset in sorted(fields, key=lambda e: e[2]):
+        if offset in offset_slots:
+            slots[name] = offset_slots[offset]
+            continue
+        if offset > position:
+            fmt += '%ix' % (offset - position)
+        fmt += _type
+        offset_slots[offset] = slots[name] = len(offset_slots)
+        position = offset + struct.calcsize('>' + _type)
+
+    return struct.Struct(fmt), slots
+
+
+def _unpack_header(layout, buffer, offset=0):
+    header_struct, slots = layout
+    values = header_struct.unpack_from(buffer, offset)
+    return {name: values[slot] for name, slot in slots.items()}
+
+
+# Precompiled header layouts, header2 offsets are relative to HEADER2_OFFSET
+_HEADER1 = _build_layout(ROIFileObject.header1_fields)
+_HEADER2 = _build_layout(ROIFileObject.header2_fields)
+_HEADER1_VARS = {e[0]: (struct.Struct('>' + e[1]), e[2]) for e in ROIFileObject.header1_fields}
+_HEADER2_VARS = {e[0]: (struct.Struct('>' + e[1]), e[2]) for e in ROIFileObject.header2_fields}
+
+
+# Header fields which are reported as zero, by ROIDecoder and ROIHeader
+_ZEROED_FIELDS = ('OVERLAY_LABEL_COLOR', 'OVERLAY_FONT_SIZE', 'IMAGE_OPACITY')
+
+
+class ROIHeader(Mapping):
+    """
+    Read-only header of an ROI file which decodes fields from the file buffer on access. Takes far less memory than a
+    dict with all header fields, and shares the buffer with the coordinate arrays of the ROI.
+    """
+    __slots__ = ('_buffer', '_header2')
+
+    def __init__(self, buffer, header2=None):
+        self._buffer = buffer
+        self._header2 = header2  # Separate copy of header2, if the buffer only holds header1
+
+    def __getitem__(self, name):
+        if name in _ZEROED_FIELDS:
+            return 0
+        elif name in _HEADER1_VARS:
+            var_struct, offset = _HEADER1_VARS[name]
+            return var_struct.unpack_from(self._buffer, offset)[0]
+        elif name in _HEADER2_VARS:
+            var_struct, offset = _HEADER2_VARS[name]
+            if self._header2 is not None:
+                return var_struct.unpack_from(self._header2, offset)[0]
+            header2_offset = self['HEADER2_OFFSET']
+            if header2_offset <= 0 or header2_offset + _HEADER2[0].size > len(self._buffer):
+                return 0  # No (complete) header2 present
+            return var_struct.unpack_from(self._buffer, header2_offset + offset)[0]
+
+        raise KeyError(name)
+
+    def __reduce__(self):
+        # The buffer may be an mmap or memoryview which cannot be pickled, only the header bytes are copied
+        header2_offset = self['HEADER2_OFFSET']
+        header2 = self._header2
+        if header2 is None:
+            header2 = bytes(self._buffer[header2_offset:header2_offset + _HEADER2[0].size]) if header2_offset > 0 \
+                else b''
+            if len(header2) < _HEADER2[0].size:
+                header2 = bytes(_HEADER2[0].size)
+        return ROIHeader, (bytes(self._buffer[:_HEADER1[0].size]), header2)
+
+    def __iter__(self):
+        for e in ROIFileObject.header1_fields + ROIFileObject.header2_fields:
+            yield e[0]
+
+    def __len__(self):
+        return len(_HEADER1_VARS) + len(_HEADER2_VARS)
+
+    def __repr__(self):
+        return 'ROIHeader(%r)' % dict(self)
+
+
+def _build_dtype(fields, base=0):
+    """Names, big-endian numpy formats and offsets of header fields, aliased fields overlap"""
+    formats = {'h': '>i2', 'i': '>i4', 'f': '>f4', 'b': 'i1'}
+    return ([e[0] for e in fields], [formats.get(e[1], 'S' + e[1][:-1]) for e in fields],
+            [base + e[2] for e in fields])
 
-    @staticmethod
-    def _type_size(_type):
-        sizes = {'h': 2, 'f': 4, 'i': 4, 's': 1, 'b': 1}
-        char = re.findall('\\D', _type)[0]
-        size = sizes[char]
-        number = re.findall('\\d', _type)
 
-        if number:
-            size *= int(number[0])
-        return size
+def _header_dtype(name_length=0):
+    # Record of header1 (64 bytes) followed by header2 (48 bytes), optionally followed by the name
+    names, formats, offsets = [list(a + b) for a, b in zip(_build_dtype(ROIFileObject.header1_fields),
+                                                           _build_dtype(ROIFileObject.header2_fields, base=64))]
+    itemsize = 64 + _HEADER2[0].size
+    if name_length:
+        names.append('NAME')
+        formats.append('U%i' % name_length)
+        offsets.append(itemsize)
+        itemsize += 4 * name_length
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize})
+
+
+HEADER_DTYPE = _header_dtype()
 
 
 class ROIEncoder(ROIFileObject):
+    """
+    Encoder for ImageJ .roi files. With tolerance (pixels), the vertices of polygon-like ROIs are simplified before
+    writing (see simplify_rois).
+    """
 
-    def __init__(self, path, roi_obj):
+    def __init__(self, path, roi_obj, tolerance=None):
         self.path = path
-        self.roi_obj = roi_obj
-
-        self._header1_dict = {e[0]: HeaderTuple(e[1], self._type_size(e[1]), e[2]) for e in self.header1_fields}
-        self._header2_dict = {e[0]: HeaderTuple(e[1], self._type_size(e[1]), e[2]) for e in self.header2_fields}
+        self.roi_obj = roi_obj if tolerance is None else simplify_roi(roi_obj, tolerance)
+        self._buffer = None
+        self._name_bytes = None
+        self._segments = None
 
     def write(self):
+        self.f_obj.write(self.encode())
+
+    def encode(self):
+        """Encode the ROI object into a single preallocated bytearray holding the complete .roi file"""
+        self._name_bytes = self.name.encode('utf-16-be')  # ImageJ stores names as 16 bit chars
+        self._buffer = bytearray(self.name_offset + len(self._name_bytes))
 
         self._write_var('MAGIC', b'Iout')
         self._write_var('VERSION_OFFSET', 225)  # todo or 226??
 
         roi_writer = getattr(self, '_write_roi_' + self.roi_obj.type)
         roi_writer()
+        self._write_header_attrs()
+
+        return self._buffer
 
     def __enter__(self):
         self.f_obj = open(self.path, 'wb')
-        pad = struct.pack('128b', *np.zeros(128, dtype=int))
-        self.f_obj.write(pad)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -369,6 +704,7 @@ class ROIEncoder(ROIFileObject):
         self._write_var('LEFT', self.roi_obj.left)
         self._write_var('BOTTOM', self.roi_obj.bottom)
         self._write_var('RIGHT', self.roi_obj.right)
+        self._write_var('ROUNDED_RECT_ARC_SIZE', self.roi_obj.arc)
         self._write_var('HEADER2_OFFSET', self.header2_offset)
         self._write_var('NAME_OFFSET', self.name_offset)
         self._write_name()
@@ -437,7 +773,30 @@ class ROIEncoder(ROIFileObject):
         self._write_name()
 
     def _write_roi_traced(self):
-        raise NotImplementedError('Writing roi type traced is not implemented')
+        self._write_var('TYPE', self.roi_types_rev[self.roi_obj.type])
+        self._write_var('TOP', self.roi_obj.top)
+        self._write_var('LEFT', self.roi_obj.left)
+        self._write_var('BOTTOM', self.roi_obj.bottom)
+        self._write_var('RIGHT', self.roi_obj.right)
+        self._write_var('N_COORDINATES', len(self.roi_obj))
+        self._write_var('HEADER2_OFFSET', self.header2_offset)
+        self._write_var('NAME_OFFSET', self.name_offset)
+
+        self._write_coords(np.concatenate((self.roi_obj.x_coords, self.roi_obj.y_coords)))
+        self._write_name()
+
+    def _write_roi_composite(self):
+        self._write_var('TYPE', self.roi_types_rev['rect'])
+        self._write_var('TOP', self.roi_obj.top)
+        self._write_var('LEFT', self.roi_obj.left)
+        self._write_var('BOTTOM', self.roi_obj.bottom)
+        self._write_var('RIGHT', self.roi_obj.right)
+        self._write_var('SHAPE_ROI_SIZE', len(self.segments))
+        self._write_var('HEADER2_OFFSET', self.header2_offset)
+        self._write_var('NAME_OFFSET', self.name_offset)
+
+        np.frombuffer(self._buffer, dtype='>f4', count=len(self.segments), offset=64)[:] = self.segments
+        self._write_name()
 
     def _write_roi_angle(self):
         raise NotImplementedError('Writing roi type angle is not implemented')
@@ -446,44 +805,77 @@ class ROIEncoder(ROIFileObject):
         raise NotImplementedError('Writing roi type point is not implemented')
 
     def _write_var(self, var_name, value):
-        if var_name in self._header1_dict:
-            var = self._header1_dict[var_name]
-            offset = var.offset
-        elif var_name in self._header2_dict:
-            var = self._header2_dict[var_name]
-            offset = var.offset + self.header2_offset
+        if var_name in _HEADER1_VARS:
+            var_struct, offset = _HEADER1_VARS[var_name]
+        elif var_name in _HEADER2_VARS:
+            var_struct, offset = _HEADER2_VARS[var_name]
+            offset += self.header2_offset
         else:
             raise Exception('Header variable %s not found' % var_name)
 
-        self.f_obj.seek(offset)
-        binary = struct.pack('>' + var.type, value)
-        self.f_obj.write(binary)
+        if var_name in ('TOP', 'LEFT', 'BOTTOM', 'RIGHT') and not -2**15 <= value <= 2**15 - 1:
+            raise ValueError('Bounding box of roi %s is outside of the 16 bit range of .roi files' % self.name)
+        var_struct.pack_into(self._buffer, offset, value)
 
     def _write_name(self):
-        if self.roi_obj.name:
-            name = self.roi_obj.name
-        else:
-            name = os.path.basename(
-                os.path.splitext(self.path)[0]
-            )
-
-        self._write_var('NAME_LENGTH', len(name))
-        name = ''.join(i for j in zip(len(name)*' ', name) for i in j)  # interleave with with spaces
-
-        self.f_obj.seek(self.name_offset)
-        self.f_obj.write(name.encode())
+        self._write_var('NAME_LENGTH', len(self._name_bytes) // 2)
+        self._buffer[self.name_offset:self.name_offset + len(self._name_bytes)] = self._name_bytes
 
     def _write_coords(self, coords):
         n_coords = int(len(coords) / 2)
         self._write_var('N_COORDINATES', n_coords)
-        self.f_obj.seek(64)
-        binary = struct.pack('>' + str(len(coords)) + 'h', *coords)
-        self.f_obj.write(binary)
+        coords = np.asarray(coords)
+        if len(coords) and (np.round(coords).min() < -2**15 or np.round(coords).max() > 2**15 - 1):
+            raise ValueError('Coordinates of roi %s are outside of the 16 bit range of .roi files' % self.name)
+        if self.subpixel:
+            # Integer coordinates followed by absolute float coordinates
+            np.frombuffer(self._buffer, dtype='>i2', count=len(coords), offset=64)[:] = np.round(coords)
+            origin = np.repeat([self.roi_obj.left, self.roi_obj.top], n_coords)
+            np.frombuffer(self._buffer, dtype='>f4', count=len(coords), offset=64 + 2*len(coords))[:] = coords + origin
+            self._write_var('OPTIONS', self.SUB_PIXEL_RESOLUTION)
+        else:
+            np.frombuffer(self._buffer, dtype='>i2', count=len(coords), offset=64)[:] = coords
+
+    def _write_header_attrs(self):
+        # Position and stroke attributes from the header of decoded ROIs
+        header = getattr(self.roi_obj, 'header', None) or {}
+        for var_name in ['POSITION', 'C_POSITION', 'Z_POSITION', 'T_POSITION', 'STROKE_WIDTH', 'STROKE_COLOR',
+                         'FILL_COLOR']:
+            if header.get(var_name, 0):
+                self._write_var(var_name, header[var_name])
+
+    @property
+    def name(self):
+        if self.roi_obj.name:
+            return self.roi_obj.name
+        elif self.path:
+            return os.path.basename(os.path.splitext(self.path)[0])
+        else:
+            return ''
+
+    @property
+    def subpixel(self):
+        return hasattr(self.roi_obj, 'x_coords') and np.asarray(self.roi_obj.x_coords).dtype.kind == 'f'
+
+    @property
+    def segments(self):
+        """Float segment array of composite ROIs, with absolute coordinates"""
+        if self._segments is None:
+            x, y = [np.asarray(c, dtype=np.float64) for c in (self.roi_obj.x_coords, self.roi_obj.y_coords)]
+            offsets = self.roi_obj.ring_offsets
+            # Without the repeated first vertices and the joining vertices, rings are closed by the close segments
+            ring_offsets = offsets - np.arange(len(offsets))
+            idx = segment_indices(offsets[:-1], np.diff(ring_offsets))[0]
+            self._segments = encode_path(self.roi_obj.left + x[idx], self.roi_obj.top + y[idx], ring_offsets)
+        return self._segments
 
     @property
     def header2_offset(self):
-        if hasattr(self.roi_obj, 'x_coords'):
-            return 64 + len(self.roi_obj)*2*2  # Header1 size + 2 bytes per pair of coords
+        if self.roi_obj.type == 'composite':
+            return 64 + 4 * len(self.segments)  # Header1 size + 4 bytes per float of the segment array
+        elif hasattr(self.roi_obj, 'x_coords'):
+            # Header1 size + 2 bytes per pair of coords, subpixel ROIs add 4 bytes per pair of float coords
+            return 64 + len(self.roi_obj)*2*2 + (len(self.roi_obj)*2*4 if self.subpixel else 0)
         else:
             return 64
 
@@ -492,125 +884,174 @@ class ROIEncoder(ROIFileObject):
         return self.header2_offset + 64  # Name is after header2 which as size 6
 
 
+def _decode_name(binary):
+    """
+    Decode a name stored as 16 bit big-endian chars. Older versions of PymageJ wrote names with a space (0x20) instead
+    of a zero as the high byte of every char, these are decoded from the low bytes.
+    """
+    binary = bytes(binary)
+    if len(binary) and binary[0::2] == b' ' * (len(binary) // 2):
+        return binary[1::2].decode('latin-1')
+    try:
+        return binary.decode('utf-16-be')
+    except UnicodeDecodeError:  # Truncated or malformed names, keep every second byte
+        return binary.decode('latin-1')[1::2]
+
+
+def encode_to_bytes(roi_obj, tolerance=None):
+    """Encode roi_obj into a bytearray with the contents of a .roi file"""
+    return ROIEncoder(None, roi_obj, tolerance=tolerance).encode()
+
+
+# Types of ROIs with vertices which can be simplified
+_SIMPLIFY_CLOSED = {'polygon': True, 'freehand': True, 'traced': True, 'freeline': False, 'polyline': False}
+
+
+def simplify_rois(roi_objs, tolerance=0.5):
+    """
+    Simplify the vertices of polygon, freehand, traced, freeline and polyline ROIs with Douglas-Peucker and collinear
+    point removal, with the tolerance in pixels. All ROIs are simplified in one vectorized pass.
+
+    Returns a list of new ROI objects, other types of ROIs are returned as they are. The bounding box, name and header
+    of the ROIs are kept.
+    """
+    roi_objs = list(roi_objs)
+    selected = [i for i, roi_obj in enumerate(roi_objs) if roi_obj.type in _SIMPLIFY_CLOSED]
+    if not selected:
+        return roi_objs
+
+    x_coords = [np.asarray(roi_objs[i].x_coords) for i in selected]
+    y_coords = [np.asarray(roi_objs[i].y_coords) for i in selected]
+    offsets = np.concatenate([[0], np.cumsum([len(x) for x in x_coords])])
+    closed = np.array([_SIMPLIFY_CLOSED[roi_objs[i].type] for i in selected])
+    keep = simplify_mask(np.concatenate(x_coords), np.concatenate(y_coords), offsets, tolerance, closed=closed)
+
+    result = list(roi_objs)
+    for i, x, y, start, end in zip(selected, x_coords, y_coords, offsets[:-1], offsets[1:]):
+        roi_obj = roi_objs[i]
+        mask = keep[start:end]
+        result[i] = roi_obj.__class__(roi_obj.top, roi_obj.left, roi_obj.bottom, roi_obj.right, x[mask], y[mask],
+                                      name=roi_obj.name)
+        if hasattr(roi_obj, 'header'):
+            result[i].header = roi_obj.header
+
+    return result
+
+
+def simplify_roi(roi_obj, tolerance=0.5):
+    """Simplified copy of a single ROI, see simplify_rois"""
+    return simplify_rois([roi_obj], tolerance)[0]
+
+
 class ROIDecoder(ROIFileObject):
-    def __init__(self, roi_path):
+    """
+    Decoder for ImageJ .roi files.
+
+    Coordinates of polygon-like ROIs are returned as read-only big-endian ('>i2') views on the file buffer, relative to
+    left/top. Pass dtype (eg np.int32 or np.float32) to get native-endian copies instead. With subpixel=True, ROIs which
+    were saved with subpixel resolution return their float coordinates (relative to left/top) instead.
+
+    With use_mmap=True the file is memory-mapped instead of read, coordinate arrays are then views on the mapping and
+    only the pages which are accessed are loaded. The mapping stays open as long as the coordinate arrays are in use.
+
+    With compact=True the header attached to the ROI object is an ROIHeader, which decodes fields on access, instead of
+    a dict.
+    """
+
+    def __init__(self, roi_path, dtype=None, subpixel=False, use_mmap=False, compact=False):
         self.roi_path = roi_path
+        self.dtype = dtype
+        self.subpixel = subpixel
+        self.use_mmap = use_mmap
+        self.compact = compact
         self.header = {}  # Output header dict
-        self._header1_dict = {e[0]: HeaderTuple(e[1], self._type_size(e[1]), e[2]) for e in self.header1_fields}
-        self._header2_dict = {e[0]: HeaderTuple(e[1], self._type_size(e[1]), e[2]) for e in self.header2_fields}
+        self._buffer = None
+
+    @classmethod
+    def from_bytes(cls, data, roi_path=None, **kwargs):
+        """
+        Decoder working on ROI file contents in a bytes-like object (bytes, memoryview, mmap), roi_path is only used
+        as fallback name
+        """
+        decoder = cls(roi_path, **kwargs)
+        decoder._buffer = data
+        return decoder
 
     def __enter__(self):
-        self.f_obj = open(self.roi_path, 'rb')
+        if self._buffer is None:
+            with open(self.roi_path, 'rb') as f_obj:
+                if self.use_mmap and os.fstat(f_obj.fileno()).st_size > 0:
+                    self._buffer = mmap.mmap(f_obj.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self._buffer = f_obj.read()  # Read the whole file at once, all decoding is done from this buffer
         return self
 
     def __exit__(self, type, value, traceback):
-        self.f_obj.close()
         return False
 
     def read_header_all(self):
-        to_read_h1 = [e[0] for e in self.header1_fields]  # Read everything in header1
-        to_read_h2 = [e[0] for e in self.header2_fields]  # Read everything in header2
-
-        for h in to_read_h1 + to_read_h2:
-            self._set_header(h)
+        self.header.update(_unpack_header(_HEADER1, self._buffer))
+        self.header.update(self._unpack_header2())
 
     def read_header(self):
-        if self._get_var('MAGIC') != b'Iout':
+        if len(self._buffer) < _HEADER1[0].size or self._get_var('MAGIC') != b'Iout':
             raise IOError('Invalid ROI file, magic number mismatch')
 
-        # to_read_h1 = ['VERSION_OFFSET', 'TYPE', 'SUBTYPE', 'TOP', 'LEFT', 'BOTTOM', 'RIGHT', 'N_COORDINATES',
-        #               'STROKE_WIDTH', 'SHAPE_ROI_SIZE', 'STROKE_COLOR', 'FILL_COLOR', 'SUBTYPE', 'OPTIONS', 'POSITION',
-        #               'HEADER2_OFFSET']
+        self.read_header_all()
 
-        to_read_h1 = [e[0] for e in self.header1_fields]  # Read everything in header1
-        to_read_h2 = [e[0] for e in self.header2_fields]  # Read everything in header2
-
-        set_zero = ['OVERLAY_LABEL_COLOR', 'OVERLAY_FONT_SIZE', 'IMAGE_OPACITY']
-
-        for h in to_read_h1 + to_read_h2:
-            self._set_header(h)
-
-        for h in set_zero:
+        for h in _ZEROED_FIELDS:
             self.header[h] = 0
 
     def get_roi(self):
         if not self.header:
             self.read_header()
 
-        try:
-            roi_reader = getattr(self, '_get_roi_' + self.roi_types[self.header['TYPE']])
-        except AttributeError:
-            raise NotImplementedError('Reading roi type %s not implemented' % self.roi_types[self.header['TYPE']])
+        if self.header['SHAPE_ROI_SIZE'] > 0:
+            roi_reader = self._get_roi_composite
+        else:
+            try:
+                roi_reader = getattr(self, '_get_roi_' + self.roi_types[self.header['TYPE']])
+            except AttributeError:
+                raise NotImplementedError('Reading roi type %s not implemented' % self.roi_types[self.header['TYPE']])
 
         roi_obj = roi_reader()
         roi_obj.name = self._get_name()
-        roi_obj.header = self.header
+        roi_obj.header = ROIHeader(self._buffer) if self.compact else self.header
 
         return roi_obj
 
     def _get_roi_polygon(self):
-        params = ['TOP', 'LEFT', 'BOTTOM', 'RIGHT']
-        for p in params:
-            self._set_header(p)
-
-        top, left, bottom, right = [self.header[p] for p in params]
-
-        n_coords = self.header['N_COORDINATES']
-        self.f_obj.seek(64)
-        binary = self.f_obj.read(2 * n_coords * 2)
-        coords = np.array(struct.unpack('>' + str(2 * n_coords) + 'h', binary))
-        x_coords = np.array(coords[:n_coords])
-        y_coords = np.array(coords[n_coords:])
+        top, left, bottom, right = self._get_bounds()
+        coords = self._get_coords()
+        x_coords, y_coords = coords.reshape(2, -1)
 
         return ROIPolygon(top, left, bottom, right, x_coords, y_coords)
 
     def _get_roi_rect(self):
-        self._set_header('ROUNDED_RECT_ARC_SIZE')
         arc = self.header['ROUNDED_RECT_ARC_SIZE']
-
-        params = ['TOP', 'LEFT', 'BOTTOM', 'RIGHT']
-        for p in params:
-            self._set_header(p)
-
-        top, left, bottom, right = [self.header[p] for p in params]
+        top, left, bottom, right = self._get_bounds()
 
         return ROIRect(top, left, bottom, right, arc=arc)
 
     def _get_roi_oval(self):
-        params = ['TOP', 'LEFT', 'BOTTOM', 'RIGHT']
-        for p in params:
-            self._set_header(p)
-
-        top, left, bottom, right = [self.header[p] for p in params]
+        top, left, bottom, right = self._get_bounds()
 
         return ROIOval(top, left, bottom, right)
 
     def _get_roi_line(self):
-        params = ['X1', 'Y1', 'X2', 'Y2']
-        for p in params:
-            self._set_header(p)
-
-        x1, y1, x2, y2 = [self.header[p] for p in params]
+        x1, y1, x2, y2 = [self.header[p] for p in ['X1', 'Y1', 'X2', 'Y2']]
 
         return ROILine(x1, y1, x2, y2)
 
     def _get_roi_freeline(self):
-        params = ['TOP', 'LEFT', 'BOTTOM', 'RIGHT']
-        for p in params:
-            self._set_header(p)
-
-        top, left, bottom, right = [self.header[p] for p in params]
+        top, left, bottom, right = self._get_bounds()
         coords = self._get_coords()
         x_coords, y_coords = coords.reshape(2, -1)
 
         return ROIFreeLine(top, left, bottom, right, x_coords, y_coords)
 
     def _get_roi_polyline(self):
-        params = ['TOP', 'LEFT', 'BOTTOM', 'RIGHT']
-        for p in params:
-            self._set_header(p)
-
-        top, left, bottom, right = [self.header[p] for p in params]
+        top, left, bottom, right = self._get_bounds()
         coords = self._get_coords()
         x_coords, y_coords = coords.reshape(2, -1)
 
@@ -620,61 +1061,508 @@ class ROIDecoder(ROIFileObject):
         raise NotImplementedError('Reading roi type no roi is not implemented')
 
     def _get_roi_freehand(self):
-        params = ['TOP', 'LEFT', 'BOTTOM', 'RIGHT']
-        for p in params:
-            self._set_header(p)
-
-        top, left, bottom, right = [self.header[p] for p in params]
+        top, left, bottom, right = self._get_bounds()
         coords = self._get_coords()
         x_coords, y_coords = coords.reshape(2, -1)
 
         return ROIFreehand(top, left, bottom, right, x_coords, y_coords)
 
     def _get_roi_traced(self):
-        params = ['TOP', 'LEFT', 'BOTTOM', 'RIGHT']
-        for p in params:
-            self._set_header(p)
-
-        top, left, bottom, right = [self.header[p] for p in params]
+        top, left, bottom, right = self._get_bounds()
         coords = self._get_coords()
         x_coords, y_coords = coords.reshape(2, -1)
 
         return ROITraced(top, left, bottom, right, x_coords, y_coords)
 
+    def _get_roi_composite(self):
+        # Segment array of moveTo, lineTo, quadTo, cubicTo and close segments with absolute float coordinates
+        top, left, bottom, right = self._get_bounds()
+        segments = np.frombuffer(self._buffer, dtype='>f4', count=self.header['SHAPE_ROI_SIZE'], offset=64)
+        x, y, offsets = decode_path(segments)
+        roi_obj = ROIComposite.from_rings(x, y, offsets, top, left, bottom, right)
+        if self.dtype is not None:
+            roi_obj.x_coords = roi_obj.x_coords.astype(self.dtype)
+            roi_obj.y_coords = roi_obj.y_coords.astype(self.dtype)
+
+        return roi_obj
+
     def _get_roi_angle(self):
         raise NotImplementedError('Reading roi type angle is not implemented')
 
     def _get_roi_point(self):
         raise NotImplementedError('Reading roi type point is not implemented')
 
+    def _get_bounds(self):
+        return [self.header[p] for p in ['TOP', 'LEFT', 'BOTTOM', 'RIGHT']]
+
     def _get_var(self, var_name):
-        if var_name in self._header1_dict:
-            var = self._header1_dict[var_name]
-            offset = var.offset
-        elif var_name in self._header2_dict:
-            var = self._header2_dict[var_name]
-            offset = var.offset + self._get_var('HEADER2_OFFSET')
+        if var_name in self.header:
+            return self.header[var_name]
+
+        if var_name in _HEADER1_VARS:
+            var_struct, offset = _HEADER1_VARS[var_name]
+        elif var_name in _HEADER2_VARS:
+            var_struct, offset = _HEADER2_VARS[var_name]
+            offset += self._get_var('HEADER2_OFFSET')
         else:
             raise Exception('Header variable %s not found' % var_name)
 
-        self.f_obj.seek(offset)
-        binary = self.f_obj.read(var.size)
-        return struct.unpack('>' + var.type, binary)[0]  # read header variable, big endian
+        return var_struct.unpack_from(self._buffer, offset)[0]  # read header variable, big endian
+
+    def _unpack_header2(self):
+        header2_offset = self._get_var('HEADER2_OFFSET')
+        if 0 < header2_offset and header2_offset + _HEADER2[0].size <= len(self._buffer):
+            return _unpack_header(_HEADER2, self._buffer, header2_offset)
+        else:  # No (complete) header2 present, eg files written by old ImageJ versions
+            return {e[0]: 0 for e in self.header2_fields}
 
     def _get_coords(self):
         n_coords = self.header['N_COORDINATES']
-        self.f_obj.seek(64)
-        binary = self.f_obj.read(2*2*n_coords)  # Two bytes per pair of coords
-        coords = np.array(struct.unpack('>' + str(2*n_coords) + 'h', binary))
+        if self.subpixel and self._has_subpixel():
+            # Float block follows the integer coordinates, four bytes per coord, absolute positions
+            coords = np.frombuffer(self._buffer, dtype='>f4', count=2*n_coords, offset=64 + 2*2*n_coords)
+            coords = coords.reshape(2, -1) - np.array([[self.header['LEFT']], [self.header['TOP']]], dtype=np.float32)
+            return coords.astype(self.dtype or np.float32, copy=False).reshape(-1)
+
+        coords = np.frombuffer(self._buffer, dtype='>i2', count=2*n_coords, offset=64)  # Two bytes per coord
+        if self.dtype is not None:
+            coords = coords.astype(self.dtype)
 
         return coords
 
+    def _has_subpixel(self):
+        return bool(self.header['OPTIONS'] & self.SUB_PIXEL_RESOLUTION) and self.header['VERSION_OFFSET'] >= 222
+
     def _get_name(self):
         name_length = self._get_var('NAME_LENGTH')
         name_offset = self._get_var('NAME_OFFSET')
-        self.f_obj.seek(name_offset)
-        binary = self.f_obj.read(2*name_length)
-        return binary.decode()[1::2]
+        if name_length == 0 and self.roi_path:  # Like ImageJ, fall back to the file name
+            return os.path.basename(os.path.splitext(self.roi_path)[0])
+        return _decode_name(self._buffer[name_offset:name_offset + 2*name_length])
 
     def _set_header(self, var_name):
         self.header[var_name] = self._get_var(var_name)
+
+
+def _map_file(f_obj):
+    """Read-only memory map of an open file, the mapping is closed when it is no longer referenced"""
+    return mmap.mmap(f_obj.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _entry_buffer(zip_obj, info, mapping=None):
+    """Contents of a zip entry, a zero-copy memoryview on the mapped archive for uncompressed entries"""
+    if mapping is not None and info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+        # Data follows the 30 byte local file header, its file name and extra field
+        name_length, extra_length = struct.unpack_from('<HH', mapping, info.header_offset + 26)
+        start = info.header_offset + 30 + name_length + extra_length
+        return memoryview(mapping)[start:start + info.file_size]
+
+    return zip_obj.read(info)
+
+
+class RoiSetReader(object):
+    """
+    Reader for ImageJ RoiSet .zip archives as saved by the ROI Manager.
+
+    Entries are decoded lazily from memory with ROIDecoder, either by iterating over the reader or by entry name:
+
+        with RoiSetReader('RoiSet.zip') as roi_set:
+            for roi_obj in roi_set:
+                ...
+            roi_obj = roi_set['0001-0123']
+
+    With use_mmap=True the archive is memory-mapped and uncompressed (stored) entries are decoded directly from the
+    mapping without copying. Other keyword arguments (dtype, subpixel, compact) are passed to ROIDecoder.
+    """
+
+    def __init__(self, path, use_mmap=False, **kwargs):
+        self.path = path
+        self.use_mmap = use_mmap
+        self.decoder_kwargs = kwargs
+        self._entries = None
+        self._mapping = None
+
+    def __enter__(self):
+        self.zip_obj = zipfile.ZipFile(self.path, 'r')
+        self._entries = {os.path.splitext(info.filename)[0]: info for info in self.zip_obj.infolist()
+                         if info.filename.endswith('.roi')}
+        if self.use_mmap:
+            self._mapping = _map_file(self.zip_obj.fp)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.zip_obj.close()
+        return False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        for name in self._entries:
+            yield self[name]
+
+    def __contains__(self, name):
+        return self._entry_name(name) in self._entries
+
+    def __getitem__(self, name):
+        try:
+            info = self._entries[self._entry_name(name)]
+        except KeyError:
+            raise KeyError('ROI %s not found in %s' % (name, self.path))
+
+        return self._decoder(info).get_roi()
+
+    @property
+    def names(self):
+        return list(self._entries)
+
+    def items(self):
+        for name in self._entries:
+            yield name, self[name]
+
+    def _decoder(self, info):
+        data = _entry_buffer(self.zip_obj, info, self._mapping)
+        return ROIDecoder.from_bytes(data, info.filename, **self.decoder_kwargs)
+
+    @staticmethod
+    def _entry_name(name):
+        return name[:-4] if name.endswith('.roi') else name
+
+
+class RoiSetWriter(object):
+    """
+    Writer for ImageJ RoiSet .zip archives. ROI objects are encoded in memory and streamed into the archive one at a
+    time, so any iterable of ROI objects can be written:
+
+        with RoiSetWriter('RoiSet.zip') as roi_set:
+            roi_set.write_all(roi_objs)
+
+    ROIs are stored under their name, unnamed ROIs get their index in the archive as name. Duplicate names get a
+    numbered suffix, as the ROI Manager requires unique names. With tolerance, the vertices of polygon-like ROIs are
+    simplified before writing (see simplify_rois).
+    """
+
+    def __init__(self, path, mode='w', compression=zipfile.ZIP_DEFLATED, tolerance=None):
+        self.path = path
+        self.mode = mode
+        self.compression = compression
+        self.tolerance = tolerance
+        self._names = set()
+
+    def __enter__(self):
+        self.zip_obj = zipfile.ZipFile(self.path, self.mode, compression=self.compression)
+        self._names = {os.path.splitext(name)[0] for name in self.zip_obj.namelist()}
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.zip_obj.close()
+        return False
+
+    def write(self, roi_obj, name=None):
+        name = self._unique_name(name or roi_obj.name or '%04d' % (len(self._names) + 1))
+        self.zip_obj.writestr(name + '.roi', self._encode(name, roi_obj))
+        return name
+
+    def write_all(self, roi_objs):
+        return [self.write(roi_obj) for roi_obj in roi_objs]
+
+    def _unique_name(self, name, taken=()):
+        unique_name = name
+        i = 1
+        while unique_name in self._names or unique_name in taken:
+            unique_name = '%s-%i' % (name, i)
+            i += 1
+        self._names.add(unique_name)
+        return unique_name
+
+    def _encode(self, name, roi_obj):
+        return bytes(ROIEncoder(name + '.roi', roi_obj, tolerance=self.tolerance).encode())
+
+
+def _copy_bytes(src, dst, size, chunk_size=2**20):
+    """Copy size bytes from the current position of src to dst, in chunks of at most chunk_size bytes"""
+    while size > 0:
+        chunk = src.read(min(chunk_size, size))
+        if not chunk:
+            raise IOError('Unexpected end of file')
+        dst.write(chunk)
+        size -= len(chunk)
+
+
+def _replace_zip_entries(zip_obj, infos, start_dir):
+    """
+    Replace the entries of a ZipFile opened for appending by infos, the next entry (or the central directory) is written
+    at start_dir. Returns the previous start_dir, the end of the last entry.
+
+    zipfile has no API to remove entries, so this sets the private filelist, NameToInfo, start_dir and _didModify
+    attributes of ZipFile. Verified with CPython 3.11; all use of zipfile internals is kept in this function.
+    """
+    previous = zip_obj.start_dir
+    zip_obj.filelist = list(infos)
+    zip_obj.NameToInfo = {info.filename: info for info in infos}
+    zip_obj.start_dir = start_dir
+    zip_obj._didModify = True
+    return previous
+
+
+class RoiSetEditor(RoiSetWriter):
+    """
+    Editor for existing ImageJ RoiSet .zip archives, entries can be appended, replaced or deleted by name:
+
+        with RoiSetEditor('RoiSet.zip') as roi_set:
+            roi_set.write(new_roi)  # Append with a unique name
+            roi_set['0001-0123'] = corrected_roi  # Replace (or append if the name is new)
+            del roi_set['0002-0456']
+
+    All changes are applied when the editor is closed, and discarded if it is closed by an exception. Entries before
+    the first replaced or deleted entry are left untouched, later entries are moved as raw (compressed) records without
+    decoding them, and replaced entries keep their position in the archive. The moved records are buffered in a
+    temporary file, memory use does not depend on the size of the archive. Appended entries are written after the last
+    entry and finally the central directory is rewritten.
+    """
+
+    def __init__(self, path, compression=zipfile.ZIP_DEFLATED, tolerance=None, **kwargs):
+        super(RoiSetEditor, self).__init__(path, mode='a', compression=compression, tolerance=tolerance)
+        self.decoder_kwargs = kwargs
+        self._replaced = {}
+        self._appended = {}
+        self._deleted = set()
+
+    def __enter__(self):
+        super(RoiSetEditor, self).__enter__()
+        self._replaced = {}
+        self._appended = {}
+        self._deleted = set()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            if self._replaced or self._deleted:
+                self._rewrite()
+            for name, data in self._appended.items():
+                self.zip_obj.writestr(name + '.roi', data)
+        return super(RoiSetEditor, self).__exit__(exc_type, exc_val, exc_tb)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return RoiSetReader._entry_name(name) in self._names
+
+    def __getitem__(self, name):
+        name = RoiSetReader._entry_name(name)
+        if name not in self._names:
+            raise KeyError('ROI %s not found in %s' % (name, self.path))
+        data = self._replaced.get(name) or self._appended.get(name) or self.zip_obj.read(name + '.roi')
+        return ROIDecoder.from_bytes(data, name + '.roi', **self.decoder_kwargs).get_roi()
+
+    def __setitem__(self, name, roi_obj):
+        name = RoiSetReader._entry_name(name)
+        if name in self._appended:
+            self._appended[name] = self._encode(name, roi_obj)
+        elif name in self._names or name in self._deleted:
+            self._deleted.discard(name)
+            self._names.add(name)
+            self._replaced[name] = self._encode(name, roi_obj)
+        else:
+            self.write(roi_obj, name=name)
+
+    def __delitem__(self, name):
+        name = RoiSetReader._entry_name(name)
+        if name not in self._names:
+            raise KeyError('ROI %s not found in %s' % (name, self.path))
+        self._names.discard(name)
+        self._replaced.pop(name, None)
+        if self._appended.pop(name, None) is None:
+            self._deleted.add(name)
+
+    def write(self, roi_obj, name=None):
+        name = self._unique_name(name or roi_obj.name or '%04d' % (len(self._names) + 1))
+        self._appended[name] = self._encode(name, roi_obj)
+        return name
+
+    @property
+    def names(self):
+        return [os.path.splitext(info.filename)[0] for info in self.zip_obj.infolist()
+                if os.path.splitext(info.filename)[0] not in self._deleted] + list(self._appended)
+
+    def _unique_name(self, name, taken=()):
+        # Deleted entries stay in the archive until it is rewritten, so their names can not be used for new entries
+        return super(RoiSetEditor, self)._unique_name(name, taken=self._deleted)
+
+    def _rewrite(self):
+        """Rewrite the archive from the first replaced or deleted entry onwards"""
+        zip_obj = self.zip_obj
+        infos = sorted(zip_obj.infolist(), key=lambda info: info.header_offset)
+        changed = self._deleted | set(self._replaced)
+        first = min(i for i, info in enumerate(infos) if os.path.splitext(info.filename)[0] in changed)
+        start = infos[first].header_offset
+        kept = infos[:first]
+        ends = [info.header_offset for info in infos[1:]] + [_replace_zip_entries(zip_obj, kept, start)]
+
+        # Replacements can be larger than the entries they replace, so the tail is moved via a temporary file
+        with tempfile.TemporaryFile() as tail:
+            zip_obj.fp.seek(start)
+            _copy_bytes(zip_obj.fp, tail, ends[-1] - start)
+
+            position = start
+            for info, end in zip(infos[first:], ends[first:]):
+                name = os.path.splitext(info.filename)[0]
+                if name in self._deleted:
+                    continue
+                elif name in self._replaced:
+                    zip_obj.writestr(info.filename, self._replaced[name])
+                    kept.append(zip_obj.getinfo(info.filename))
+                    position = zip_obj.fp.tell()
+                else:
+                    tail.seek(info.header_offset - start)
+                    zip_obj.fp.seek(position)
+                    _copy_bytes(tail, zip_obj.fp, end - info.header_offset)
+                    info.header_offset = position
+                    position = zip_obj.fp.tell()
+                    kept.append(info)
+                    _replace_zip_entries(zip_obj, kept, position)
+
+        self._replaced = {}
+        self._deleted = set()
+
+
+def _decode_chunk(zip_path, items, use_mmap=False, **kwargs):
+    """Decode a chunk of ROIs, returns a list of (roi_obj, exception) tuples"""
+    zip_obj = zipfile.ZipFile(zip_path, 'r') if zip_path else None
+    mapping = _map_file(zip_obj.fp) if zip_obj is not None and use_mmap else None
+    results = []
+    try:
+        for item in items:
+            try:
+                if zip_obj is not None:
+                    data = _entry_buffer(zip_obj, zip_obj.getinfo(item), mapping)
+                    decoder = ROIDecoder.from_bytes(data, item, **kwargs)
+                elif isinstance(item, (bytes, bytearray, memoryview)):
+                    decoder = ROIDecoder.from_bytes(item, **kwargs)
+                else:
+                    decoder = ROIDecoder(item, use_mmap=use_mmap, **kwargs)
+                with decoder:
+                    results.append((decoder.get_roi(), None))
+            except Exception as e:
+                results.append((None, e))
+    finally:
+        if zip_obj is not None:
+            zip_obj.close()
+
+    return results
+
+
+def _roi_paths(paths_or_dir):
+    """List of .roi file paths, the sorted .roi files in paths_or_dir if it is a directory"""
+    if isinstance(paths_or_dir, str) and os.path.isdir(paths_or_dir):
+        return [os.path.join(paths_or_dir, name) for name in sorted(os.listdir(paths_or_dir)) if name.endswith('.roi')]
+    return list(paths_or_dir)
+
+
+def decode_many(paths_or_zip, workers=None, chunksize=None, **kwargs):
+    """
+    Decode many ROIs in parallel.
+
+    paths_or_zip is either the path of a RoiSet .zip archive, a directory of .roi files or an iterable of .roi file
+    paths or of in-memory .roi file contents. Files are decoded in a process pool with `workers` processes (default:
+    number of CPUs), in-memory contents in a thread pool. With workers=1 everything is decoded in the calling process.
+    Keyword arguments (dtype, subpixel, use_mmap, compact) are passed to ROIDecoder, with use_mmap workers memory-map
+    the archive and decode uncompressed entries from the shared page cache.
+
+    Returns a list of ROI objects in input order, with None for ROIs which failed to decode, and a dict of the
+    exceptions of the failed ROIs by path, zip entry name or (for in-memory input) index.
+    """
+    zip_path = None
+    if isinstance(paths_or_zip, str) and zipfile.is_zipfile(paths_or_zip):
+        zip_path = paths_or_zip
+        with zipfile.ZipFile(zip_path, 'r') as zip_obj:
+            items = [name for name in zip_obj.namelist() if name.endswith('.roi')]
+    else:
+        items = _roi_paths(paths_or_zip)
+
+    in_memory = zip_path is None and any(isinstance(item, (bytes, bytearray, memoryview)) for item in items)
+    workers = workers or os.cpu_count() or 1
+    chunksize = chunksize or max(1, -(-len(items) // (4 * workers)))  # Roughly four chunks per worker
+    chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+    decode_chunk = partial(_decode_chunk, zip_path, **kwargs)
+
+    if workers == 1 or len(chunks) <= 1:
+        results = [decode_chunk(chunk) for chunk in chunks]
+    else:
+        executor_cls = ThreadPoolExecutor if in_memory else ProcessPoolExecutor
+        with executor_cls(workers) as executor:
+            results = list(executor.map(decode_chunk, chunks))
+
+    roi_objs = []
+    errors = {}
+    for i, (roi_obj, error) in enumerate(r for chunk in results for r in chunk):
+        roi_objs.append(roi_obj)
+        if error is not None:
+            errors[i if in_memory else items[i]] = error
+
+    return roi_objs, errors
+
+
+def _scan_header(read_at, with_name):
+    """Header1 and header2 bytes and optionally the name of one ROI file, read_at(offset, size) returns file bytes"""
+    header1 = read_at(0, 64)
+    if len(header1) < 64 or header1[:4] != b'Iout':
+        raise IOError('Invalid ROI file, magic number mismatch')
+
+    header2_offset = _HEADER1_VARS['HEADER2_OFFSET'][0].unpack_from(header1, 60)[0]
+    header2 = read_at(header2_offset, _HEADER2[0].size) if header2_offset > 0 else b''
+    if len(header2) < _HEADER2[0].size:
+        header2 = bytes(_HEADER2[0].size)
+
+    name = ''
+    if with_name:
+        name_offset, name_length = struct.unpack_from('>ii', header2, _HEADER2_VARS['NAME_OFFSET'][1])
+        name = _decode_name(read_at(name_offset, 2*name_length)) if name_length > 0 else ''
+
+    return header1 + header2, name
+
+
+def scan_headers(paths_or_zip, names=False):
+    """
+    Read the headers of many ROI files into one numpy structured array with a field per header1 and header2 field
+    (big-endian, see HEADER_DTYPE). Coordinates are never decoded. Files are only read at the header1, header2 and
+    (if names is True) name offsets; entries of a RoiSet .zip archive are returned in archive order, .roi files in a
+    directory in sorted order.
+
+    With names=True the returned array has an extra 'NAME' field with the ROI names.
+    """
+    headers = []
+    roi_names = []
+    if isinstance(paths_or_zip, str) and zipfile.is_zipfile(paths_or_zip):
+        with zipfile.ZipFile(paths_or_zip, 'r') as zip_obj:
+            for info in zip_obj.infolist():
+                if not info.filename.endswith('.roi'):
+                    continue
+                data = zip_obj.read(info)
+                header, name = _scan_header(lambda offset, size: data[offset:offset + size], names)
+                headers.append(header)
+                roi_names.append(name)
+    else:
+        for path in _roi_paths(paths_or_zip):
+            with open(path, 'rb') as f_obj:
+                def read_at(offset, size):
+                    f_obj.seek(offset)
+                    return f_obj.read(size)
+                try:
+                    header, name = _scan_header(read_at, names)
+                except IOError as e:
+                    raise IOError('%s: %s' % (path, e))
+            headers.append(header)
+            roi_names.append(name)
+
+    records = np.frombuffer(b''.join(headers), dtype=HEADER_DTYPE)
+    if not names:
+        return records
+
+    dtype = _header_dtype(max([len(name) for name in roi_names] + [1]))
+    out = np.zeros(len(records), dtype=dtype)
+    out.view(np.uint8).reshape(len(records), -1)[:, :HEADER_DTYPE.itemsize] = \
+        records.view(np.uint8).reshape(len(records), -1)
+    out['NAME'] = roi_names
+    return out
@@ -0,0 +1,267 @@
+"""
+PymageJ Copyright (C) 2015 Jochem Smit
+
+This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public License
+ as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+ of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program; if not, write to the
+Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from pymagej.roi import ROIFileObject
+from pymagej.collection import ROICollection, TYPES_CLOSED
+from pymagej.geometry import segment_indices
+
+
+# Containment follows the masks in pymagej.mask: a point is inside an ROI where a pixel with its center at the point
+# would be inside the ROI's mask. Lines contain no points.
+
+
+def _polygon_contains(rois, roi_idx, x, y):
+    """
+    Even-odd test for pairs of polygon ROIs and points. The pairs are sorted by ROI and y, so the pairs crossed by each
+    edge are a contiguous range and only those edge-pair combinations are tested.
+    """
+    involved = np.unique(roi_idx)
+    vertex_idx, segment = segment_indices(rois.offsets[involved], rois.lengths[involved])
+    edge_roi = involved[segment]
+    next_idx = vertex_idx + 1
+    last = rois.offsets[edge_roi + 1] - 1 == vertex_idx
+    next_idx[last] = rois.offsets[edge_roi[last]]
+
+    x1, y1 = rois.x[vertex_idx].astype(np.float64), rois.y[vertex_idx].astype(np.float64)
+    x2, y2 = rois.x[next_idx].astype(np.float64), rois.y[next_idx].astype(np.float64)
+
+    # Exact integer ranks of all y values, pairs and edge ends are then compared by (roi, rank) keys
+    ranks = np.unique(np.concatenate([y, y1, y2]), return_inverse=True)[1].reshape(-1)
+    n_ranks = ranks.max() + 1
+    pair_keys = roi_idx * n_ranks + ranks[:len(y)]
+    order = np.argsort(pair_keys, kind='stable')
+    pair_keys = pair_keys[order]
+
+    rank1, rank2 = ranks[len(y):len(y) + len(y1)], ranks[len(y) + len(y1):]
+    lo = np.searchsorted(pair_keys, edge_roi * n_ranks + np.minimum(rank1, rank2), 'left')
+    hi = np.searchsorted(pair_keys, edge_roi * n_ranks + np.maximum(rank1, rank2), 'left')
+
+    # Pairs with y in [min(y1, y2), max(y1, y2)) are crossed by the edge, count crossings left of the point
+    positions, edge = segment_indices(lo, hi - lo)
+    pair = order[positions]
+    crossing = x1[edge] + (y[pair] - y1[edge]) * (x2[edge] - x1[edge]) / (y2[edge] - y1[edge])
+    counts = np.bincount(pair[crossing <= x[pair]], minlength=len(y))
+    return counts % 2 == 1
+
+
+def contains(rois, roi_idx, x, y):
+    """
+    Vectorized test whether the points x, y are inside the ROIs with indices roi_idx in the ROICollection rois, for
+    pairs of ROIs and points. Returns a boolean array with an entry per pair.
+    """
+    roi_idx = np.asarray(roi_idx, dtype=np.int64)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    types = rois.types[roi_idx]
+    top, left = rois.top[roi_idx].astype(np.float64), rois.left[roi_idx].astype(np.float64)
+    bottom, right = rois.bottom[roi_idx].astype(np.float64), rois.right[roi_idx].astype(np.float64)
+    inside = np.zeros(len(roi_idx), dtype=bool)
+
+    is_polygon = np.isin(types, TYPES_CLOSED)
+    if is_polygon.any():
+        inside[is_polygon] = _polygon_contains(rois, roi_idx[is_polygon], x[is_polygon], y[is_polygon])
+
+    is_oval = types == ROIFileObject.roi_types_rev['oval']
+    rx, ry = (right[is_oval] - left[is_oval]) / 2., (bottom[is_oval] - top[is_oval]) / 2.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inside[is_oval] = ((x[is_oval] - left[is_oval] - rx) / rx)**2 + ((y[is_oval] - top[is_oval] - ry) / ry)**2 < 1
+
+    is_rect = types == ROIFileObject.roi_types_rev['rect']
+    dx, dy = x[is_rect] - left[is_rect], y[is_rect] - top[is_rect]
+    width, height = right[is_rect] - left[is_rect], bottom[is_rect] - top[is_rect]
+    in_rect = (dx >= 0) & (dx < width) & (dy >= 0) & (dy < height)
+
+    # Rounded corners as in fill_rect, the distance into the corner regions should be within the corner ellipse
+    arc = rois.arc[roi_idx][is_rect].astype(np.float64)
+    rounded = arc > 0
+    crx, cry = np.minimum(arc, width) / 2., np.minimum(arc, height) / 2.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cdx = np.maximum(np.maximum(crx - dx, dx - (width - crx)), 0) / crx
+        cdy = np.maximum(np.maximum(cry - dy, dy - (height - cry)), 0) / cry
+    in_rect[rounded] &= cdx[rounded]**2 + cdy[rounded]**2 <= 1
+    inside[is_rect] = in_rect
+
+    return inside
+
+
+class ROIIndex(object):
+    """
+    Spatial index over the bounding boxes of many ROIs, as a uniform grid. Each ROI is registered in the grid cells its
+    bounding box overlaps, queries only look at the ROIs in the cells they touch.
+
+    rois is a list of ROI objects or an ROICollection. The cell size defaults to the median ROI size.
+    """
+
+    def __init__(self, rois, cell_size=None):
+        self.rois = ROICollection.from_rois(rois)
+        top, left, bottom, right = [c.astype(np.int64) for c in (self.rois.top, self.rois.left, self.rois.bottom,
+                                                                 self.rois.right)]
+        if cell_size is None:
+            size = np.maximum(right - left, bottom - top)
+            cell_size = int(np.median(size)) if len(size) else 1
+        self.cell_size = max(int(cell_size), 1)
+
+        self.origin = (int(top.min()), int(left.min())) if len(self) else (0, 0)
+        row0, col0 = self._cells(top, left)
+        row1, col1 = self._cells(np.maximum(bottom - 1, top), np.maximum(right - 1, left))
+        self.shape = (int(row1.max()) + 1, int(col1.max()) + 1) if len(self) else (0, 0)
+
+        n_rows, n_cols = row1 - row0 + 1, col1 - col0 + 1
+        k, roi_idx = segment_indices(np.zeros(len(self), dtype=np.int64), n_rows * n_cols)
+        keys = (row0[roi_idx] + k // n_cols[roi_idx]) * self.shape[1] + col0[roi_idx] + k % n_cols[roi_idx]
+
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._roi_idx = roi_idx[order]
+        self._centroid = None
+
+        # Start of every cell's entries for direct lookup, unless the grid is much larger than the number of entries
+        n_cells = self.shape[0] * self.shape[1]
+        self._cell_start = None
+        if n_cells <= 4 * len(keys) + 2**16:
+            self._cell_start = np.searchsorted(self._keys, np.arange(n_cells + 1))
+
+    def __len__(self):
+        return len(self.rois)
+
+    def _cells(self, y, x):
+        return (np.floor(y).astype(np.int64) - self.origin[0]) // self.cell_size, \
+            (np.floor(x).astype(np.int64) - self.origin[1]) // self.cell_size
+
+    def query_bbox(self, top, left, bottom, right):
+        """Sorted indices of the ROIs whose bounding box overlaps with the given box"""
+        return self.query_bboxes([top], [left], [bottom], [right])[1]
+
+    def query_bboxes(self, top, left, bottom, right):
+        """
+        All pairs of boxes (arrays top, left, bottom, right) and ROIs whose bounding box overlaps with them, as arrays
+        of box indices and ROI indices sorted by box and then ROI.
+        """
+        top, left, bottom, right = [np.asarray(c, dtype=np.float64).reshape(-1) for c in (top, left, bottom, right)]
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        row0, col0 = self._cells(top, left)
+        row1, col1 = self._cells(bottom, right)
+        row0, col0 = np.maximum(row0, 0), np.maximum(col0, 0)
+        row1, col1 = np.minimum(row1, self.shape[0] - 1), np.minimum(col1, self.shape[1] - 1)
+        n_rows, n_cols = np.maximum(row1 - row0 + 1, 0), np.maximum(col1 - col0 + 1, 0)
+
+        k, box_idx = segment_indices(np.zeros(len(top), dtype=np.int64), n_rows * n_cols)
+        keys = (row0[box_idx] + k // n_cols[box_idx]) * self.shape[1] + col0[box_idx] + k % n_cols[box_idx]
+        lo, hi = self._cell_ranges(keys)
+        positions, pair = segment_indices(lo, hi - lo)
+        box_idx, roi_idx = box_idx[pair], self._roi_idx[positions]
+
+        rois = self.rois
+        overlaps = (rois.top[roi_idx] < bottom[box_idx]) & (rois.bottom[roi_idx] > top[box_idx]) & \
+                   (rois.left[roi_idx] < right[box_idx]) & (rois.right[roi_idx] > left[box_idx])
+        # ROIs spanning multiple cells are found once per cell
+        pairs = np.unique(box_idx[overlaps] * len(self) + roi_idx[overlaps])
+        return pairs // len(self), pairs % len(self)
+
+    def _cell_ranges(self, keys):
+        """Start and end of the entries of the grid cells with the given keys"""
+        if self._cell_start is not None:
+            return self._cell_start[keys], self._cell_start[keys + 1]
+        return np.searchsorted(self._keys, keys, 'left'), np.searchsorted(self._keys, keys, 'right')
+
+    def query_points(self, x, y):
+        """
+        All pairs of points and ROIs containing them, as arrays of point indices and ROI indices, sorted by point and
+        then ROI. Candidates are found in the grid and checked against the bounding boxes before the exact test.
+        """
+        x = np.asarray(x, dtype=np.float64).reshape(-1)
+        y = np.asarray(y, dtype=np.float64).reshape(-1)
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        row, col = self._cells(y, x)
+        in_grid = (row >= 0) & (row < self.shape[0]) & (col >= 0) & (col < self.shape[1])
+        lo, hi = self._cell_ranges(np.where(in_grid, row * self.shape[1] + col, 0))
+        hi = np.where(in_grid, hi, lo)
+
+        positions, point_idx = segment_indices(lo, hi - lo)
+        roi_idx = self._roi_idx[positions]
+        rois = self.rois
+        px, py = x[point_idx], y[point_idx]
+        in_bbox = (px >= rois.left[roi_idx]) & (px < rois.right[roi_idx]) & \
+                  (py >= rois.top[roi_idx]) & (py < rois.bottom[roi_idx])
+        point_idx, roi_idx = point_idx[in_bbox], roi_idx[in_bbox]
+
+        # Pairs are already ordered by point and, as the ROIs in each cell are in index order, by ROI
+        inside = contains(rois, roi_idx, x[point_idx], y[point_idx])
+        return point_idx[inside], roi_idx[inside]
+
+    def query_point(self, x, y):
+        """Sorted indices of the ROIs containing the point x, y"""
+        return self.query_points([x], [y])[1]
+
+    def nearest(self, x, y, k=1):
+        """
+        Indices of the k ROIs with their centroid nearest to the point x, y, ordered by distance. The search is done in
+        growing squares around the point until the k nearest ROIs are certain to be found.
+        """
+        if self._centroid is None:
+            self._centroid = self.rois.centroid
+        k = min(k, len(self))
+        half_size = self.cell_size
+        while True:
+            candidates = self.query_bbox(y - half_size, x - half_size, y + half_size, x + half_size)
+            distance = np.hypot(self._centroid[candidates, 0] - x, self._centroid[candidates, 1] - y)
+            order = np.argsort(distance, kind='stable')[:k]
+            # ROIs with a centroid within half_size of the point have a bounding box overlapping the square
+            if len(candidates) == len(self) or (len(order) == k and (k == 0 or distance[order[-1]] <= half_size)):
+                return candidates[order]
+            half_size *= 2
+
+
+def _assign_chunk(index, points):
+    """ROI index per point for one chunk of points, see assign_points"""
+    point_idx, roi_idx = index.query_points(points[:, 0], points[:, 1])
+    assigned = np.full(len(points), -1, dtype=np.int64)
+    if len(point_idx) == 0:
+        return assigned
+    # Pairs are ordered by point and ROI, keep the last (topmost) ROI of every point
+    last = np.r_[point_idx[1:] != point_idx[:-1], True]
+    assigned[point_idx[last]] = roi_idx[last]
+    return assigned
+
+
+def assign_points(points, rois, workers=1, chunksize=1000000, cell_size=None):
+    """
+    Index of the ROI containing each of the points, an (n, 2) array of x, y coordinates. Points outside all ROIs get
+    -1, points in overlapping ROIs get the last of these ROIs (the one drawn on top, as in rasterize).
+
+    rois is a list of ROI objects, an ROICollection or an ROIIndex. Candidates are found with the bounding boxes in an
+    ROIIndex and tested exactly with contains. Points are processed in chunks of chunksize points, with workers > 1
+    (None for the number of CPUs) the chunks are divided over a process pool.
+    """
+    index = rois if isinstance(rois, ROIIndex) else ROIIndex(rois, cell_size=cell_size)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    chunks = [points[i:i + chunksize] for i in range(0, len(points), chunksize)]
+    assign_chunk = partial(_assign_chunk, index)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(chunks) <= 1:
+        results = [assign_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(assign_chunk, chunks))
+
+    return np.concatenate(results) if results else np.empty(0, dtype=np.int64)
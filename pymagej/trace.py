@@ -0,0 +1,145 @@
+"""
+PymageJ Copyright (C) 2015 Jochem Smit
+
+This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public License
+ as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+ of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program; if not, write to the
+Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import numpy as np
+
+from pymagej.roi import ROITraced, ROIPolygon
+from pymagej.geometry import signed_areas
+
+
+# Outlines are traced along pixel edges like ImageJ's wand tool, so vertices are at pixel corners and the outline
+# rasterizes back to exactly the traced pixels. Every boundary edge of every label is a directed edge with the label on
+# its right hand side, all edges are linked to the next edge of the same outline at once and the outlines are then
+# ordered with pointer jumping, so there is no Python loop over pixels or labels.
+
+# Start and end corner (dx, dy) relative to the pixel's top left corner of the top, right, bottom and left pixel edges
+_EDGE_CORNERS = [((0, 0), (1, 0)), ((1, 0), (1, 1)), ((1, 1), (0, 1)), ((0, 1), (0, 0))]
+
+
+def _boundary_edges(labels):
+    """Directed boundary edges of all labels as arrays of start x, y, end x, y, direction, label index and pixel"""
+    height, width = labels.shape
+    padded = np.pad(labels, 1)
+    center = padded[1:-1, 1:-1]
+    neighbours = [padded[:-2, 1:-1], padded[1:-1, 2:], padded[2:, 1:-1], padded[1:-1, :-2]]
+
+    parts = []
+    for direction, (neighbour, (start, end)) in enumerate(zip(neighbours, _EDGE_CORNERS)):
+        rows, cols = np.nonzero((center != 0) & (center != neighbour))
+        parts.append((cols + start[0], rows + start[1], cols + end[0], rows + end[1],
+                      np.full(len(rows), direction, dtype=np.int8), center[rows, cols], rows * width + cols))
+
+    return [np.concatenate(arrays) for arrays in zip(*parts)]
+
+
+def _successors(x0, y0, x1, y1, label_index, pixel, n_labels, width, connectivity):
+    """Index of the next edge along the outline for every edge"""
+    out_keys = (y0 * (width + 1) + x0) * n_labels + label_index
+    in_keys = (y1 * (width + 1) + x1) * n_labels + label_index
+    order = np.argsort(out_keys, kind='stable')
+    sorted_keys = out_keys[order]
+
+    # Corners where two diagonal pixels of a label meet have two outgoing edges, the outline continues along the other
+    # pixel if they are connected (8-connectivity) or around the same pixel if not.
+    pos = np.searchsorted(sorted_keys, in_keys)
+    successor = order[pos]
+    second = np.minimum(pos + 1, len(order) - 1)
+    ambiguous = (pos + 1 < len(order)) & (sorted_keys[second] == in_keys)
+    same_pixel = pixel[successor] == pixel
+    switch = ambiguous & (same_pixel if connectivity == 8 else ~same_pixel)
+    successor[switch] = order[second[switch]]
+    return successor
+
+
+def _order_outlines(successor):
+    """Outline id (its lowest edge index) and the order of all edges sorted by outline and position along it"""
+    n = len(successor)
+    steps = int(np.ceil(np.log2(max(n, 2))))
+
+    outline = np.arange(n)
+    nxt = successor.copy()
+    for i in range(steps):
+        outline = np.minimum(outline, outline[nxt])
+        nxt = nxt[nxt]
+
+    # Cut each outline before its first edge and rank the edges by their distance to the cut
+    last = outline[successor] == np.arange(n)
+    nxt = np.where(last, np.arange(n), successor)
+    distance = (~last).astype(np.int64)
+    for i in range(steps):
+        distance = distance + distance[nxt]
+        nxt = nxt[nxt]
+
+    return outline, np.lexsort((-distance, outline))
+
+
+def label_image_to_rois(labels, connectivity=8, roi_type='traced'):
+    """
+    Trace the outer boundary of every label in a label image, like ImageJ's wand tool. Zero is background.
+
+    Holes are filled, for labels with multiple disconnected parts the part with the largest area is traced. Pixels of a
+    label touching diagonally are connected for connectivity 8 and not for 4. Returns a list of ROITraced or ROIPolygon
+    objects (roi_type 'traced' or 'polygon') named after their label, ordered by label.
+    """
+    labels = np.asarray(labels)
+    if labels.ndim != 2:
+        raise ValueError('Expected a label image (y, x), got %i dimensions' % labels.ndim)
+    if connectivity not in (4, 8):
+        raise ValueError('Connectivity must be 4 or 8, got %s' % connectivity)
+    roi_class = {'traced': ROITraced, 'polygon': ROIPolygon}[roi_type]
+
+    values, label_index = np.unique(labels, return_inverse=True)
+    label_index = label_index.reshape(labels.shape).astype(np.int64)
+    # Index 0 is the background, labels are numbered from 1 in sorted order with the background (if any) left out
+    background = np.flatnonzero(values == 0)
+    if len(background):
+        values = np.delete(values, background[0])
+        label_index = np.where(label_index == background[0], 0, label_index + (label_index < background[0]))
+    else:
+        label_index += 1
+    if len(values) == 0:
+        return []
+
+    x0, y0, x1, y1, direction, edge_label, pixel = _boundary_edges(label_index)
+    successor = _successors(x0, y0, x1, y1, edge_label, pixel, len(values) + 1, labels.shape[1], connectivity)
+    outline, order = _order_outlines(successor)
+    x0, y0, direction, outline, edge_label = x0[order], y0[order], direction[order], outline[order], edge_label[order]
+
+    # Only keep corners, where the direction of the outline changes
+    starts = np.flatnonzero(np.r_[True, outline[1:] != outline[:-1]])
+    previous = np.arange(-1, len(order) - 1)
+    previous[starts] = np.r_[starts[1:], len(order)] - 1
+    corner = direction != direction[previous]
+    x, y = x0[corner], y0[corner]
+    offsets = np.r_[0, np.cumsum(np.add.reduceat(corner, starts))]
+    outline_label = edge_label[starts]
+
+    # Outer boundaries run clockwise, holes anticlockwise. Pick the largest outer boundary of every label.
+    area = signed_areas(x, y, offsets)
+    outer = np.flatnonzero(area > 0)
+    outer = outer[np.lexsort((-area[outer], outline_label[outer]))]
+    first = np.r_[True, outline_label[outer][1:] != outline_label[outer][:-1]]
+    selected = outer[first]
+
+    lefts = np.minimum.reduceat(x, offsets[:-1])[selected]
+    tops = np.minimum.reduceat(y, offsets[:-1])[selected]
+    rights = np.maximum.reduceat(x, offsets[:-1])[selected]
+    bottoms = np.maximum.reduceat(y, offsets[:-1])[selected]
+
+    rois = []
+    for i, top, left, bottom, right in zip(selected, tops, lefts, bottoms, rights):
+        segment = slice(offsets[i], offsets[i + 1])
+        rois.append(roi_class(int(top), int(left), int(bottom), int(right), x[segment] - left, y[segment] - top,
+                              name=str(values[outline_label[i] - 1])))
+
+    return rois
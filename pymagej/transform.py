@@ -0,0 +1,119 @@
+"""
+PymageJ Copyright (C) 2015 Jochem Smit
+
+This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public License
+ as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+ of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program; if not, write to the
+Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import numpy as np
+
+from pymagej.roi import ROIFileObject
+from pymagej.collection import ROICollection
+
+
+# Coordinates in .roi files are stored as 16 bit integers
+INT16_MIN, INT16_MAX = -2**15, 2**15 - 1
+
+
+def _as_matrices(matrices_or_shifts):
+    """Affine matrices of shape (..., 2, 3) from shifts (..., 2) or matrices (..., 2, 3) or (..., 3, 3)"""
+    values = np.asarray(matrices_or_shifts, dtype=np.float64)
+    if values.shape[-1] == 2 and values.ndim <= 2:
+        matrices = np.zeros(values.shape[:-1] + (2, 3))
+        matrices[..., 0, 0] = matrices[..., 1, 1] = 1
+        matrices[..., :, 2] = values
+        return matrices
+    elif values.ndim >= 2 and values.shape[-2:] in [(2, 3), (3, 3)]:
+        return values[..., :2, :]
+    raise ValueError('Expected shifts (..., 2) or affine matrices (..., 2, 3) or (..., 3, 3), got shape %s' %
+                     (values.shape,))
+
+
+def _per_roi(matrices, rois, by):
+    """Matrix for every ROI, matrices is a single matrix, one per ROI (by='roi') or one per position along by"""
+    n = len(rois)
+    if matrices.ndim == 2:
+        return np.broadcast_to(matrices, (n, 2, 3))
+    if by == 'roi':
+        if len(matrices) != n:
+            raise ValueError('Expected %i matrices, one per ROI, got %i' % (n, len(matrices)))
+        return matrices
+
+    # Per frame matrices, ROIs without a position along by are not transformed
+    position = getattr(rois, by + '_position').astype(np.int64)
+    position = np.where(position > 0, position, rois.position)
+    if position.max(initial=0) > len(matrices):
+        raise ValueError('ROIs at position %i along %s, got %i matrices' % (position.max(), by, len(matrices)))
+    identity = np.array([[1., 0., 0.], [0., 1., 0.]])
+    return np.concatenate([identity[np.newaxis], matrices])[position]
+
+
+def _apply(matrices, x, y):
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    return matrices[:, 0, 0] * x + matrices[:, 0, 1] * y + matrices[:, 0, 2], \
+        matrices[:, 1, 0] * x + matrices[:, 1, 1] * y + matrices[:, 1, 2]
+
+
+def transform(rois, matrices_or_shifts, by='roi'):
+    """
+    Apply translations or affine transforms to the coordinates of many ROIs at once.
+
+    matrices_or_shifts are shifts (dx, dy) or affine matrices (2 x 3, or 3 x 3 homogeneous) mapping image coordinates
+    (x, y, 1) to new coordinates. Pass a single shift or matrix for all ROIs, one per ROI (by='roi') or one per frame
+    (by='t', 'z' or 'c'), where the matrix for an ROI is selected by its 1-based position along that dimension (see
+    measure.roi_position). ROIs without a position are not transformed.
+
+    Vertices and line endpoints are transformed and the bounding boxes of ROIs with vertices are recomputed. Rects and
+    ovals stay axis aligned: their bounding box becomes the (rounded) bounding box of their transformed corners and the
+    arc of rounded rects is scaled. ROIs whose vertices are no longer integer become subpixel ROIs. A ValueError is
+    raised if a bounding box is outside of the 16 bit range of .roi files.
+
+    rois is a list of ROI objects or an ROICollection, the result is of the same kind.
+    """
+    is_collection = isinstance(rois, ROICollection)
+    rois = ROICollection.from_rois(rois)
+    matrices = _per_roi(_as_matrices(matrices_or_shifts), rois, by)
+
+    roi_idx = np.repeat(np.arange(len(rois)), rois.lengths)
+    x, y = _apply(matrices[roi_idx], rois.x, rois.y)
+
+    top, left, bottom, right = [c.astype(np.float64) for c in (rois.top, rois.left, rois.bottom, rois.right)]
+    has_vertices = rois.lengths > 0
+    starts = rois.offsets[:-1][has_vertices]
+    if len(starts):
+        left[has_vertices] = np.floor(np.minimum.reduceat(x, starts))
+        top[has_vertices] = np.floor(np.minimum.reduceat(y, starts))
+        right[has_vertices] = np.ceil(np.maximum.reduceat(x, starts))
+        bottom[has_vertices] = np.ceil(np.maximum.reduceat(y, starts))
+
+    # Bounding box of the transformed corners of rects and ovals
+    is_box = np.isin(rois.types, [ROIFileObject.roi_types_rev['rect'], ROIFileObject.roi_types_rev['oval']])
+    box = matrices[is_box]
+    corners = [_apply(box, cx, cy) for cx, cy in [(left[is_box], top[is_box]), (right[is_box], top[is_box]),
+                                                  (left[is_box], bottom[is_box]), (right[is_box], bottom[is_box])]]
+    corner_x, corner_y = np.array([c[0] for c in corners]), np.array([c[1] for c in corners])
+    left[is_box], right[is_box] = np.round(corner_x.min(axis=0)), np.round(corner_x.max(axis=0))
+    top[is_box], bottom[is_box] = np.round(corner_y.min(axis=0)), np.round(corner_y.max(axis=0))
+    scale = np.sqrt(np.abs(matrices[:, 0, 0] * matrices[:, 1, 1] - matrices[:, 0, 1] * matrices[:, 1, 0]))
+    arc = np.round(rois.arc * scale)
+
+    bounds = np.stack([top, left, bottom, right])
+    if len(rois) and (bounds.min() < INT16_MIN or bounds.max() > INT16_MAX):
+        raise ValueError('Transformed ROIs are outside of the 16 bit coordinate range of .roi files')
+
+    x, y = x.astype(np.float32), y.astype(np.float32)
+    non_integer = (x != np.round(x)) | (y != np.round(y))
+    subpixel = rois.subpixel.copy()
+    if len(non_integer):
+        subpixel |= np.bincount(roi_idx[non_integer], minlength=len(rois)) > 0
+
+    columns = {k: getattr(rois, k) for k in rois.columns}
+    columns.update(top=top, left=left, bottom=bottom, right=right, arc=arc, subpixel=subpixel)
+    result = ROICollection(x=x, y=y, offsets=rois.offsets, **columns)
+    return result if is_collection else list(result)
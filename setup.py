@@ -8,6 +8,7 @@ setup(
     author_email='jhsmit@mgail.com',
     url='https://github.com/Jhsmit/PymageJ/',
     packages=['pymagej'],
+    extras_require={'scipy': ['scipy']},
     license='GNU',
     classifiers=[
         'Development Status :: 3 - Alpha',
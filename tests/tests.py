@@ -13,10 +13,28 @@ Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 0211
 
 import numpy as np
 import unittest
+import warnings
 import tempfile
 import os
+import zipfile
 
-from pymagej.roi import ROIEncoder, ROIDecoder, ROIRect, ROIFreehand, ROIOval, ROIPolygon, ROILine, ROIPolyline
+from pymagej.roi import ROIEncoder, ROIDecoder, ROIRect, ROIFreehand, ROIOval, ROIPolygon, ROILine, ROIPolyline, \
+    ROITraced, ROIComposite, RoiSetReader, RoiSetWriter, RoiSetEditor, encode_to_bytes, decode_many, scan_headers, \
+    simplify_rois
+from pymagej.collection import ROICollection, save_cache, load_cache
+from pymagej.mask import rasterize, rasterize_tiles, MaskCache
+from pymagej.geometry import areas, perimeters, centroids, simplify, decode_path, encode_path
+from pymagej.measure import measure, profile
+from pymagej.trace import label_image_to_rois
+from pymagej.spatial import ROIIndex, assign_points, contains
+from pymagej.overlap import iou_pairs, iou_matrix, match_rois
+from pymagej.positions import PositionIndex, position_index
+from pymagej.transform import transform
+
+try:
+    import scipy
+except ImportError:
+    scipy = None
 
 directory = os.path.dirname(__file__)
 
@@ -57,6 +75,37 @@ class ROITest(unittest.TestCase):
         self.assertEqual(roi_obj.right, 114)
         self.assertEqual(roi_obj.area, 6270)
 
+    def test_decoder_header(self):
+        with ROIDecoder(os.path.join(directory, 'polygon.roi')) as roi:
+            roi.read_header()
+            header = roi.header
+
+        self.assertEqual(header['MAGIC'], b'Iout')
+        self.assertEqual(header['TYPE'], 0)
+        self.assertEqual(header['N_COORDINATES'], 6)
+        self.assertEqual(header['HEADER2_OFFSET'], 136)
+        self.assertEqual(header['XD'], header['X1'])
+        self.assertEqual(header['NAME_OFFSET'], 200)
+        self.assertEqual(header['NAME_LENGTH'], 8)
+
+    def test_decoder_compact(self):
+        with ROIDecoder(os.path.join(directory, 'polygon.roi'), compact=True) as roi:
+            roi_obj = roi.get_roi()
+        with ROIDecoder(os.path.join(directory, 'polygon.roi')) as roi:
+            header = roi.get_roi().header
+
+        self.assertFalse(hasattr(roi_obj, '__dict__'))
+        self.assertNotIsInstance(roi_obj.header, dict)
+        self.assertEqual(roi_obj.header['N_COORDINATES'], 6)
+        self.assertEqual(roi_obj.header['NAME_LENGTH'], 8)
+        self.assertRaises(KeyError, roi_obj.header.__getitem__, 'COORDINATES')
+        self.assertEqual(dict(roi_obj.header), header)
+
+        buffer = bytearray(open(os.path.join(directory, 'polygon.roi'), 'rb').read())
+        buffer[ROIDecoder.header2_fields[5][2] + roi_obj.header['HEADER2_OFFSET'] + 3] = 7  # OVERLAY_LABEL_COLOR
+        with ROIDecoder.from_bytes(bytes(buffer), compact=True) as roi:
+            self.assertEqual(roi.get_roi().header['OVERLAY_LABEL_COLOR'], roi.header['OVERLAY_LABEL_COLOR'])
+
     def test_encoder_rect(self):
         roi_obj = ROIRect(20, 30, 40, 50, name='rect_test')
         temp_path = tempfile.mkstemp()[1]
@@ -114,6 +163,24 @@ class ROITest(unittest.TestCase):
         self.assertTrue(np.allclose([6, 0, 35, 51, 25, 14], roi_obj.x_coords))
         self.assertTrue(np.allclose([14, 44, 42, 17, 1, 0], roi_obj.y_coords))
 
+    def test_decoder_polygon_dtype(self):
+        with ROIDecoder(os.path.join(directory, 'polygon.roi')) as roi:
+            roi_obj = roi.get_roi()
+        self.assertEqual(roi_obj.x_coords.dtype, np.dtype('>i2'))
+
+        with ROIDecoder(os.path.join(directory, 'polygon.roi'), dtype=np.int32) as roi:
+            roi_obj = roi.get_roi()
+        self.assertEqual(roi_obj.x_coords.dtype, np.dtype(np.int32))
+        self.assertTrue(np.allclose([6, 0, 35, 51, 25, 14], roi_obj.x_coords))
+
+    def test_decoder_polygon_subpixel(self):
+        with ROIDecoder(os.path.join(directory, 'polygon.roi'), subpixel=True) as roi:
+            roi_obj = roi.get_roi()
+
+        self.assertEqual(roi_obj.x_coords.dtype, np.dtype(np.float32))
+        self.assertTrue(np.allclose([6, 0.5, 35, 51.75, 25.75, 14.75], roi_obj.x_coords))
+        self.assertTrue(np.allclose([14.75, 45, 42.75, 17.25, 1.25, 0.75], roi_obj.y_coords))
+
     def test_encoder_polygon(self):
         y_coords = np.array([45, 30, 0, 12, 20])
         x_coords = np.array([0, 13, 25, 60, 5])
@@ -140,6 +207,23 @@ class ROITest(unittest.TestCase):
         self.assertTrue(np.allclose(y_coords, roi_obj.y_coords))
         self.assertEqual('polygon_test', roi_obj.name)
 
+    def test_decoder_legacy_name(self):
+        # Written by the previous encoder, which interleaved the name with spaces
+        path = os.path.join(directory, 'legacy_name.roi')
+        with ROIDecoder(path) as roi:
+            self.assertEqual(roi.get_roi().name, 'cell_1')
+        self.assertEqual(list(scan_headers([path], names=True)['NAME']), ['cell_1'])
+
+    def test_encoder_coords_range(self):
+        roi_obj = ROIPolygon(0, 0, 10, 100, np.array([0, 40000, 0]), np.array([0, 0, 10]))
+        self.assertRaises(ValueError, encode_to_bytes, roi_obj)
+        roi_obj = ROIPolygon(0, 0, 10, 100, np.array([0, 40000.5, 0]), np.array([0, 0, 10.]))
+        self.assertRaises(ValueError, encode_to_bytes, roi_obj)
+        self.assertRaises(ValueError, encode_to_bytes, ROIRect(0, 0, 10, 40000))
+        self.assertRaises(ValueError, encode_to_bytes, ROIOval(-40000, 0, 10, 10))
+        roi_obj = ROIPolygon(0, 40000, 10, 40100, np.array([0, 100, 0]), np.array([0, 0, 10]))
+        self.assertRaises(ValueError, encode_to_bytes, roi_obj)
+
     def test_decoder_line(self):
         with ROIDecoder(os.path.join(directory, 'line.roi')) as roi:
             roi_obj = roi.get_roi()
@@ -198,5 +282,754 @@ class ROITest(unittest.TestCase):
         os.remove(temp_path)
 
 
+class RoiSetTest(unittest.TestCase):
+    names = ['freehand', 'line', 'oval', 'polygon', 'polyline', 'rect']
+
+    def setUp(self):
+        self.zip_path = tempfile.mkstemp(suffix='.zip')[1]
+        with zipfile.ZipFile(self.zip_path, 'w') as zip_obj:
+            for name in self.names:
+                zip_obj.write(os.path.join(directory, name + '.roi'), name + '.roi')
+
+    def tearDown(self):
+        os.remove(self.zip_path)
+
+    def test_reader(self):
+        with RoiSetReader(self.zip_path) as roi_set:
+            self.assertEqual(len(roi_set), 6)
+            self.assertEqual(roi_set.names, self.names)
+            roi_objs = list(roi_set)
+            self.assertIsInstance(roi_set['oval'], ROIOval)
+            self.assertIsInstance(roi_set['rect.roi'], ROIRect)
+            self.assertIn('polygon', roi_set)
+            self.assertRaises(KeyError, roi_set.__getitem__, 'traced')
+
+        self.assertEqual([type(r) for r in roi_objs],
+                         [ROIFreehand, ROILine, ROIOval, ROIPolygon, ROIPolyline, ROIRect])
+        self.assertEqual(roi_objs[3].top, 81)
+        self.assertEqual(roi_objs[1].name, 'line')
+
+    def test_writer(self):
+        with RoiSetReader(self.zip_path) as roi_set:
+            roi_objs = list(roi_set)
+
+        out_path = tempfile.mkstemp(suffix='.zip')[1]
+        with RoiSetWriter(out_path) as roi_set:
+            names = roi_set.write_all(iter(roi_objs))
+            names.append(roi_set.write(ROIRect(1, 2, 3, 4)))
+            names.append(roi_set.write(ROIRect(1, 2, 3, 4, name='line')))
+
+        self.assertEqual(names, [r.name for r in roi_objs] + ['0007', 'line-1'])
+        with RoiSetReader(out_path) as roi_set:
+            self.assertEqual(roi_set.names, names)
+            self.assertTrue(np.allclose(roi_set[roi_objs[3].name].x_coords, roi_objs[3].x_coords))
+            self.assertEqual(roi_set['line-1'].bottom, 3)
+        os.remove(out_path)
+
+    def test_editor(self):
+        with RoiSetEditor(self.zip_path) as roi_set:
+            self.assertEqual(roi_set.write(ROIRect(1, 2, 3, 4, name='line')), 'line-1')
+            roi_set['oval'] = ROIRect(5, 6, 7, 8)
+            del roi_set['polygon']
+            roi_set['new'] = ROIRect(1, 1, 2, 2)
+            self.assertEqual(roi_set['oval'].bottom, 7)
+            self.assertNotIn('polygon', roi_set)
+            self.assertEqual(roi_set.write(ROIRect(1, 2, 3, 4), name='polygon'), 'polygon-1')
+
+        with RoiSetReader(self.zip_path) as roi_set:
+            self.assertEqual(roi_set.names, ['freehand', 'line', 'oval', 'polyline', 'rect', 'line-1', 'new',
+                                             'polygon-1'])
+            self.assertIsInstance(roi_set['oval'], ROIRect)
+            self.assertEqual(len(roi_set['freehand'].x_coords), 117)
+            self.assertEqual(roi_set['polyline'].top, 59)
+        with zipfile.ZipFile(self.zip_path) as zip_obj:
+            self.assertIsNone(zip_obj.testzip())
+
+        # Changes are discarded on exceptions
+        with self.assertRaises(ValueError):
+            with RoiSetEditor(self.zip_path) as roi_set:
+                del roi_set['freehand']
+                roi_set.write(ROIRect(1, 2, 3, 4), name='appended')
+                raise ValueError
+        with RoiSetReader(self.zip_path) as roi_set:
+            self.assertIn('freehand', roi_set)
+            self.assertNotIn('appended', roi_set)
+
+        # A replacement larger than the entry it replaces moves the entries after it
+        x = np.arange(500, dtype=float)
+        with RoiSetEditor(self.zip_path) as roi_set:
+            roi_set['line'] = ROIPolygon(0, 0, 20, 500, x, (x % 20), name='line')
+        with RoiSetReader(self.zip_path) as roi_set:
+            self.assertEqual(len(roi_set['line'].x_coords), 500)
+            self.assertEqual(len(roi_set['freehand'].x_coords), 117)
+            self.assertEqual(roi_set['polyline'].top, 59)
+        with zipfile.ZipFile(self.zip_path) as zip_obj:
+            self.assertIsNone(zip_obj.testzip())
+
+    def test_encode_to_bytes(self):
+        with open(os.path.join(directory, 'oval.roi'), 'rb') as f_obj:
+            data = f_obj.read()
+        roi_obj = ROIDecoder.from_bytes(data).get_roi()
+        encoded = encode_to_bytes(roi_obj)
+
+        self.assertIsInstance(encoded, bytearray)
+        roi_out = ROIDecoder.from_bytes(encoded).get_roi()
+        self.assertEqual((roi_out.top, roi_out.left, roi_out.bottom, roi_out.right), (57, 25, 98, 115))
+        self.assertEqual(roi_out.name, roi_obj.name)
+
+    def test_scan_headers(self):
+        roi_objs = read_test_rois(self.names)
+        headers = scan_headers(self.zip_path, names=True)
+
+        self.assertEqual(list(headers['NAME']), [r.name for r in roi_objs])
+        self.assertEqual(list(headers['TYPE']), [r.header['TYPE'] for r in roi_objs])
+        self.assertEqual(list(headers['N_COORDINATES']), [117, 0, 0, 6, 8, 0])
+        self.assertEqual(list(headers['TOP']), [r.header['TOP'] for r in roi_objs])
+        self.assertEqual(list(headers['NAME_OFFSET']), [r.header['NAME_OFFSET'] for r in roi_objs])
+        self.assertEqual(headers['X1'][1], 134.75)
+
+        paths = [os.path.join(directory, name + '.roi') for name in self.names]
+        headers_paths = scan_headers(paths)
+        self.assertNotIn('NAME', headers_paths.dtype.names)
+        self.assertTrue(np.array_equal(headers_paths['HEADER2_OFFSET'], headers['HEADER2_OFFSET']))
+
+    def test_reader_mmap(self):
+        stored_path = tempfile.mkstemp(suffix='.zip')[1]
+        with zipfile.ZipFile(stored_path, 'w', compression=zipfile.ZIP_STORED) as zip_obj:
+            for name in self.names:
+                zip_obj.write(os.path.join(directory, name + '.roi'), name + '.roi')
+
+        for path in [stored_path, self.zip_path]:
+            with RoiSetReader(path, use_mmap=True) as roi_set:
+                roi_objs = list(roi_set)
+            self.assertTrue(np.array_equal(roi_objs[0].x_coords, read_test_rois(['freehand'])[0].x_coords))
+            self.assertEqual(roi_objs[3].name, 'new_poly')
+            self.assertFalse(roi_objs[0].x_coords.flags.owndata)
+
+        roi_objs, errors = decode_many(stored_path, workers=1, use_mmap=True)
+        self.assertEqual(len(roi_objs), 6)
+        self.assertEqual(errors, {})
+        os.remove(stored_path)
+
+        with ROIDecoder(os.path.join(directory, 'polygon.roi'), use_mmap=True) as roi:
+            roi_obj = roi.get_roi()
+        self.assertTrue(np.allclose([6, 0, 35, 51, 25, 14], roi_obj.x_coords))
+
+
+class DecodeManyTest(unittest.TestCase):
+    names = ['freehand', 'line', 'oval', 'polygon', 'polyline', 'rect']
+    types = [ROIFreehand, ROILine, ROIOval, ROIPolygon, ROIPolyline, ROIRect]
+
+    def test_decode_paths(self):
+        paths = [os.path.join(directory, name + '.roi') for name in self.names]
+        paths.insert(2, os.path.join(directory, 'tests.py'))
+        roi_objs, errors = decode_many(paths, workers=2, chunksize=2)
+
+        self.assertEqual(len(roi_objs), 7)
+        self.assertIsNone(roi_objs[2])
+        self.assertEqual(list(errors), [paths[2]])
+        self.assertEqual([type(r) for r in roi_objs[:2] + roi_objs[3:]], self.types)
+
+    def test_decode_zip(self):
+        zip_path = tempfile.mkstemp(suffix='.zip')[1]
+        with zipfile.ZipFile(zip_path, 'w') as zip_obj:
+            for name in self.names:
+                zip_obj.write(os.path.join(directory, name + '.roi'), name + '.roi')
+
+        roi_objs, errors = decode_many(zip_path, workers=2, chunksize=1)
+        os.remove(zip_path)
+
+        self.assertEqual(errors, {})
+        self.assertEqual([type(r) for r in roi_objs], self.types)
+
+    def test_decode_compact_mmap(self):
+        # Compact headers on memory-mapped buffers are sent back from the worker processes
+        zip_path = tempfile.mkstemp(suffix='.zip')[1]
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_obj:
+            for name in self.names:
+                zip_obj.write(os.path.join(directory, name + '.roi'), name + '.roi')
+        paths = [os.path.join(directory, name + '.roi') for name in self.names]
+
+        for items in [zip_path, paths]:
+            roi_objs, errors = decode_many(items, workers=2, chunksize=1, compact=True, use_mmap=True)
+            self.assertEqual(errors, {})
+            self.assertEqual([type(r) for r in roi_objs], self.types)
+            self.assertEqual([dict(r.header) for r in roi_objs], [r.header for r in read_test_rois()])
+        os.remove(zip_path)
+
+    def test_decode_bytes(self):
+        data = []
+        for name in self.names:
+            with open(os.path.join(directory, name + '.roi'), 'rb') as f_obj:
+                data.append(f_obj.read())
+        data.append(b'')
+
+        roi_objs, errors = decode_many(data, workers=2, chunksize=1)
+        self.assertEqual([type(r) for r in roi_objs[:-1]], self.types)
+        self.assertEqual(list(errors), [6])
+
+
+def read_test_rois(names=('freehand', 'line', 'oval', 'polygon', 'polyline', 'rect')):
+    roi_objs = []
+    for name in names:
+        with ROIDecoder(os.path.join(directory, name + '.roi')) as roi:
+            roi_objs.append(roi.get_roi())
+    return roi_objs
+
+
+class CollectionTest(unittest.TestCase):
+    def setUp(self):
+        self.roi_objs = read_test_rois()
+        self.collection = ROICollection.from_rois(self.roi_objs)
+
+    def test_columns(self):
+        self.assertEqual(len(self.collection), 6)
+        self.assertEqual(list(self.collection.lengths), [117, 2, 0, 6, 8, 0])
+        self.assertEqual(list(self.collection.bboxes[3]), [81, 34, 126, 86])
+        self.assertEqual(list(self.collection.width[[2, 5]]), [90, 114])
+        self.assertEqual(list(self.collection.names), [r.name for r in self.roi_objs])
+
+    def test_area(self):
+        area = self.collection.area
+        self.assertEqual(area[5], 6270)
+        self.assertAlmostEqual(area[2], self.roi_objs[2].area)
+        self.assertEqual(area[1], 0)
+        x, y = self.roi_objs[3].x_coords.astype(float), self.roi_objs[3].y_coords.astype(float)
+        shoelace = 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+        self.assertAlmostEqual(area[3], shoelace)
+
+    def test_materialize(self):
+        for roi_obj, roi_out in zip(self.roi_objs, self.collection):
+            self.assertIsInstance(roi_out, type(roi_obj))
+            self.assertEqual(roi_out.name, roi_obj.name)
+            if hasattr(roi_obj, 'x_coords'):
+                self.assertEqual(roi_out.top, roi_obj.top)
+                self.assertTrue(np.array_equal(roi_out.x_coords, roi_obj.x_coords))
+                self.assertTrue(np.array_equal(roi_out.y_coords, roi_obj.y_coords))
+        self.assertEqual(self.collection[1].x2, self.roi_objs[1].x2)
+
+    def test_take(self):
+        subset = self.collection.take([3, 0])
+        self.assertEqual(list(subset.lengths), [6, 117])
+        self.assertTrue(np.array_equal(subset[0].x_coords, self.roi_objs[3].x_coords))
+        self.assertTrue(np.array_equal(subset[1].y_coords, self.roi_objs[0].y_coords))
+        self.assertEqual(list(self.collection.in_bbox(120, 30, 130, 40)), [3, 4])
+
+    def test_cache(self):
+        with ROIDecoder(os.path.join(directory, 'polygon.roi'), subpixel=True) as roi:
+            subpixel = roi.get_roi()
+        traced = ROITraced(2, 3, 6, 7, np.array([0, 4, 4, 0]), np.array([0, 0, 4, 4]), name='traced')
+        traced.header = {'T_POSITION': 5, 'STROKE_COLOR': -65536}
+        roi_objs = self.roi_objs + [subpixel, traced, ROIRect(0, 1, 10, 12, arc=3, name='rounded')]
+
+        cache_path = tempfile.mkstemp()[1]
+        save_cache(roi_objs, cache_path)
+        for use_mmap in [True, False]:
+            collection = load_cache(cache_path, use_mmap=use_mmap)
+            self.assertEqual(len(collection), 9)
+            self.assertTrue(np.array_equal(collection.x, ROICollection.from_rois(roi_objs).x))
+            self.assertEqual(list(collection.names), [r.name for r in roi_objs])
+            self.assertEqual(list(collection.t_position), [0] * 7 + [5, 0])
+
+        roi_outs = [ROIDecoder.from_bytes(encode_to_bytes(r), subpixel=True).get_roi() for r in collection]
+        for roi_obj, roi_out in zip(roi_objs, roi_outs):
+            self.assertIsInstance(roi_out, type(roi_obj))
+            self.assertEqual(roi_out.name, roi_obj.name)
+            for attr in ['top', 'left', 'bottom', 'right', 'x1', 'y2', 'arc', 'x_coords', 'y_coords']:
+                if hasattr(roi_obj, attr):
+                    self.assertTrue(np.array_equal(getattr(roi_out, attr), getattr(roi_obj, attr)), attr)
+        self.assertEqual(roi_outs[8].arc, 3)
+        self.assertEqual(roi_outs[7].header['T_POSITION'], 5)
+        self.assertEqual(roi_outs[7].header['STROKE_COLOR'], -65536)
+        os.remove(cache_path)
+
+
+class GeometryTest(unittest.TestCase):
+    def test_polygon_geometry(self):
+        square = ROIPolygon(10, 20, 14, 24, np.array([0, 4, 4, 0]), np.array([0, 0, 4, 4]))
+        self.assertEqual(square.area, 16)
+        self.assertEqual(square.perimeter, 16)
+        self.assertEqual(square.centroid, (22, 12))
+
+        line = ROIPolyline(10, 20, 14, 24, np.array([0, 4, 4]), np.array([0, 0, 4]))
+        self.assertEqual(line.area, 0)
+        self.assertEqual(line.perimeter, 8)
+        self.assertEqual(line.centroid, (23, 11))
+
+        freehand = read_test_rois(['freehand'])[0]
+        self.assertAlmostEqual(freehand.area, freehand.to_mask((300, 300)).sum(), delta=0.05 * freehand.area)
+
+    def test_batched_geometry(self):
+        x = np.array([0, 4, 4, 0, 0, 3, 0, 5, 5], dtype=float)
+        y = np.array([0, 0, 4, 4, 0, 0, 4, 5, 6], dtype=float)
+        offsets = [0, 4, 4, 7, 9]
+
+        self.assertTrue(np.allclose(areas(x, y, offsets), [16, 0, 6, 0]))
+        self.assertTrue(np.allclose(perimeters(x, y, offsets, closed=[True, True, True, False]), [16, 0, 12, 1]))
+        self.assertTrue(np.allclose(centroids(x, y, offsets)[[0, 2, 3]], [[2, 2], [1, 4 / 3.], [5, 5.5]]))
+
+    def test_collection_geometry(self):
+        roi_objs = read_test_rois()
+        collection = ROICollection.from_rois(roi_objs)
+        self.assertTrue(np.allclose(collection.area, [r.area for r in roi_objs]))
+        self.assertTrue(np.allclose(collection.perimeter, [r.perimeter for r in roi_objs]))
+        self.assertTrue(np.allclose(collection.centroid, [r.centroid for r in roi_objs]))
+
+    def test_simplify(self):
+        # Square with collinear and duplicate vertices, line with a small wiggle and a polygon below the tolerance
+        x = np.array([0, 2, 4, 4, 4, 4, 0, 0, 1, 2, 3, 0, 1, 1], dtype=float)
+        y = np.array([0, 0, 0, 2, 4, 4, 4, 0, 0.2, 0, 1, 0, 0, 1], dtype=float)
+        offsets = [0, 7, 11, 14]
+
+        sx, sy, s_offsets = simplify(x, y, offsets, tolerance=0.5, closed=[True, False, True])
+        self.assertEqual(list(s_offsets), [0, 4, 7, 10])
+        self.assertEqual(list(sx[:4]), [0, 4, 4, 0])
+        self.assertEqual(list(sy[:4]), [0, 0, 4, 4])
+        self.assertEqual(list(sx[4:7]), [0, 2, 3])
+        self.assertEqual(list(simplify(x, y, offsets, tolerance=0)[2]), [0, 4, 8, 11])
+
+    def test_simplify_rois(self):
+        roi_objs = read_test_rois(['freehand', 'polyline', 'rect'])
+        simplified = simplify_rois(roi_objs, tolerance=1)
+        self.assertLess(len(simplified[0]), len(roi_objs[0]))
+        self.assertIs(simplified[2], roi_objs[2])
+        for roi_obj, simple in zip(roi_objs, simplified):
+            self.assertEqual((simple.top, simple.left, simple.bottom, simple.right, simple.name),
+                             (roi_obj.top, roi_obj.left, roi_obj.bottom, roi_obj.right, roi_obj.name))
+        self.assertLess(np.sum(roi_objs[0].to_mask((300, 300)) != simplified[0].to_mask((300, 300))),
+                        0.1 * roi_objs[0].area)
+
+        data = encode_to_bytes(roi_objs[0], tolerance=1)
+        self.assertLess(len(data), len(encode_to_bytes(roi_objs[0])))
+        with ROIDecoder.from_bytes(data) as roi:
+            self.assertEqual(len(roi.get_roi()), len(simplified[0]))
+
+        collection = ROICollection.from_rois(roi_objs).simplify(tolerance=1)
+        self.assertEqual(list(collection.lengths), [len(r) for r in simplified[:2]] + [0])
+
+
+def points_in_polygon(px, py, x, y):
+    # Brute force even-odd crossing test as reference
+    inside = np.zeros(len(px), dtype=bool)
+    for x1, y1, x2, y2 in zip(x, y, np.roll(x, -1), np.roll(y, -1)):
+        crosses = (y1 <= py) != (y2 <= py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (px < x_cross)
+    return inside
+
+
+class MaskTest(unittest.TestCase):
+    def test_polygon_mask(self):
+        for name in ['freehand', 'polygon']:
+            roi_obj = read_test_rois([name])[0]
+            shape = (roi_obj.bottom + 5, roi_obj.right + 5)
+            mask = roi_obj.to_mask(shape)
+
+            yy, xx = np.mgrid[:shape[0], :shape[1]]
+            expected = points_in_polygon(xx.ravel() + 0.5, yy.ravel() + 0.5, roi_obj.x_coords + roi_obj.left,
+                                         roi_obj.y_coords + roi_obj.top).reshape(shape)
+            self.assertTrue(np.array_equal(mask, expected))
+
+    def test_rect_oval_mask(self):
+        mask = ROIRect(2, 3, 6, 8).to_mask((10, 10))
+        self.assertEqual(mask.sum(), 20)
+        self.assertTrue(mask[2:6, 3:8].all())
+
+        mask = ROIRect(0, 0, 6, 8, arc=4).to_mask((6, 8))
+        self.assertEqual(mask.sum(), 44)
+        self.assertFalse(mask[0, 0] or mask[-1, -1])
+
+        mask = ROIOval(0, 0, 5, 7).to_mask((6, 8))
+        self.assertEqual(mask.sum(), 31)
+        self.assertFalse(mask[0, 0] or mask[5].any())
+
+    def test_rasterize(self):
+        square = ROIPolygon(1, 1, 5, 5, np.array([0, 4, 4, 0]), np.array([0, 0, 4, 4]))
+        labels = rasterize([square, ROIRect(4, 4, 8, 12)], (8, 10))
+
+        self.assertEqual((labels == 1).sum(), 15)
+        self.assertEqual((labels == 2).sum(), 24)
+        self.assertEqual(labels[4, 4], 2)
+        self.assertEqual(labels[0].sum(), 0)
+
+    def test_rasterize_tiles(self):
+        rois = [roi_obj for roi_obj in read_test_rois() if roi_obj.type not in ['line', 'polyline']]
+        rois += [ROIRect(10, 200, 40, 260, arc=20), ROIOval(150, 150, 190, 230), ROIRect(-5, -5, 30, 30)]
+        expected = rasterize(rois, (300, 250))
+
+        out = np.zeros((300, 250), dtype=np.int32)
+        tiles = list(rasterize_tiles(rois, (300, 250), tile_size=(64, 48), out=out))
+        self.assertTrue(np.array_equal(out, expected))
+        for (top, left), tile in tiles:
+            self.assertTrue(tile.any())
+            self.assertTrue(np.array_equal(tile, expected[top:top + tile.shape[0], left:left + tile.shape[1]]))
+
+        tiles = list(rasterize_tiles(rois, (300, 250), tile_size=100, skip_empty=False, workers=2))
+        self.assertEqual([origin for origin, tile in tiles], [(r, c) for r in [0, 100, 200] for c in [0, 100, 200]])
+        self.assertEqual(tiles[-1][1].shape, (100, 50))
+
+
+class MeasureTest(unittest.TestCase):
+    def test_measure_image(self):
+        image = np.arange(100, dtype=float).reshape(10, 10)
+        rois = [ROIRect(0, 0, 2, 2), ROIRect(8, 8, 12, 12), ROIRect(20, 20, 22, 22)]
+        result = measure(rois, image, stats=('area', 'mean', 'sum', 'min', 'max', 'std'))
+
+        self.assertTrue(np.allclose(result['area'][:2], [4, 4]))
+        self.assertTrue(np.allclose(result['mean'][:2], [5.5, 93.5]))
+        self.assertTrue(np.allclose(result['sum'][:2], [22, 374]))
+        self.assertTrue(np.allclose(result['min'][:2], [0, 88]))
+        self.assertTrue(np.allclose(result['std'][:2], np.std([0, 1, 10, 11], ddof=1)))
+        self.assertTrue(np.isnan(result['mean'][2]))
+
+        # ImageJ reports a standard deviation of 0 for single pixel ROIs
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            result = measure([ROIRect(3, 4, 4, 5)], image, stats=('area', 'mean', 'std'))
+        self.assertEqual((result['area'][0], result['mean'][0], result['std'][0]), (1, 34, 0))
+
+    def test_measure_stack(self):
+        stack = np.arange(3)[:, np.newaxis, np.newaxis] * np.ones((3, 10, 10))
+        roi_all = ROIRect(0, 0, 2, 2)
+        roi_t2 = ROIRect(0, 0, 2, 2)
+        roi_t2.header = {'C_POSITION': 0, 'Z_POSITION': 0, 'T_POSITION': 2, 'POSITION': 0}
+        result = measure([roi_all, roi_t2], stack, stats=('mean',))
+
+        self.assertEqual(result['mean'].shape, (2, 3))
+        self.assertTrue(np.allclose(result['mean'][0], [0, 1, 2]))
+        self.assertTrue(np.isnan(result['mean'][1, [0, 2]]).all())
+        self.assertEqual(result['mean'][1, 1], 1)
+
+        result = measure([roi_all, roi_t2], stack, stats=('mean',), use_positions=False)
+        self.assertTrue(np.allclose(result['mean'][1], [0, 1, 2]))
+
+    def test_profile(self):
+        image = np.arange(100, dtype=float).reshape(10, 10)  # Value is 10 * row + col at pixel centers
+        line = ROILine(0.5, 2.5, 5.5, 2.5)
+        self.assertTrue(np.allclose(profile(line, image), [20, 21, 22, 23, 24, 25]))
+        self.assertTrue(np.allclose(profile(line, image, width=3), [20, 21, 22, 23, 24, 25]))
+        self.assertTrue(np.allclose(profile(ROILine(1, 2.5, 2, 2.5), image), [20.5, 21.5]))
+        self.assertTrue(np.allclose(profile(ROILine(1, 2.5, 2, 2.5), image, order=0), [21, 22]))
+
+        polyline = ROIPolyline(0, 0, 5, 5, np.array([0.5, 3.5, 3.5]), np.array([0.5, 0.5, 4.5]))
+        self.assertTrue(np.allclose(profile(polyline, image), [0, 1, 2, 3, 13, 23, 33, 43]))
+        self.assertTrue(np.isnan(profile(ROILine(-2, 0.5, 2, 0.5), image)[:2]).all())
+
+        stack = np.stack([image + i for i in range(3)])
+        profiles = profile([line, polyline], stack)
+        self.assertEqual([p.shape for p in profiles], [(3, 6), (3, 8)])
+        self.assertTrue(np.allclose(profiles[0][2], [22, 23, 24, 25, 26, 27]))
+        self.assertRaises(NotImplementedError, profile, ROIRect(0, 0, 2, 2), image)
+
+    def test_mask_cache(self):
+        cache = MaskCache(max_bytes=30)
+        image = np.ones((10, 10))
+        rois = [ROIRect(0, 0, 4, 4), ROIRect(0, 0, 4, 4, name='same_geometry'), ROIOval(2, 2, 7, 7)]
+
+        result = measure(rois, image, stats=('sum',), cache=cache)
+        self.assertTrue(np.allclose(result['sum'], [16, 16, ROIOval(2, 2, 7, 7).to_mask((10, 10)).sum()]))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(cache.nbytes, 25)  # Rect mask evicted
+        self.assertEqual(len(cache), 1)
+
+        cache.max_bytes = 100
+        measure(rois, image, stats=('sum',), cache=cache)
+        self.assertEqual(cache.stats, {'hits': 3, 'misses': 3, 'entries': 2, 'nbytes': 41})
+        self.assertTrue(np.array_equal(cache.to_mask(rois[2], (10, 10)), rois[2].to_mask((10, 10))))
+
+        # ROIs outside the image are not cached
+        self.assertEqual(cache.get(ROIRect(20, 20, 25, 25), (10, 10)), (None, None))
+        self.assertEqual(cache.stats, {'hits': 4, 'misses': 4, 'entries': 2, 'nbytes': 41})
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.labels = np.zeros((20, 20), dtype=np.int32)
+        self.labels[2:6, 3:9] = 5
+        self.labels[4, 4] = 0  # Hole
+        self.labels[10:15, 10:12] = 7
+        self.labels[12, 12:15] = 7
+        self.labels[0, 19] = 9  # Diagonally connected pixels
+        self.labels[1, 18] = 9
+
+    def test_label_image_to_rois(self):
+        rois = label_image_to_rois(self.labels)
+        self.assertEqual([roi_obj.name for roi_obj in rois], ['5', '7', '9'])
+        self.assertTrue(all(isinstance(roi_obj, ROITraced) for roi_obj in rois))
+        self.assertEqual([(r.top, r.left, r.bottom, r.right) for r in rois],
+                         [(2, 3, 6, 9), (10, 10, 15, 15), (0, 18, 2, 20)])
+        self.assertEqual([len(roi_obj) for roi_obj in rois], [4, 8, 8])  # Only corners
+
+        expected = np.where(self.labels == 0, 0, np.searchsorted([0, 5, 7, 9], self.labels))
+        expected[4, 4] = 1  # Holes are filled
+        self.assertTrue(np.array_equal(rasterize(rois, self.labels.shape), expected))
+
+        with ROIDecoder.from_bytes(encode_to_bytes(rois[1])) as roi:
+            roi_obj = roi.get_roi()
+        self.assertIsInstance(roi_obj, ROITraced)
+        self.assertTrue(np.array_equal(roi_obj.x_coords, rois[1].x_coords))
+
+    def test_connectivity(self):
+        rois = label_image_to_rois(self.labels, connectivity=4, roi_type='polygon')
+        self.assertIsInstance(rois[0], ROIPolygon)
+        self.assertEqual([roi_obj.area for roi_obj in rois], [24, 13, 1])
+
+    def test_negative_labels(self):
+        labels = np.array([[-1, -1, 0, 0], [-1, -1, 0, 2], [0, 0, 0, 2]])
+        rois = label_image_to_rois(labels)
+        self.assertEqual([roi_obj.name for roi_obj in rois], ['-1', '2'])
+        self.assertEqual([(r.top, r.left, r.bottom, r.right) for r in rois], [(0, 0, 2, 2), (1, 3, 3, 4)])
+        self.assertEqual([roi_obj.area for roi_obj in rois], [4, 2])
+
+
+class SpatialTest(unittest.TestCase):
+    def setUp(self):
+        self.roi_objs = read_test_rois() + [ROIRect(10, 200, 40, 260, arc=20), ROIOval(150, 150, 190, 230)]
+        self.index = ROIIndex(self.roi_objs)
+
+    def test_query_points(self):
+        # Points at all pixel centers are inside an ROI where its mask is
+        y, x = np.mgrid[0:300, 0:300]
+        point_idx, roi_idx = self.index.query_points(x.ravel() + 0.5, y.ravel() + 0.5)
+        for i, roi_obj in enumerate(self.roi_objs):
+            mask = np.zeros(300 * 300, dtype=bool)
+            mask[point_idx[roi_idx == i]] = True
+            if roi_obj.type in ['line', 'polyline']:
+                self.assertFalse(mask.any())
+            else:
+                self.assertTrue(np.array_equal(mask, roi_obj.to_mask((300, 300)).ravel()))
+
+        self.assertEqual(list(self.index.query_point(60.5, 100.5)), [3])
+        self.assertEqual(list(self.index.query_point(10.5, 10.5)), [5])
+        self.assertEqual(list(self.index.query_point(500, 500)), [])
+
+    def test_query_bbox(self):
+        expected = ROICollection.from_rois(self.roi_objs).in_bbox(0, 0, 100, 100)
+        self.assertEqual(list(self.index.query_bbox(0, 0, 100, 100)), list(expected))
+        self.assertEqual(list(self.index.query_bbox(-50, -50, -10, -10)), [])
+
+    def test_nearest(self):
+        centroids = ROICollection.from_rois(self.roi_objs).centroid
+        for x, y in [(100, 60), (0, 0), (280, 280), (1000, -1000)]:
+            distance = np.hypot(centroids[:, 0] - x, centroids[:, 1] - y)
+            self.assertEqual(list(self.index.nearest(x, y, k=3)), list(np.argsort(distance)[:3]))
+
+    def test_assign_points(self):
+        points = np.random.RandomState(0).uniform(-10, 310, (5000, 2))
+        closed = [i for i, roi_obj in enumerate(self.roi_objs) if roi_obj.type not in ['line', 'polyline']]
+        labels = np.array([-1] + closed)[rasterize([self.roi_objs[i] for i in closed], (300, 300))]
+        col, row = np.floor(points).astype(int).T
+        in_image = (row >= 0) & (row < 300) & (col >= 0) & (col < 300)
+        centers = np.floor(points) + 0.5  # Masks are defined by pixel centers
+
+        assigned = assign_points(centers, self.roi_objs)
+        expected = np.where(in_image, labels[row.clip(0, 299), col.clip(0, 299)], -1)
+        self.assertTrue(np.array_equal(assigned, expected))
+        self.assertTrue(np.array_equal(assign_points(centers, self.index, chunksize=1000, workers=2), expected))
+
+        overlapping = [ROIRect(0, 0, 5, 5), ROIRect(2, 2, 6, 6)]
+        self.assertEqual(list(assign_points([[1, 1], [3, 3], [9, 9]], overlapping)), [0, 1, -1])
+        self.assertEqual(list(assign_points([[1, 1], [3, 3]], [])), [-1, -1])
+
+
+class OverlapTest(unittest.TestCase):
+    def setUp(self):
+        self.rois_a = [ROIRect(0, 10, 10, 20), ROIRect(0, 15, 10, 25), ROIOval(50, 50, 60, 70)]
+        self.rois_b = [ROIRect(0, 12, 10, 22), ROIRect(0, 6, 10, 16), ROIOval(50, 50, 60, 70), ROIRect(90, 90, 95, 95)]
+
+    def test_iou_pairs(self):
+        idx_a, idx_b, intersection, iou = iou_pairs(self.rois_a, self.rois_b)
+        self.assertEqual(list(zip(idx_a, idx_b)), [(0, 0), (0, 1), (1, 0), (1, 1), (2, 2)])
+        self.assertEqual(list(intersection), [80, 60, 70, 10, self.rois_a[2].to_mask((100, 100)).sum()])
+
+        # Brute force reference on full masks
+        for a, b, value in zip(idx_a, idx_b, iou):
+            mask_a, mask_b = self.rois_a[a].to_mask((100, 100)), self.rois_b[b].to_mask((100, 100))
+            self.assertAlmostEqual(value, (mask_a & mask_b).sum() / float((mask_a | mask_b).sum()))
+
+    def test_match_rois(self):
+        idx_a, idx_b, iou = match_rois(self.rois_a, self.rois_b, threshold=0.3)
+        self.assertEqual(list(zip(idx_a, idx_b)), [(0, 0), (2, 2)])
+        self.assertRaises(ValueError, match_rois, self.rois_a, self.rois_b, method='random')
+
+    @unittest.skipUnless(scipy, 'scipy not installed')
+    def test_iou_matrix(self):
+        matrix = iou_matrix(self.rois_a, self.rois_b)
+        idx_a, idx_b, intersection, iou = iou_pairs(self.rois_a, self.rois_b)
+        self.assertEqual(matrix.shape, (3, 4))
+        self.assertEqual(matrix.nnz, len(iou))
+        self.assertTrue(np.allclose(matrix[idx_a, idx_b].A1, iou))
+        expected = np.zeros((3, 4))
+        expected[idx_a, idx_b] = iou
+        self.assertTrue(np.allclose(matrix.toarray(), expected))
+
+    @unittest.skipUnless(scipy, 'scipy not installed')
+    def test_match_rois_hungarian(self):
+        # Maximizing the total IoU matches both rects
+        idx_a, idx_b, iou = match_rois(self.rois_a, self.rois_b, threshold=0.3, method='hungarian')
+        self.assertEqual(list(zip(idx_a, idx_b)), [(0, 1), (1, 0), (2, 2)])
+
+
+class PositionTest(unittest.TestCase):
+    def setUp(self):
+        # ROIs 0-8 at c 1-2, z 1 and t 1-5, ROI 9 without position and ROIs 10, 11 at stack position 7
+        self.roi_objs = []
+        for i in range(12):
+            roi_obj = ROIRect(0, 0, 5, 5, name='roi_%02i' % i)
+            positioned = i < 9
+            roi_obj.header = {'C_POSITION': i % 2 + 1 if positioned else 0, 'Z_POSITION': int(positioned),
+                              'T_POSITION': i // 2 + 1 if positioned else 0, 'POSITION': 7 if i >= 10 else 0}
+            self.roi_objs.append(roi_obj)
+
+    def test_queries(self):
+        index = PositionIndex.from_rois(self.roi_objs)
+        self.assertEqual(list(index.frame(3)), [4, 5])
+        self.assertEqual(list(index.frames(2, 4)), [2, 3, 4, 5])
+        self.assertEqual(list(index.frame(7)), [10, 11])
+        self.assertEqual(list(index.frame(3, include_all=True)), [4, 5, 9])
+        self.assertEqual(list(index.frame(2, dim='c')), [1, 3, 5, 7])
+        self.assertEqual(list(index[2, 1, 3]), [5])
+        self.assertEqual(list(index[0, 0, 3]), [4, 5])
+        self.assertEqual(list(index[1, 1, 99]), [])
+        self.assertEqual(list(index.unique()), [1, 2, 3, 4, 5, 7])
+
+    def test_position_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        for roi_obj in self.roi_objs:
+            with ROIEncoder(os.path.join(tmp_dir, roi_obj.name + '.roi'), roi_obj) as roi:
+                roi.write()
+        zip_path = os.path.join(tmp_dir, 'RoiSet.zip')
+        with RoiSetWriter(zip_path) as roi_set:
+            roi_set.write_all(self.roi_objs)
+
+        for path in [tmp_dir, zip_path]:
+            index = position_index(path)
+            self.assertEqual(len(index), 12)
+            self.assertEqual(list(index[2, 1, 3]), [5])
+            self.assertEqual(list(index.frame(7)), [10, 11])
+        self.assertEqual(len(decode_many(tmp_dir, workers=1)[0]), 12)
+
+
+class TransformTest(unittest.TestCase):
+    def test_shift(self):
+        roi_objs = read_test_rois()
+        shifted = transform(roi_objs, (10, -5))
+
+        self.assertEqual((shifted[0].top, shifted[0].left), (roi_objs[0].top - 5, roi_objs[0].left + 10))
+        self.assertTrue(np.array_equal(shifted[0].x_coords, roi_objs[0].x_coords))
+        self.assertEqual((shifted[1].x1, shifted[1].y2), (roi_objs[1].x1 + 10, roi_objs[1].y2 - 5))
+        self.assertEqual((shifted[5].top, shifted[5].left, shifted[5].bottom, shifted[5].right), (-5, 10, 50, 124))
+        mask = np.roll(roi_objs[0].to_mask((300, 300)), (-5, 10), axis=(0, 1))
+        self.assertTrue(np.array_equal(shifted[0].to_mask((300, 300)), mask))
+
+        collection = transform(ROICollection.from_rois(roi_objs), (10, -5))
+        self.assertIsInstance(collection, ROICollection)
+        self.assertTrue(np.array_equal(collection.bboxes, ROICollection.from_rois(shifted).bboxes))
+
+    def test_affine(self):
+        polygon = ROIPolygon(10, 20, 14, 24, np.array([0, 4, 4, 0]), np.array([0, 0, 4, 4]))
+        rect = ROIRect(0, 0, 10, 20, arc=4)
+        scaled = transform([polygon, rect], [[1.5, 0, 0.25], [0, 1.5, 0], [0, 0, 1]])
+
+        self.assertEqual(scaled[0].x_coords.dtype.kind, 'f')  # Promoted to subpixel
+        self.assertEqual((scaled[0].top, scaled[0].left, scaled[0].bottom, scaled[0].right), (15, 30, 21, 37))
+        self.assertTrue(np.allclose(scaled[0].left + scaled[0].x_coords, [30.25, 36.25, 36.25, 30.25]))
+        self.assertEqual((scaled[1].bottom, scaled[1].right, scaled[1].arc), (15, 30, 6))
+
+        with ROIDecoder.from_bytes(encode_to_bytes(scaled[0]), subpixel=True) as roi:
+            self.assertTrue(np.allclose(roi.get_roi().x_coords, scaled[0].x_coords))
+
+        self.assertRaises(ValueError, transform, [rect], (40000, 0))
+
+    def test_per_frame(self):
+        roi_objs = [ROIRect(0, 0, 5, 5) for i in range(3)]
+        for t, roi_obj in enumerate(roi_objs):
+            roi_obj.header = {'T_POSITION': t}
+        shifted = transform(roi_objs, [[1, 1], [2, 2]], by='t')
+        self.assertEqual([(r.top, r.left) for r in shifted], [(0, 0), (1, 1), (2, 2)])
+        self.assertRaises(ValueError, transform, roi_objs, [[1, 1]], by='t')
+        self.assertRaises(ValueError, transform, roi_objs, [[1, 1], [2, 2]])
+
+
+class CompositeTest(unittest.TestCase):
+    def setUp(self):
+        # Square with a square hole, both rings anticlockwise, and a separate small square
+        x = np.array([10, 10, 30, 30, 15, 15, 25, 25, 40, 40, 44, 44])
+        y = np.array([10, 30, 30, 10, 15, 25, 25, 15, 10, 14, 14, 10])
+        self.roi_obj = ROIComposite.from_rings(x, y, [0, 4, 8, 12], name='composite')
+
+    def test_geometry(self):
+        roi_obj = self.roi_obj
+        self.assertEqual((roi_obj.top, roi_obj.left, roi_obj.bottom, roi_obj.right), (10, 10, 30, 44))
+        self.assertEqual(len(roi_obj.rings), 3)
+        self.assertEqual(roi_obj.area, 316)
+        self.assertEqual(roi_obj.perimeter, 136)
+
+        mask = roi_obj.to_mask((50, 50))
+        self.assertEqual(mask.sum(), 316)
+        self.assertFalse(mask[15:25, 15:25].any())
+        self.assertTrue(mask[10:15, 10:30].all() and mask[10:14, 40:44].all())
+
+        rois = ROICollection.from_rois([roi_obj])
+        self.assertTrue(np.allclose(rois.area, [316]) and np.allclose(rois.perimeter, [136]))
+        self.assertEqual(list(contains(rois, [0, 0, 0], [12, 20, 42], [12, 20, 12])), [True, False, True])
+        self.assertTrue(np.array_equal(rois[0].to_mask((50, 50)), mask))
+        self.assertTrue(np.array_equal(rois.simplify().x, rois.x))
+
+    def test_encode_decode(self):
+        data = encode_to_bytes(self.roi_obj)
+        with ROIDecoder.from_bytes(data) as roi:
+            roi_obj = roi.get_roi()
+            self.assertEqual(roi.header['TYPE'], ROIDecoder.roi_types_rev['rect'])
+            self.assertEqual(roi.header['SHAPE_ROI_SIZE'], 3 * 12 + 3)
+
+        self.assertIsInstance(roi_obj, ROIComposite)
+        self.assertEqual(roi_obj.name, 'composite')
+        self.assertEqual(roi_obj.area, 316)
+        self.assertTrue(np.array_equal(roi_obj.to_mask((50, 50)), self.roi_obj.to_mask((50, 50))))
+
+    def test_ring_through_start(self):
+        # A single ring passing through its first vertex twice, as two touching squares
+        roi_obj = ROIComposite.from_rings([2, 4, 4, 2, 2, 0, 0, 2], [2, 2, 4, 4, 2, 2, 0, 0], [0, 8])
+        self.assertEqual(len(roi_obj.rings), 1)
+        self.assertEqual(roi_obj.area, 8)
+        self.assertEqual(roi_obj.perimeter, 16)
+
+        with ROIDecoder.from_bytes(encode_to_bytes(roi_obj)) as roi:
+            decoded = roi.get_roi()
+        self.assertEqual(len(decoded.rings), 1)
+        self.assertEqual(decoded.area, 8)
+        self.assertTrue(np.array_equal(decoded.to_mask((5, 5)), roi_obj.to_mask((5, 5))))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_cache([roi_obj, ROIRect(0, 0, 2, 2)], os.path.join(tmp_dir, 'rois.cache'))
+            rois = load_cache(os.path.join(tmp_dir, 'rois.cache'), use_mmap=False)
+        self.assertEqual(list(rois[0].ring_offsets), list(roi_obj.ring_offsets))
+        self.assertIsNone(rois.ring_offsets[1])
+        self.assertEqual(rois.take([0])[0].perimeter, 16)
+
+    def test_decode_path(self):
+        x, y, offsets = decode_path(encode_path([0, 4, 4, 0], [0, 0, 4, 4], [0, 4]))
+        self.assertEqual(list(x), [0, 4, 4, 0])
+        self.assertEqual(list(offsets), [0, 4])
+
+        # Circle of four cubic curves, coordinates look like segment types
+        k = 0.5523
+        segments = [0, 1, 0, 3, 1, k, k, 1, 0, 1, 3, -k, 1, -1, k, -1, 0, 3, -1, -k, -k, -1, 0, -1, 3, k, -1, 1, -k, 1,
+                    0, 4, 0, 2, 2, 1, 3, 3, 2, 3, 2, 2, 2, 4]
+        x, y, offsets = decode_path(segments, curve_steps=16)
+        self.assertEqual(list(offsets), [0, 64, 81])
+        self.assertTrue(np.allclose(np.hypot(x[:64], y[:64]), 1, atol=1e-3))
+        self.assertAlmostEqual(areas(x, y, offsets)[0], np.pi, places=2)
+
+        # A ring continuing after close without moveTo starts at the closed ring's start
+        x, y, offsets = decode_path([0, 0, 0, 1, 2, 0, 1, 2, 2, 4, 1, 0, 2, 1, -2, 2, 4])
+        self.assertEqual(list(offsets), [0, 3, 6])
+        self.assertEqual(list(zip(x[3:], y[3:])), [(0, 0), (0, 2), (-2, 2)])
+
+        self.assertRaises(ValueError, decode_path, [0, 1, 0, 1, 2])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file